@@ -0,0 +1,59 @@
+"""
+Adaptive stack range: follows the sharpness of the slices of a stack as they are taken, bottom to top, to leave out
+the slices that show nothing in focus
+
+The leading slices are left out while the field looks empty, i.e. while the sharpness stays within a factor rise of
+the first slice: only the last lead of them are kept once the sharpness rises. When the stack starts in focus, the
+sharpness falls instead and every slice is kept. The stack ends once the sharpness has peaked and fallen back towards
+the sharpness of the out of focus field below the peak, by the fraction drop of the contrast of the peak (of its
+sharpness when the stack starts at the peak).
+"""
+
+
+class AdaptiveRange(object):
+    """
+    :param drop: the stack ends once the sharpness above the out of focus level falls below this fraction of the one
+        of the peak
+    :param rise: factor of sharpness over the out of focus level telling that something is in focus
+    :param lead: number of slices kept before the sharpness rises
+    """
+    def __init__(self, drop=0.25, rise=1.2, lead=1):
+        if not 0 <= drop < 1 or rise <= 1 or lead < 0:
+            raise ValueError(f"Invalid adaptive range drop {drop}, rise {rise} or lead {lead}")
+        self.drop = drop
+        self.rise = rise
+        self.lead = lead
+        # Sharpness of each slice added
+        self.values = []
+        # Index of the first slice kept, None while the field looks empty
+        self.first = None
+        self.stopped = False
+
+    def add(self, sharpness):
+        """
+        Adds the sharpness of the next slice, and updates first and stopped
+        """
+        self.values.append(sharpness)
+        i = len(self.values) - 1
+        if self.first is None:
+            if sharpness >= self.rise * self.values[0]:
+                self.first = max(i - self.lead, 0)
+            elif sharpness * self.rise <= self.values[0]:
+                self.first = 0
+            else:
+                return
+        peak = max(range(self.first, i + 1), key=lambda j: self.values[j])
+        # Out of focus level below the peak, none when the stack starts at the peak
+        floor = min(self.values[:peak]) if peak > 0 else 0
+        if self.values[peak] >= self.rise * floor and sharpness - floor < self.drop * (self.values[peak] - floor):
+            self.stopped = True
+
+    def finish(self):
+        """
+        Keeps every slice if the field looked empty all along
+
+        :return: index of the first slice kept
+        """
+        if self.first is None:
+            self.first = 0
+        return self.first
@@ -0,0 +1,80 @@
+"""
+Autofocus: finds the height at which the image is the sharpest in a few moves
+
+The sharpness is first sampled coarsely across the search range, from the bottom up, stopping early once it has
+clearly passed its peak. The peak is then narrowed down by golden-section search around the best coarse sample, and
+its position refined by fitting a parabola through the best sample and its neighbours. Every height is only measured
+once.
+"""
+import numpy as np
+
+GOLDEN = (np.sqrt(5) - 1) / 2
+
+
+def parabola_vertex(z, values):
+    """
+    :param z: three heights
+    :param values: the sharpness at these heights
+    :return: height of the vertex of the parabola through the three points, None if it is not a maximum
+    """
+    (z0, z1, z2), (v0, v1, v2) = z, values
+    denominator = (z0 - z1) * (z0 - z2) * (z1 - z2)
+    if denominator == 0:
+        return None
+    a = (z2 * (v1 - v0) + z1 * (v0 - v2) + z0 * (v2 - v1)) / denominator
+    b = (z2 ** 2 * (v0 - v1) + z1 ** 2 * (v2 - v0) + z0 ** 2 * (v1 - v2)) / denominator
+    if a >= 0:
+        return None
+    return -b / (2 * a)
+
+
+def autofocus(measure, z_min, z_max, coarse_step, tolerance, drop=0.5):
+    """
+    :param measure: function (z) moving the stage to z (µm) and returning the sharpness of the image taken there
+    :param coarse_step: distance between the samples of the coarse pass, in µm
+    :param tolerance: size of the bracket around the peak at which the search stops, in µm
+    :param drop: the coarse pass stops once the sharpness falls below this fraction of the best one, at least two
+        steps above it
+    :return: dict with the height of best focus 'z', the best 'sharpness' measured, the number of 'moves' and the
+        'samples' as a list of (z, sharpness) sorted by z
+    """
+    if z_max <= z_min or coarse_step <= 0 or tolerance <= 0:
+        raise ValueError(f"Invalid autofocus range [{z_min}, {z_max}], step {coarse_step} or tolerance {tolerance}")
+    samples = {}
+
+    def sample(z):
+        z = float(min(max(z, z_min), z_max))
+        if z not in samples:
+            samples[z] = measure(z)
+        return samples[z]
+
+    best = None
+    for z in np.arange(z_min, z_max + coarse_step / 2, coarse_step):
+        value = sample(z)
+        if best is None or value > samples[best]:
+            best = float(z)
+        elif z - best >= 2 * coarse_step and value < drop * samples[best]:
+            break
+
+    low, high = max(best - coarse_step, z_min), min(best + coarse_step, z_max)
+    c, d = high - GOLDEN * (high - low), low + GOLDEN * (high - low)
+    fc, fd = sample(c), sample(d)
+    while high - low > tolerance:
+        if fc > fd:
+            high, d, fd = d, c, fc
+            c = high - GOLDEN * (high - low)
+            fc = sample(c)
+        else:
+            low, c, fc = c, d, fd
+            d = low + GOLDEN * (high - low)
+            fd = sample(d)
+
+    ordered = sorted(samples.items())
+    index = max(range(len(ordered)), key=lambda i: ordered[i][1])
+    z_best, sharpness = ordered[index]
+    if 0 < index < len(ordered) - 1:
+        (z0, v0), (z2, v2) = ordered[index - 1], ordered[index + 1]
+        vertex = parabola_vertex((z0, z_best, z2), (v0, sharpness, v2))
+        if vertex is not None and z0 < vertex < z2:
+            z_best = vertex
+    return {'z': float(z_best), 'sharpness': float(sharpness), 'moves': len(samples), 'samples': ordered}
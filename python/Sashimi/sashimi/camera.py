@@ -1,19 +1,139 @@
 import threading
+import time
 
 import cv2
+import numpy as np
 from pypylon import pylon
 from pathlib import Path
 
 # TODO: look into pylon.ImageFileFormat
 
-capture_lock = threading.Lock()
+
+class FrameRing(object):
+    """
+    Preallocated slots holding the latest frames, written by the capture thread one after the other
+
+    Consumers get a read-only view of the newest complete frame, without copying it, or wait for the next frame
+    that satisfies a condition (wait_for). The lock is only held to update or read the sequence numbers. A view stays
+    valid until its slot is written again, i.e. for slots - 1 frames; is_current() tells whether it still is, and
+    frames that are kept longer must be copied.
+
+    :param slots: number of frames kept
+    """
+    def __init__(self, slots=8):
+        self.slots = slots
+        self.frames = None
+        self.exposures = [None] * slots
+        self.starts = [None] * slots
+        self.sequences = [-1] * slots
+        self.sequence = -1
+        self.condition = threading.Condition()
+
+    def next_slot(self, shape, dtype=np.uint8):
+        """
+        :return: index and array of the slot in which to write the next frame
+        """
+        shape = tuple(shape)
+        if self.frames is None or self.frames.shape[1:] != shape or self.frames.dtype != dtype:
+            # The views of the previous frames keep the old slots alive
+            self.frames = np.empty((self.slots,) + shape, dtype=dtype)
+        index = (self.sequence + 1) % self.slots
+        with self.condition:
+            self.sequences[index] = -1
+        return index, self.frames[index]
+
+    def publish(self, index, exposure, started=None):
+        """
+        :param started: time (time.monotonic) at which the exposure of the frame started
+        """
+        with self.condition:
+            self.sequence += 1
+            self.sequences[index] = self.sequence
+            self.exposures[index] = exposure
+            self.starts[index] = started
+            self.condition.notify_all()
+
+    def store(self, image, exposure, started=None, rotate=False):
+        """
+        Copies an image in the next slot, rotating it by 180° if asked, and publishes it
+        """
+        index, slot = self.next_slot(image.shape, image.dtype)
+        if rotate:
+            cv2.rotate(image, cv2.ROTATE_180, dst=slot)
+        else:
+            np.copyto(slot, image)
+        self.publish(index, exposure, started)
+
+    def latest(self):
+        """
+        :return: read-only view of the newest frame, its exposure and its sequence number (None, None, -1 before
+            the first frame)
+        """
+        with self.condition:
+            if self.sequence < 0:
+                return None, None, -1
+            return self._view(self.sequence)
+
+    def wait_for(self, predicate=None, after=-1, timeout=None):
+        """
+        Waits for the first frame newer than after that satisfies predicate(exposure, started)
+
+        The frames published meanwhile are checked oldest first, as long as they are still in the ring.
+
+        :param after: sequence number of a frame already seen
+        :param timeout: in seconds, None to wait indefinitely
+        :return: read-only view of the frame, its exposure and its sequence number (None, None, -1 on timeout)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            checked = after
+            while True:
+                for sequence in range(max(checked + 1, self.sequence - self.slots + 1), self.sequence + 1):
+                    index = sequence % self.slots
+                    if self.sequences[index] != sequence:
+                        continue
+                    if predicate is None or predicate(self.exposures[index], self.starts[index]):
+                        return self._view(sequence)
+                checked = max(checked, self.sequence)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None, None, -1
+                self.condition.wait(remaining)
+
+    def _view(self, sequence):
+        index = sequence % self.slots
+        frame = self.frames[index].view()
+        frame.flags.writeable = False
+        return frame, self.exposures[index], sequence
+
+    def started(self, sequence):
+        """
+        :return: time (time.monotonic) at which the exposure of the frame with this sequence number started, None if
+            it is unknown or the frame was overwritten
+        """
+        with self.condition:
+            index = sequence % self.slots
+            return self.starts[index] if sequence >= 0 and self.sequences[index] == sequence else None
+
+    def is_current(self, sequence):
+        """
+        Whether the frame with this sequence number has not been overwritten yet
+        """
+        with self.condition:
+            return sequence >= 0 and self.sequences[sequence % self.slots] == sequence
 
 
 class CaptureThread(threading.Thread):
+    """
+    Grabs the frames into a FrameRing, either free running (keeping only the latest frame) or one by one, each
+    frame being triggered by software (see Camera.set_triggered)
+    """
     def __init__(self,
                  camera: pylon.InstantCamera,
                  converter: pylon.ImageFormatConverter,
                  controller,
+                 frames: FrameRing,
+                 triggered=False,
                  group=None,
                  target=None,
                  name=None,
@@ -26,25 +146,49 @@ class CaptureThread(threading.Thread):
         self.controller = controller
         self.target = target
         self.name = name
-        self.image = None
-        self.exposure = None
+        self.frames = frames
+        self.triggered = triggered
+        # Whether the camera already flips the images (ReverseX and ReverseY)
+        self.reversed = False
 
     # noinspection PyUnresolvedReferences
     def run(self):
-        self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
+        if self.triggered:
+            # No frame is dropped, there is exactly one per trigger
+            self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
+        else:
+            self.camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
+        previous = None
         while self.camera.IsGrabbing():
-            grab_result = self.camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-            if grab_result is False:
-                continue
-            if grab_result.GrabSucceeded():
-                with capture_lock:
-                    self.image = cv2.rotate(self.converter.Convert(grab_result).Array, cv2.ROTATE_180)
-                    self.exposure = grab_result.ChunkExposureTime.Value
-                # Check if quit
+            # Triggered frames may be far apart, so the wait is repeated until grabbing stops
+            grab_result = self.camera.RetrieveResult(500, pylon.TimeoutHandling_Return)
+            if not grab_result.IsValid():
+                # Timed out, e.g. while no trigger comes
                 if self.controller.quit_requested:
-                    grab_result.Release()
                     break
+                continue
+            if grab_result.GrabSucceeded():
+                exposure = grab_result.ChunkExposureTime.Value
+                # The exposure started at the latest one frame interval (at least the exposure) before the frame
+                # was received. Triggered frames start after their trigger.
+                received = time.monotonic()
+                if previous is None or self.triggered:
+                    interval = exposure / 1e6
+                else:
+                    interval = max(exposure / 1e6, received - previous)
+                started = received - interval
+                previous = received
+                if grab_result.PixelType == pylon.PixelType_BGR8packed:
+                    # Copied straight from the grab buffer into the slot
+                    with grab_result.GetArrayZeroCopy() as array:
+                        self.frames.store(array, exposure, started, rotate=not self.reversed)
+                else:
+                    self.frames.store(self.converter.Convert(grab_result).Array, exposure, started,
+                                      rotate=not self.reversed)
             grab_result.Release()
+            # Check if quit
+            if self.controller.quit_requested:
+                break
         return
 
 
@@ -56,6 +200,9 @@ class Camera(object):
         self.converter = pylon.ImageFormatConverter()
         self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed
         self.capture_thread = None
+        self.frames = FrameRing()
+        self.reversed = False
+        self.triggered = False
         self.camera_settings_file_path = str(Path(package_path).joinpath(camera_settings_file))
 
     def start(self):
@@ -78,8 +225,53 @@ class Camera(object):
             answer = input("No camera setting file found. Do you want to save the current camera settings? (y/n): ")
             if answer.lower() == 'y':
                 self.save_camera_settings()
-        self.capture_thread = CaptureThread(self.camera, self.converter, self.controller)
+        self.reversed = self.reverse_image()
+        self.start_capture()
+
+    def start_capture(self):
+        self.capture_thread = CaptureThread(self.camera, self.converter, self.controller, self.frames, self.triggered)
+        self.capture_thread.reversed = self.reversed
         self.capture_thread.start()
+
+    def set_triggered(self, triggered):
+        """
+        Switches between free running and software triggered acquisition. Grabbing is restarted, the frames are
+        still published to the same FrameRing.
+        """
+        if triggered == self.triggered:
+            return
+        self.camera.StopGrabbing()
+        self.capture_thread.join()
+        self.camera.TriggerSelector.SetValue("FrameStart")
+        self.camera.TriggerMode.SetValue("On" if triggered else "Off")
+        self.camera.TriggerSource.SetValue("Software")
+        self.triggered = triggered
+        self.start_capture()
+
+    def trigger(self, timeout_ms=1000):
+        """
+        Takes exactly one frame in triggered mode
+
+        :return: sequence number of the frame published before it, to wait for it with wait_for_frame(after=...)
+        """
+        sequence = self.frames.sequence
+        self.camera.WaitForFrameTriggerReady(timeout_ms, pylon.TimeoutHandling_ThrowException)
+        self.camera.ExecuteSoftwareTrigger()
+        return sequence
+
+    def reverse_image(self):
+        """
+        Rotates the images by 180° on the camera, if it can
+
+        :return: whether the camera rotates the images
+        """
+        try:
+            self.camera.ReverseX.SetValue(True)
+            self.camera.ReverseY.SetValue(True)
+            return True
+        except Exception as e:
+            print(f"The camera can not reverse the images, they are rotated by Sashimi ({e})")
+            return False
     
     def save_camera_settings(self):
         n_map = self.camera.GetNodeMap()
@@ -98,17 +290,37 @@ class Camera(object):
         self.camera.ChunkModeActive = False
         self.camera.Close()
 
-    def latest_image(self, with_exposure=False):
-        img = None
-        with capture_lock:
-            if self.capture_thread.image is not None:
-                img = self.capture_thread.image.copy()
-                exp = int(self.capture_thread.exposure)
+    def latest_image(self, with_exposure=False, copy=True):
+        """
+        :param copy: return a copy of the image rather than a read-only view of the frame buffer, which gets
+            overwritten after a few frames (see FrameRing)
+        """
+        img, exp, _ = self.latest_frame()
+        if img is not None and copy:
+            img = img.copy()
         if with_exposure:
-            return img, exp
+            return img, None if exp is None else int(exp)
         else:
             return img
 
+    def latest_frame(self):
+        """
+        :return: read-only view of the newest frame, its exposure and its sequence number
+        """
+        return self.frames.latest()
+
+    def wait_for_frame(self, predicate=None, after=-1, timeout=None):
+        """
+        Waits for the next frame satisfying predicate(exposure, started), see FrameRing.wait_for
+        """
+        return self.frames.wait_for(predicate, after, timeout)
+
+    def frame_rate(self):
+        """
+        :return: frame rate of the camera when free running, given its current settings (exposure, ROI...)
+        """
+        return self.camera.ResultingFrameRate.GetValue()
+
     def set_exposure(self, value):
         self.camera.ExposureTime.SetValue(value)
 
@@ -3,7 +3,7 @@ import click
 import datetime as dt
 from pathlib import Path
 from sashimi.controller import Controller
-from sashimi import helicon_stack as helicon_stacker, utils, focus_stack
+from sashimi import helicon_stack as helicon_stacker, utils, focus_stack, stackers
 
 
 @click.group()
@@ -44,9 +44,53 @@ def cli():
 @click.option("--skip-fs", "-s",
               is_flag=True,
               help='skips focus-stacking while scanning')
+@click.option("--stream-fs", "-f",
+              is_flag=True,
+              help='fuses each stack while it is being captured instead of after it is saved')
+@click.option("--stack-files",
+              is_flag=True,
+              help='saves each stack in a single file instead of one jpg per picture')
+@click.option("--stacker",
+              type=click.Choice(list(stackers.STACKERS)),
+              default="pyramid",
+              help='algorithm fusing the stacks while scanning')
+@click.option("--stack-workers", "-w",
+              type=int,
+              default=None,
+              help='number of processes fusing the stacks while scanning (half the number of CPUs by default)')
+@click.option("--fusion-precision",
+              type=click.Choice(list(focus_stack.PRECISIONS)),
+              default="float64",
+              help='storage of the pyramid levels of the pyramid stacker, uint16 uses the least memory')
+@click.option("--fusion-memory",
+              type=float,
+              default=None,
+              help='memory available to the fusion of each stack in GB, above which the pyramid stacker fuses the '
+                   'images one at a time, then at a lower precision')
+@click.option('--triggered',
+              is_flag=True,
+              help='triggers exactly one frame per slice instead of waiting for the next frame of the camera')
+@click.option('--continuous-z',
+              is_flag=True,
+              help='moves Z without stopping through each stack, taking one picture per frame of the camera')
+@click.option('--autofocus',
+              type=click.Choice(['tile', 'corners', 'map']),
+              default=None,
+              help='finds the height of each stack, of the corners of each scan or of a grid over each scan (map), '
+                   'by autofocus')
+@click.option('--adaptive-z',
+              is_flag=True,
+              help='leaves out the slices below and above the particles of each stack, following their sharpness')
+@click.option('--empty-fields',
+              type=click.Choice(['skip', 'single']),
+              default=None,
+              help='skips the stacks of the fields without particles, or takes a single picture of them')
 @click.option('--auto-quit', '-q',
               is_flag=True,
               help='Sashimi quits automatically after scanning')
+@click.option('--simulate',
+              is_flag=True,
+              help='uses a simulated camera and stage instead of the hardware')
 @click.option('--margin', '-m',
               type=int,
               default=200,
@@ -57,7 +101,9 @@ def cli():
 @click.option('--yes/--no', '-y/-n',
               default=False,
               is_flag=True)
-def scan(dir_, port, lang, layout, mult_exp, remove_raw, skip_fs, auto_quit, margin, lowest, yes):
+def scan(dir_, port, lang, layout, mult_exp, remove_raw, skip_fs, stream_fs, stack_files, stacker, stack_workers,
+         fusion_precision, fusion_memory, triggered, continuous_z, autofocus, adaptive_z, empty_fields, auto_quit,
+         simulate, margin, lowest, yes):
     if dir_ is None:
         dir_ = utils.make_unique_subdir()
     if mult_exp == 'undisclosed':
@@ -69,8 +115,13 @@ def scan(dir_, port, lang, layout, mult_exp, remove_raw, skip_fs, auto_quit, mar
         
     controller = Controller(dir_, port, lang=lang, layout=layout,
                             z_margin=margin, remove_raw=remove_raw,
-                            auto_f_stack=not skip_fs, auto_quit=auto_quit,
-                            multi_exp=exp_values, lowest_z=lowest, do_overwrite=yes)
+                            auto_f_stack=not skip_fs, stream_stack=stream_fs, stack_files=stack_files,
+                            stacker=stacker, stack_workers=stack_workers, fusion_precision=fusion_precision,
+                            memory_budget=None if fusion_memory is None else fusion_memory * 1e9,
+                            triggered=triggered,
+                            continuous_z=continuous_z, autofocus=autofocus, adaptive_z=adaptive_z,
+                            empty_fields=empty_fields, auto_quit=auto_quit,
+                            multi_exp=exp_values, lowest_z=lowest, do_overwrite=yes, simulate=simulate)
     controller.start()
 
 
@@ -79,12 +130,16 @@ def scan(dir_, port, lang, layout, mult_exp, remove_raw, skip_fs, auto_quit, mar
               type=str,
               prompt='Directory containing stacks',
               help='Directory with a structure like "THIS/DIRECTORY/X00100_Y02200/X00100_Y02200_Z00135.jpg"')
-def stack(dir_):
+@click.option('--workers', '-w',
+              type=int,
+              default=None,
+              help='number of stacking processes (half the number of CPUs by default)')
+def stack(dir_, workers):
     if dir_ is None:
         utils.make_unique_subdir()
     else:
         dir_ = Path(dir_).resolve()
-    focus_stack.stack(dir_)
+    focus_stack.stack(dir_, workers)
     print(f"focus stacks saved at {dir_}")
 
 
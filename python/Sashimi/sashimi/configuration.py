@@ -1,6 +1,7 @@
 import json
 import os
 import sashimi
+from sashimi.motion import MotionModel
 
 
 class Configuration(object):
@@ -17,8 +18,23 @@ class Configuration(object):
                        'Z_corrections':[0, 0]}]
         self.package_path = os.path.dirname(sashimi.__file__)
         self.camera_settings_file="nodeFile.pfs"
+        # Accelerations of the axes and settle time of the stage, calibrated while scanning
+        self.motion = MotionModel.default_parameters()
+        # Columns and rows of the grid of autofocus samples of the focus maps, and the surface fitted through them
+        self.focus_grid = [3, 3]
+        self.focus_map_method = "bilinear"
+        # Focus operator of the autofocus and of the adaptive stack range (see focus_metrics)
+        self.focus_metric = "tenengrad"
+        # Adaptive stack range: fraction of the contrast of the peak of sharpness below which the stack ends, and
+        # factor of sharpness telling that something is in focus (see adaptive_range)
+        self.adaptive_drop = 0.25
+        self.adaptive_rise = 1.2
+        # Empty field detection: distance to the background of the particles, in standard deviations of the
+        # background, and area of the smallest particle in pixels (see occupancy)
+        self.occupancy_threshold = 4.
+        self.occupancy_min_area = 900
     
-    def update_z_correction_terms(self, index, blz=None):
+    def update_z_correction_terms(self, index, blz=None, save=True):
         # supposes the scan surface is flat and non-vertical
         fl, br = self.scans[index]['FL'], self.scans[index]['BR']
         x, y, z = 0, 1, 2
@@ -35,7 +51,10 @@ class Configuration(object):
 
         self.scans[index]['BL_Z'] = blz
         self.scans[index]['Z_corrections'] = [dz_dx, dz_dy]
-        self.save()
+        # The focus map does not match the new corners
+        self.scans[index].pop('focus_map', None)
+        if save:
+            self.save()
 
     def save(self, save_name="config"):
         config_file = os.path.join(os.path.expanduser("~"), ".Sashimi", save_name + ".json")
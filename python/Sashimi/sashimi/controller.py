@@ -1,3 +1,4 @@
+import time
 import cv2
 import numpy as np
 from pathlib import Path
@@ -5,6 +6,8 @@ from sashimi.camera import Camera
 from sashimi.scanner import Scanner
 from sashimi.stage import Stage
 from sashimi.configuration import Configuration
+from sashimi.preview import Preview
+from sashimi import simulation
 from sashimi.utils import Keyboard
 
 # TODO: Add save/load config files
@@ -21,9 +24,22 @@ class Controller(object):
             multi_exp: list[float] = None,
             remove_raw: bool = False,
             auto_f_stack: bool = True,
+            stream_stack: bool = False,
+            stack_files: bool = False,
+            stacker: str = "pyramid",
+            stack_workers: int = None,
+            fusion_precision: str = "float64",
+            memory_budget: float = None,
+            triggered: bool = False,
+            continuous_z: bool = False,
+            autofocus: str = None,
+            adaptive_z: bool = False,
+            empty_fields: str = None,
             auto_quit: bool = False,
             lowest_z: bool = False,
-            do_overwrite: bool = False):
+            do_overwrite: bool = False,
+            simulate: bool = False,
+            headless: bool = False):
 
         # saved/default config
         self.config = Configuration.load()
@@ -41,9 +57,36 @@ class Controller(object):
         self.multi_exp = multi_exp
         self.remove_raw = remove_raw
         self.auto_f_stack = auto_f_stack
+        self.stream_stack = stream_stack
+        self.stack_files = stack_files
+        self.stacker = stacker
+        self.stack_workers = stack_workers
+        # Storage of the pyramid levels and bytes available to the fusion of each stack, for the pyramid stacker
+        self.fusion_precision = fusion_precision
+        self.memory_budget = memory_budget
+        # One software triggered frame per slice, instead of waiting for the next free running one
+        self.triggered = triggered
+        # Z moves without stopping through each stack, which takes one exposure on the free running camera
+        if continuous_z and (triggered or multi_exp):
+            raise ValueError("Continuous Z stacks can not be triggered nor taken with multiple exposures")
+        self.continuous_z = continuous_z
+        # Finds the height of the stacks by autofocus at each stack ('tile'), at the corners of the scans or on a grid
+        # over the scans ('map')
+        if autofocus not in (None, 'tile', 'corners', 'map'):
+            raise ValueError(f"Unknown autofocus mode '{autofocus}', expected 'tile', 'corners' or 'map'")
+        self.autofocus = autofocus
+        # Leaves out the slices of each stack that show nothing in focus
+        self.adaptive_z = adaptive_z
+        # Skips the stacks of the fields without particles ('skip'), or takes a single frame of them ('single')
+        if empty_fields not in (None, 'skip', 'single'):
+            raise ValueError(f"Unknown empty fields mode '{empty_fields}', expected 'skip' or 'single'")
+        self.empty_fields = empty_fields
         self.auto_quit = auto_quit
         self.lowest_z = lowest_z
         self.do_overwrite = do_overwrite
+        # Without a window, nothing is displayed and no key is read (e.g. for benchmarks)
+        self.headless = headless
+        self.simulate = simulate
 
         # parameters an variables
         self.img_mode = 1
@@ -57,10 +100,17 @@ class Controller(object):
         self.start_scan_requested = False
         self.stop_scan_requested = False
         self.time_remaining = None
+        # Side panel on the left of the preview, showing the current status
+        self.preview = Preview(panel_width=300)
+        self.displayed_sequence = -1
         
         # instances
-        self.stage = Stage(self, com_port)
-        self.camera = Camera(self, self.config.package_path, self.config.camera_settings_file)
+        if simulate:
+            self.stage = simulation.SimulatedStage(self, com_port)
+            self.camera = simulation.SimulatedCamera(self)
+        else:
+            self.stage = Stage(self, com_port, self.config.motion)
+            self.camera = Camera(self, self.config.package_path, self.config.camera_settings_file)
         self.scanner = Scanner(self)
         self.keyboard = Keyboard(self.layout)
 
@@ -280,6 +330,9 @@ class Controller(object):
             self.interrupt_flag = True
     
     def check_for_command(self, wait_time=50):
+        if self.headless:
+            time.sleep(wait_time / 1000)
+            return False
         key = cv2.waitKey(wait_time)
         if key == -1:
             return False
@@ -292,20 +345,14 @@ class Controller(object):
             self.menu_commands(key)
         return True
 
-    def display(self, im: np.array):
+    def display(self, im: np.array, started=None):
+        """
+        :param started: time (time.monotonic) at which the exposure of the frame started, for the readout of the
+            preview
+        """
+        if self.headless:
+            return
         kb = self.keyboard
-        # Reduce size of image
-        im = im[::4, ::4, :].astype(np.uint8)
-
-        if self.img_mode > 1:
-            # Image mode and 2, 3, 4 are red, green and blue.
-            # If one of these are selected, create a new colour image just from that channel
-            im = np.repeat(im[:, :, self.img_mode - 2][..., np.newaxis], 3, axis=-1)
-
-        # Add some black space to left of image to draw current status
-        LEFT_EDGE_SIZE = 300
-        im = np.pad(im, [[0, 0], [LEFT_EDGE_SIZE, 0], [0, 0]])
-
         sel_scan_num = self.selected_scan_number
         sel_scan = self.selected_scan()
         blz = self.selected_scan()['BL_Z']
@@ -526,26 +573,22 @@ class Controller(object):
             if self.lang == "fr":
                 text_help = ["?: afficher l'aide"]
 
-        # Draw the UIs text
-        for i, t in enumerate(text_status):
-            cv2.putText(im, t, (50, i * 20 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (230, 230, 3055), 1, cv2.LINE_AA)
-
-        for i, t in enumerate(text_button):
-            cv2.putText(im, t, (10, i * 20 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (120, 255, 255), 1, cv2.LINE_AA)
-
-        for i, t in enumerate(text_help):
-            cv2.putText(im, t, (LEFT_EDGE_SIZE + 10, i * 20 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1,
-                        cv2.LINE_AA)
+        # Image modes 2, 3, 4 show the blue, green and red channel in grey levels. The text is only redrawn when it
+        # changes.
+        channel = self.img_mode - 2 if self.img_mode > 1 else None
+        canvas = self.preview.render(im, channel, text_button, text_status, text_help, started)
 
         # Show the image in the UI using open CV
-        cv2.imshow("im", im)
+        cv2.imshow("im", canvas)
     
     def wait(self, ms=50, display=True):
         for frame in range(ms//self.frame_duration_ms):
             if display:
-                img = self.camera.latest_image()
-                if img is not None:
-                    self.display(self.camera.latest_image())
+                # Only the frames that were not displayed yet
+                img, _, sequence = self.camera.latest_frame()
+                if img is not None and sequence != self.displayed_sequence:
+                    self.display(img, self.camera.frames.started(sequence))
+                    self.displayed_sequence = sequence
             if self.check_for_command():
                 return
 
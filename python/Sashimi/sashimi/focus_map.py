@@ -0,0 +1,102 @@
+"""
+Focus maps: height of best focus across a scan, interpolated between autofocus samples
+
+The best focus is sampled on a coarse grid over the scan, and a smooth surface is fitted through the samples, either
+bilinear between the points of the grid or a thin-plate spline (which also takes scattered samples, and can smooth
+noisy ones). The maps are saved with the scans in the configuration, as their samples. Heights and positions are in
+µm.
+"""
+import numpy as np
+from scipy import interpolate
+
+from sashimi import path_planning
+
+METHODS = ("bilinear", "thin_plate")
+
+
+def grid_points(scan, columns, rows):
+    """
+    :return: list of (x, y) positions of a grid of columns x rows points spanning the scan, corners included, in
+        the serpentine order in which to visit them
+    """
+    fl, br = scan['FL'], scan['BR']
+    xs = np.linspace(fl[0], br[0], columns)
+    ys = np.linspace(fl[1], br[1], rows)
+    return [(int(round(xs[xi])), int(round(ys[yi]))) for xi, yi in path_planning.serpentine(columns, rows)]
+
+
+def _thin_plate(samples, smoothing):
+    return interpolate.RBFInterpolator(samples[:, :2], samples[:, 2], kernel="thin_plate_spline", smoothing=smoothing)
+
+
+class FocusMap(object):
+    """
+    :param samples: list of (x, y, z) heights of best focus
+    :param method: 'bilinear' (the samples must form a full grid) or 'thin_plate'
+    :param smoothing: smoothing of the thin-plate spline, 0 to go through the samples
+    """
+    def __init__(self, samples, method="bilinear", smoothing=0.):
+        if method not in METHODS:
+            raise ValueError(f"Unknown focus map method '{method}', expected one of {METHODS}")
+        self.samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        self.method = method
+        self.smoothing = smoothing
+        if method == "bilinear":
+            xs, ys = np.unique(self.samples[:, 0]), np.unique(self.samples[:, 1])
+            if len(xs) < 2 or len(ys) < 2 or len(xs) * len(ys) != len(self.samples):
+                raise ValueError("A bilinear focus map needs samples on a full grid of at least 2 x 2 points")
+            grid = np.empty((len(ys), len(xs)))
+            grid[np.searchsorted(ys, self.samples[:, 1]), np.searchsorted(xs, self.samples[:, 0])] = self.samples[:, 2]
+            # Extrapolated linearly outside of the grid
+            self.interpolator = interpolate.RegularGridInterpolator((ys, xs), grid, bounds_error=False,
+                                                                    fill_value=None)
+        else:
+            if len(self.samples) < 3:
+                raise ValueError("A thin-plate focus map needs at least 3 samples")
+            self.interpolator = _thin_plate(self.samples, smoothing)
+        self.error = self.leave_one_out_error()
+
+    def __call__(self, x, y):
+        """
+        :return: height of best focus at (x, y), a float or an array like x and y
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        if self.method == "bilinear":
+            z = self.interpolator(np.column_stack([y.ravel(), x.ravel()]))
+        else:
+            z = self.interpolator(np.column_stack([x.ravel(), y.ravel()]))
+        return float(z[0]) if x.ndim == 0 else z.reshape(x.shape)
+
+    def leave_one_out_error(self):
+        """
+        RMS error of the height of each sample predicted from the other ones by a thin-plate spline, which tells how
+        far the surface can be from the best focus between the samples
+
+        :return: the error in µm, None if there are too few samples
+        """
+        errors = []
+        for i in range(len(self.samples)):
+            others = np.delete(self.samples, i, axis=0)
+            try:
+                predicted = _thin_plate(others, self.smoothing)(self.samples[i:i + 1, :2])[0]
+            except (ValueError, np.linalg.LinAlgError):
+                return None
+            errors.append(predicted - self.samples[i, 2])
+        return float(np.sqrt(np.mean(np.square(errors)))) if errors else None
+
+    def margin(self, step, maximum):
+        """
+        :param step: stack step, the smallest margin
+        :param maximum: margin used without a focus map
+        :return: distance below the surface at which to start the stacks: three times the leave-one-out error
+        """
+        if self.error is None:
+            return maximum
+        return int(min(max(np.ceil(3 * self.error), step), maximum))
+
+    def to_dict(self):
+        return {'method': self.method, 'smoothing': self.smoothing, 'samples': self.samples.round(1).tolist()}
+
+    @staticmethod
+    def from_dict(d):
+        return FocusMap(d['samples'], d['method'], d.get('smoothing', 0.))
@@ -0,0 +1,74 @@
+"""
+Focus metrics: sharpness of a frame, measured on a decimated view of it in float32
+
+The operators are
+- 'tenengrad': mean of the squared Sobel gradient
+- 'laplacian': variance of the Laplacian
+- 'brenner': mean of the squared differences between pixels two columns apart
+- 'gradient': mean norm of the gradient over the mean grey level, which does not change with the exposure
+
+The frame, or a region of it, is decimated by a strided view and reduced to grey levels in a single float32 array,
+which keeps the metrics fast enough to measure every frame while their peak stays at the same height.
+"""
+import cv2
+import numpy as np
+
+OPERATORS = ("tenengrad", "laplacian", "brenner", "gradient")
+
+
+def grey_view(img, step=4, roi=None):
+    """
+    :param step: decimation of the frame
+    :param roi: (x, y, width, height) region of the frame, the whole frame by default
+    :return: float32 grey levels (mean of the channels) of the decimated region
+    """
+    if roi is not None:
+        x, y, width, height = roi
+        img = img[y:y + height, x:x + width]
+    view = img[::step, ::step]
+    if view.ndim == 2:
+        return view.astype(np.float32)
+    # Channel by channel into the same array, which is much faster than reducing the strided last axis
+    grey = view[..., 0].astype(np.float32)
+    for channel in range(1, view.shape[-1]):
+        grey += view[..., channel]
+    grey *= 1 / view.shape[-1]
+    return grey
+
+
+def tenengrad(grey):
+    gx = cv2.Sobel(grey, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(grey, cv2.CV_32F, 0, 1)
+    return (float(np.vdot(gx, gx)) + float(np.vdot(gy, gy))) / grey.size
+
+
+def laplacian(grey):
+    _, deviation = cv2.meanStdDev(cv2.Laplacian(grey, cv2.CV_32F))
+    return float(deviation[0, 0]) ** 2
+
+
+def brenner(grey):
+    difference = grey[:, 2:] - grey[:, :-2]
+    return float(np.vdot(difference, difference)) / max(difference.size, 1)
+
+
+def gradient(grey):
+    dx = grey[1:, 1:] - grey[1:, :-1]
+    dy = grey[1:, 1:] - grey[:-1, 1:]
+    return float(cv2.magnitude(dx, dy).mean()) / max(float(grey.mean()), 1)
+
+
+_FUNCTIONS = {'tenengrad': tenengrad, 'laplacian': laplacian, 'brenner': brenner, 'gradient': gradient}
+
+
+def sharpness(img, operator="tenengrad", step=4, roi=None):
+    """
+    :param img: frame, colour (rows, columns, channels) or grey, of any dtype
+    :param operator: one of OPERATORS
+    :param step: decimation of the frame
+    :param roi: (x, y, width, height) region of the frame, the whole frame by default
+    :return: the sharpness, larger when the frame is in focus
+    """
+    if operator not in _FUNCTIONS:
+        raise ValueError(f"Unknown focus operator '{operator}', expected one of {OPERATORS}")
+    return _FUNCTIONS[operator](grey_view(img, step, roi))
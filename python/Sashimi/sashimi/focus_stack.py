@@ -13,10 +13,35 @@ import skimage.util as sku
 from glob import glob
 import skimage.io as skio
 import multiprocessing
+import queue
+import threading
+import time
+import tracemalloc
+from sashimi import registration, stack_file, stacking_service
+
+# "convolve" runs the full 5x5 kernel over each image and channel separately (reference implementation)
+# "separable" runs the 1D kernel over all images and channels at once and expands without zero-stuffing
+PYRAMID_BACKENDS = ("convolve", "separable")
+
+# Storage type of the pyramid levels. "uint16" stores levels as fixed point (see encode_level) and
+# computes in float32.
+PRECISIONS = ("float64", "float32", "uint16")
+
+# "batch" builds the pyramids of every image at once, "sequential" fuses one image at a time (see PyramidFuser)
+FUSION_STRATEGIES = ("batch", "sequential")
+
+# Laplacian levels lie in (-256, 256) for 8 bit images. Offsetting by 256 and scaling by 128 fits them into
+# uint16 with a resolution of 1/128 of a grey level.
+FIXED_POINT_OFFSET = 256
+FIXED_POINT_SCALE = 128
+
+
+def generating_kernel_1d(a):
+    return np.array([0.25 - a / 2.0, 0.25, a, 0.25, 0.25 - a / 2.0])
 
 
 def generating_kernel(a):
-    kernel = np.array([0.25 - a / 2.0, 0.25, a, 0.25, 0.25 - a / 2.0])
+    kernel = generating_kernel_1d(a)
     return np.outer(kernel, kernel)
 
 
@@ -56,7 +81,120 @@ def convolve(image, kernel=generating_kernel(0.4)):
     return ndimage.convolve(image.astype(np.float64), kernel, mode='mirror')
 
 
-def gaussian_pyramid(images, levels):
+def compute_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+    return np.float64 if precision == "float64" else np.float32
+
+
+def storage_dtype(precision):
+    return np.uint16 if precision == "uint16" else compute_dtype(precision)
+
+
+def fits_fixed_point(dtype):
+    """
+    Whether images of this type fit the range of the fixed point levels: 8 bit images, or float images in 0-255 as
+    everywhere else in this module
+    """
+    return not np.issubdtype(dtype, np.integer) or np.dtype(dtype).itemsize == 1
+
+
+def check_fixed_point(images, precision):
+    if precision == "uint16" and not fits_fixed_point(images.dtype):
+        raise ValueError(f"The uint16 precision needs 8 bit images, not {images.dtype}")
+
+
+def encode_level(level, precision):
+    if precision != "uint16":
+        return level.astype(compute_dtype(precision), copy=False)
+    fixed = (level + FIXED_POINT_OFFSET) * FIXED_POINT_SCALE + 0.5
+    return np.clip(fixed, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def decode_level(level, precision):
+    if precision != "uint16":
+        return level.astype(compute_dtype(precision), copy=False)
+    return level.astype(np.float32) / FIXED_POINT_SCALE - FIXED_POINT_OFFSET
+
+
+def _as_float(array):
+    if array.dtype == np.float32 or array.dtype == np.float64:
+        return array
+    return array.astype(np.float64)
+
+
+def _along(axis, index, ndim):
+    """
+    Index tuple that applies index along a single axis
+    """
+    key = [slice(None)] * ndim
+    key[axis] = index
+    return tuple(key)
+
+
+def reduce_stack(images, kernel=generating_kernel_1d(0.4)):
+    """
+    Reduces a (..., rows, columns, channels) array in one pass, using the separable form of the kernel.
+
+    Only the rows (then columns) that are kept by the decimation are filtered along the second axis.
+    """
+    reduced = _as_float(images)
+    for axis in (-3, -2):
+        reduced = ndimage.correlate1d(reduced, kernel, axis=axis, mode='mirror')
+        reduced = reduced[_along(axis, slice(None, None, 2), reduced.ndim)]
+    return reduced
+
+
+def _expand_axis(layer, axis, size, kernel):
+    # Polyphase form of zero-stuffing followed by the 5 tap kernel: even outputs use taps 0, 2 and 4 and odd
+    # outputs use taps 1 and 3. Padding one sample each side reproduces the mirror border of the stuffed array.
+    ndim = layer.ndim
+    n = layer.shape[axis]
+    kernel = kernel.astype(layer.dtype)
+    padded = np.concatenate([layer[_along(axis, slice(min(1, n - 1), min(1, n - 1) + 1), ndim)],
+                             layer,
+                             layer[_along(axis, slice(n - 1, n), ndim)]], axis=axis)
+    left = padded[_along(axis, slice(0, n), ndim)]
+    centre = padded[_along(axis, slice(1, n + 1), ndim)]
+    right = padded[_along(axis, slice(2, n + 2), ndim)]
+    shape = list(layer.shape)
+    shape[axis] = size
+    expanded = np.empty(shape, dtype=layer.dtype)
+    even = 2. * (kernel[0] * left + kernel[2] * centre + kernel[4] * right)
+    odd = 2. * (kernel[1] * centre + kernel[3] * right)
+    expanded[_along(axis, slice(0, None, 2), ndim)] = even[_along(axis, slice(0, (size + 1) // 2), ndim)]
+    expanded[_along(axis, slice(1, None, 2), ndim)] = odd[_along(axis, slice(0, size // 2), ndim)]
+    return expanded
+
+
+def expand_stack(layers, shape=None, kernel=generating_kernel_1d(0.4)):
+    """
+    Expands a (..., rows, columns, channels) array to (..., shape[0], shape[1], channels) in one pass.
+
+    Equivalent to expand_layer on every image and channel followed by cropping to shape, but the zero-stuffed
+    array is never built.
+    """
+    if shape is None:
+        shape = (2 * layers.shape[-3], 2 * layers.shape[-2])
+    expanded = _as_float(layers)
+    expanded = _expand_axis(expanded, -3, shape[0], kernel)
+    expanded = _expand_axis(expanded, -2, shape[1], kernel)
+    return expanded
+
+
+def _check_backend(backend):
+    if backend not in PYRAMID_BACKENDS:
+        raise ValueError(f"Unknown pyramid backend '{backend}', expected one of {PYRAMID_BACKENDS}")
+
+
+def gaussian_pyramid(images, levels, backend="convolve"):
+    _check_backend(backend)
+    if backend == "separable":
+        pyramid = [images.astype(np.float64)]
+        for level in range(levels):
+            pyramid.append(reduce_stack(pyramid[-1]))
+        return pyramid
+
     pyramid = [images.astype(np.float64)]
     num_images = images.shape[0]
 
@@ -72,9 +210,25 @@ def gaussian_pyramid(images, levels):
     return pyramid
 
 
-def laplacian_pyramid(images, levels):
-    gaussian = gaussian_pyramid(images, levels)
-
+def laplacian_pyramid(images, levels, backend="convolve", precision="float64"):
+    """
+    Laplacian pyramid of a stack of images, with every level stored as storage_dtype(precision).
+
+    The separable backend builds it one level at a time, so only two gaussian levels are held at once.
+    """
+    _check_backend(backend)
+    check_fixed_point(images, precision)
+    if backend == "separable":
+        gauss = images.astype(compute_dtype(precision))
+        pyramid = []
+        for level in range(levels):
+            reduced = reduce_stack(gauss)
+            pyramid.append(encode_level(gauss - expand_stack(reduced, gauss.shape[-3:-1]), precision))
+            gauss = reduced
+        pyramid.append(encode_level(gauss, precision))
+        return pyramid
+
+    gaussian = gaussian_pyramid(images, levels, backend)
     pyramid = [gaussian[-1]]
     for level in range(len(gaussian) - 1, 0, -1):
         gauss = gaussian[level - 1]
@@ -86,11 +240,17 @@ def laplacian_pyramid(images, levels):
                 expanded = expanded[:gauss_layer.shape[0], :gauss_layer.shape[1]]
             pyramid[-1][layer] = gauss_layer - expanded
 
-    return pyramid[::-1]
+    return [encode_level(level, precision) for level in pyramid[::-1]]
 
 
-def collapse(pyramid):
+def collapse(pyramid, backend="convolve"):
+    _check_backend(backend)
     image = pyramid[-1]
+    if backend == "separable":
+        for layer in pyramid[-2::-1]:
+            image = expand_stack(image, layer.shape[-3:-1]) + layer
+        return image
+
     for layer in pyramid[-2::-1]:
         expanded = expand_layer(image)
         if expanded.shape != layer.shape:
@@ -106,98 +266,569 @@ def get_probabilities(gray_image):
     return probabilities
 
 
-def entropy(image, kernel_size):
-    def _area_entropy(area, probabilities):
-        levels = area.flatten()
-        return -1. * (levels * np.log(probabilities[levels])).sum()
-    probabilities = get_probabilities(image)
-    pad_amount = int((kernel_size - 1) / 2)
-    padded_image = cv2.copyMakeBorder(image, pad_amount, pad_amount, pad_amount, pad_amount, cv2.BORDER_REFLECT101)
-    entropies = np.zeros(image.shape[:2], dtype=np.float64)
-    offset = np.arange(-pad_amount, pad_amount + 1)
-    for row in range(entropies.shape[0]):
-        for column in range(entropies.shape[1]):
-            area = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset]
-            entropies[row, column] = _area_entropy(area, probabilities)
-    return entropies
+def box_sum(image, kernel_size):
+    """
+    Sliding window sum over a kernel_size x kernel_size window, with the image reflected (101) at the borders
+    """
+    return cv2.boxFilter(image.astype(np.float64), cv2.CV_64F, (kernel_size, kernel_size),
+                         normalize=False, borderType=cv2.BORDER_REFLECT101)
+
+
+def box_mean(image, kernel_size):
+    return box_sum(image, kernel_size) / (kernel_size * kernel_size)
+
+
+def entropy_lut(probabilities):
+    """
+    Per grey level contribution to the window entropy: -level * log(p(level))
+
+    Levels that do not appear in the image have a probability of zero and never get looked up.
+    """
+    levels = np.arange(256, dtype=np.float64)
+    lut = np.zeros((256,), dtype=np.float64)
+    present = probabilities > 0
+    lut[present] = -levels[present] * np.log(probabilities[present])
+    return lut
+
+
+def entropy(image, kernel_size, probabilities=None):
+    if probabilities is None:
+        probabilities = get_probabilities(image)
+    return box_sum(entropy_lut(probabilities)[image], kernel_size)
 
 
 def deviation(image, kernel_size):
-    def _area_deviation(area):
-        average = np.average(area).astype(np.float64)
-        return np.square(area - average).sum() / area.size
-    pad_amount = int((kernel_size - 1) / 2)
-    padded_image = cv2.copyMakeBorder(image, pad_amount, pad_amount, pad_amount, pad_amount, cv2.BORDER_REFLECT101)
-    deviations = np.zeros(image.shape[:2], dtype=np.float64)
-    offset = np.arange(-pad_amount, pad_amount + 1)
-    for row in range(deviations.shape[0]):
-        for column in range(deviations.shape[1]):
-            area = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset]
-            deviations[row, column] = _area_deviation(area)
-    return deviations
-
-
-def get_fused_base(images, kernel_size):
+    # Variance in the window from the sliding sums: E[x^2] - E[x]^2
+    image = image.astype(np.float64)
+    mean = box_mean(image, kernel_size)
+    variance = box_mean(np.square(image), kernel_size) - np.square(mean)
+    return np.maximum(variance, 0)
+
+
+def get_fused_base(images, kernel_size, probabilities=None):
+    """
+    :param probabilities: optional grey level probabilities of each image used for the entropy, (images, 256).
+        By default they are computed from the images themselves.
+    """
     layers = images.shape[0]
     entropies = np.zeros(images.shape[:3], dtype=np.float64)
     deviations = np.copy(entropies)
     for layer in range(layers):
         gray_image = cv2.cvtColor(images[layer].astype(np.float32), cv2.COLOR_BGR2GRAY).astype(np.uint8)
-        probabilities = get_probabilities(gray_image)
-        entropies[layer] = entropy(gray_image, kernel_size)
+        entropies[layer] = entropy(gray_image, kernel_size, None if probabilities is None else probabilities[layer])
         deviations[layer] = deviation(gray_image, kernel_size)
     best_e = np.argmax(entropies, axis=0)
     best_d = np.argmax(deviations, axis=0)
-    fused = np.zeros(images.shape[1:], dtype=np.float64)
-    # print("get_fused_base")
-    # plt.matshow(best_e), plt.show()
-    # plt.matshow(best_d), plt.show()
-    for layer in range(layers):
-        fused += np.where(best_e[:, :, np.newaxis] == layer, images[layer], 0)
-        fused += np.where(best_d[:, :, np.newaxis] == layer, images[layer], 0)
+    fused = np.take_along_axis(images, best_e[np.newaxis, :, :, np.newaxis], axis=0)[0].astype(np.float64)
+    fused += np.take_along_axis(images, best_d[np.newaxis, :, :, np.newaxis], axis=0)[0]
     return (fused / 2).astype(images.dtype)
 
 
-def fuse_pyramids(pyramids, kernel_size):
-    fused = [get_fused_base(pyramids[-1], kernel_size)]
-    energies = []
+def depth_map(best_index, shape):
+    best_index = ndimage.median_filter(best_index, [15, 15]).astype(np.uint8)
+    return sku.img_as_ubyte(skt.resize(best_index, shape))
+
+
+def fuse_pyramids(pyramids, kernel_size, precision="float64", probabilities=None, index_only=False):
+    """
+    :param index_only: return the index of the image picked at each pixel of the second level (of the first when
+        there is a single level above the base) instead of the depth map made from it
+    """
+    if len(pyramids) < 2:
+        raise ValueError("The pyramids need at least one level above the base for the depth map")
+    fused = [get_fused_base(decode_level(pyramids[-1], precision), kernel_size, probabilities)]
+    # Only the energies of the second level are needed for the depth map, so the others are dropped straight away
+    best_index = None
     for layer in range(len(pyramids) - 2, -1, -1):
-        f, en = get_fused_laplacian(pyramids[layer])
+        f, en = get_fused_laplacian(pyramids[layer], precision)
         fused.append(f)
-        energies.append(en)
-    en_best = np.argmax(energies[-2], axis=0)
-    en_best = ndimage.median_filter(en_best, [15,15]).astype(np.uint8)
-    m = sku.img_as_ubyte(skt.resize(en_best, energies[-1].shape[1:3]))
-    return fused[::-1], m
+        if layer == 1 or best_index is None:
+            best_index = np.argmax(en, axis=0)
+    if index_only:
+        return fused[::-1], best_index
+    return fused[::-1], depth_map(best_index, pyramids[0].shape[1:3])
 
 
-def get_fused_laplacian(laplacians):
+def get_fused_laplacian(laplacians, precision="float64"):
     layers = laplacians.shape[0]
-    region_energies = np.zeros(laplacians.shape[:3], dtype=np.float64)
+    region_energies = np.zeros(laplacians.shape[:3], dtype=compute_dtype(precision))
     for layer in range(layers):
-        gray_lap = cv2.cvtColor(laplacians[layer].astype(np.float32), cv2.COLOR_BGR2GRAY)
+        gray_lap = cv2.cvtColor(decode_level(laplacians[layer], precision).astype(np.float32), cv2.COLOR_BGR2GRAY)
         region_energies[layer] = region_energy(gray_lap)
     best_re = np.argmax(region_energies, axis=0)
     # print("get_fused_laplacian")
     # plt.matshow(best_re), plt.colorbar(), plt.show()
     # plt.matshow(np.log(np.max(region_energies, axis=0))), plt.colorbar(), plt.show()
-    fused = np.zeros(laplacians.shape[1:], dtype=laplacians.dtype)
-    for layer in range(layers):
-        fused += np.where(best_re[:, :, np.newaxis] == layer, laplacians[layer], 0)
-    return fused, region_energies
+    fused = np.take_along_axis(laplacians, best_re[np.newaxis, :, :, np.newaxis], axis=0)[0]
+    return decode_level(fused, precision), region_energies
 
 
 def region_energy(laplacian):
     return convolve(np.square(laplacian))
 
 
-def get_pyramid_fusion(images, min_size=32):
-    smallest_side = min(images[0].shape[:2])
-    depth = int(np.log2(smallest_side / min_size))
+class PyramidFuser(object):
+    """
+    Fuses a stack one image at a time, keeping only the fused pyramid and the best focus measures so far.
+
+    The result is the same as the batch fusion (ties go to the first image, as with argmax), but the memory used
+    does not depend on the number of images.
+    """
+    def __init__(self, depth, kernel_size=5, backend="separable", precision="float64"):
+        _check_backend(backend)
+        if depth < 1:
+            raise ValueError(f"The fusion needs at least one pyramid level for the depth map, not {depth}")
+        self.depth = depth
+        self.kernel_size = kernel_size
+        self.backend = backend
+        self.precision = precision
+        self.energy_dtype = compute_dtype(precision)
+        self.count = 0
+
+        # Laplacian levels (stored as storage_dtype) and the region energy they were picked with
+        self.fused = None
+        self.energies = None
+        # Image index picked on the second level, used for the depth map
+        self.best_index = None
+        # Base level picked by entropy and by deviation
+        self.entropy = None
+        self.entropy_colour = None
+        self.deviation = None
+        self.deviation_colour = None
+
+    def add(self, image, probabilities=None):
+        """
+        :param probabilities: optional grey level probabilities of the image's base level, used for the entropy
+        """
+        pyramid = [level[0] for level in laplacian_pyramid(image[np.newaxis], self.depth, self.backend, self.precision)]
+        index_level = 1 if self.depth > 1 else 0
+
+        energies = []
+        for level in pyramid[:-1]:
+            gray_lap = cv2.cvtColor(decode_level(level, self.precision).astype(np.float32), cv2.COLOR_BGR2GRAY)
+            energies.append(region_energy(gray_lap).astype(self.energy_dtype))
+
+        base = decode_level(pyramid[-1], self.precision)
+        gray_base = cv2.cvtColor(base.astype(np.float32), cv2.COLOR_BGR2GRAY).astype(np.uint8)
+        base_entropy = entropy(gray_base, self.kernel_size, probabilities)
+        base_deviation = deviation(gray_base, self.kernel_size)
+
+        if self.count == 0:
+            self.fused = pyramid[:-1]
+            self.energies = energies
+            self.best_index = np.zeros(energies[index_level].shape, dtype=np.int64)
+            self.entropy, self.entropy_colour = base_entropy, base.copy()
+            self.deviation, self.deviation_colour = base_deviation, base.copy()
+        else:
+            for level, energy in enumerate(energies):
+                better = energy > self.energies[level]
+                self.fused[level][better] = pyramid[level][better]
+                self.energies[level][better] = energy[better]
+                if level == index_level:
+                    self.best_index[better] = self.count
+            better = base_entropy > self.entropy
+            self.entropy[better] = base_entropy[better]
+            self.entropy_colour[better] = base[better]
+            better = base_deviation > self.deviation
+            self.deviation[better] = base_deviation[better]
+            self.deviation_colour[better] = base[better]
+        self.count += 1
+
+    def result(self, index_only=False):
+        """
+        :param index_only: see fuse_pyramids
+        :return: fused image, depth map
+        """
+        if self.count == 0:
+            raise ValueError("No images have been added to the fusion")
+        base = (self.entropy_colour.astype(np.float64) + self.deviation_colour) / 2
+        fusion = [decode_level(level, self.precision) for level in self.fused]
+        fusion.append(base.astype(self.entropy_colour.dtype))
+        if index_only:
+            return collapse(fusion, self.backend), self.best_index.copy()
+        return collapse(fusion, self.backend), depth_map(self.best_index, self.fused[0].shape[:2])
+
+
+class StreamingFuser(threading.Thread):
+    """
+    Fuses a stack in a background thread while it is being captured
+
+    Slices are handed over with add() as soon as they are grabbed, and folded into a PyramidFuser, so the fused
+    image is ready shortly after the last slice arrives. The queue of pending slices is bounded, so add() blocks
+    if fusion falls behind capture.
+
+    :param save_path: if given, the fused image is saved there once the stack is closed
+    """
+    def __init__(self, save_path=None, min_size=32, backend="separable", precision="float64", max_pending=4):
+        super(StreamingFuser, self).__init__(daemon=True)
+        self.save_path = save_path
+        self.min_size = min_size
+        self.backend = backend
+        self.precision = precision
+        self.slices = queue.Queue(maxsize=max_pending)
+        self.fuser = None
+        self.fused = None
+        self.depth = None
+        self.cancelled = False
+        # Exception raised while fusing, raised again by result()
+        self.error = None
+        self.start()
+
+    def add(self, image):
+        self.slices.put(image)
+
+    def close(self):
+        """
+        Marks the end of the stack. The fused image is then available once the thread has finished (join).
+        """
+        self.slices.put(None)
+
+    def cancel(self):
+        self.cancelled = True
+        self.slices.put(None)
+
+    def result(self):
+        """
+        :return: fused image, depth map. Raises the error that stopped the fusion, if any.
+        """
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.fused, self.depth
+
+    def run(self):
+        # After an error, the remaining slices are still taken off the queue so that add() never blocks
+        while True:
+            image = self.slices.get()
+            if image is None:
+                break
+            if self.cancelled or self.error is not None:
+                continue
+            try:
+                if self.fuser is None:
+                    depth = pyramid_depth(image.shape, self.min_size)
+                    self.fuser = PyramidFuser(depth, backend=self.backend, precision=self.precision)
+                self.fuser.add(image)
+            except Exception as e:
+                self.error = e
+        if self.cancelled or self.error is not None or self.fuser is None:
+            return
+        try:
+            self.fused, self.depth = self.fuser.result()
+            if self.save_path is not None:
+                os.makedirs(os.path.dirname(self.save_path), exist_ok=True)
+                # Slices come from the camera in BGR
+                skio.imsave(str(self.save_path), to_uint8(self.fused[..., ::-1]), check_contrast=False)
+        except Exception as e:
+            self.error = e
+
+
+def _pyramid_pixels(rows, columns, depth):
+    total = 0
+    for level in range(depth + 1):
+        total += rows * columns
+        rows, columns = (rows + 1) // 2, (columns + 1) // 2
+    return total
+
+
+def estimate_fusion_bytes(shape, depth, precision="float64", strategy="batch"):
+    """
+    Approximate peak memory used by the fusion, not counting the input images themselves
+
+    :param shape: shape of the stack (images, rows, columns, channels)
+    """
+    count, rows, columns, channels = shape
+    compute = np.dtype(compute_dtype(precision)).itemsize
+    storage = np.dtype(storage_dtype(precision)).itemsize
+    pixels = rows * columns
+    pyramid = _pyramid_pixels(rows, columns, depth)
+    if strategy == "batch":
+        # Working gaussian levels and stored laplacians of every image, then the energies of one level
+        return count * (3 * pixels * channels * compute + pyramid * channels * storage + pixels * compute)
+    if strategy == "sequential":
+        # Working pyramid of one image plus the running fused pyramid and its energies
+        return 3 * pixels * channels * compute + pyramid * (channels * (compute + storage) + 2 * compute)
+    raise ValueError(f"Unknown fusion strategy '{strategy}', expected one of {FUSION_STRATEGIES}")
+
+
+def choose_fusion_strategy(shape, depth, precision="float64", memory_budget=None, dtype=np.uint8):
+    """
+    Picks the first of batch, sequential, then sequential at lower precisions, that fits in the memory budget
+
+    :param dtype: type of the images, which are only fused in uint16 if they fit the fixed point range
+    :return: strategy, precision, projected bytes
+    """
+    candidates = [("batch", precision), ("sequential", precision)]
+    candidates += [("sequential", p) for p in PRECISIONS[PRECISIONS.index(precision) + 1:]
+                   if p != "uint16" or fits_fixed_point(dtype)]
+    for strategy, candidate_precision in candidates:
+        projected = estimate_fusion_bytes(shape, depth, candidate_precision, strategy)
+        if memory_budget is None or projected <= memory_budget:
+            break
+    else:
+        print(f"Fusion needs about {projected / 1e9:.2f} GB which is over the budget of {memory_budget / 1e9:.2f} GB")
+    if (strategy, candidate_precision) != candidates[0]:
+        print(f"Fusion switched to {strategy} strategy in {candidate_precision} to fit the memory budget")
+    return strategy, candidate_precision, projected
+
+
+def pyramid_depth(shape, min_size=32):
+    """
+    :return: number of pyramid levels, so that the smallest side of the top level is about min_size
+    """
+    if min(shape[:2]) < 2 * min_size:
+        raise ValueError(f"Images of {shape[0]}x{shape[1]} are too small for a pyramid level above min_size "
+                         f"{min_size}, their smallest side must be at least {2 * min_size}")
+    return int(np.log2(min(shape[:2]) / min_size))
+
+
+def fusion_halo(depth):
+    """
+    Distance in pixels over which a pixel of the fused image depends on its neighbours
+
+    Each of the depth levels of reduction, the region energy, the base entropy window and the collapse add a
+    few samples of support at their own scale, which adds up to about 6 * 2 ** depth. The halo is rounded up to
+    keep a margin, and is a multiple of 2 ** depth so that tiles stay aligned with the decimation grid.
+    """
+    return 8 * 2 ** depth
+
+
+def base_probabilities(images, depth, precision="float64"):
+    """
+    Grey level probabilities of the base level of every image, as used by the entropy in get_fused_base
+    """
+    check_fixed_point(images, precision)
+    probabilities = np.zeros((images.shape[0], 256), dtype=np.float64)
+    for i, image in enumerate(images):
+        base = image.astype(compute_dtype(precision))
+        for level in range(depth):
+            base = reduce_stack(base)
+        base = decode_level(encode_level(base, precision), precision)
+        probabilities[i] = get_probabilities(cv2.cvtColor(base.astype(np.float32), cv2.COLOR_BGR2GRAY))
+    return probabilities
+
+
+def fuse_stack(images, depth, backend="separable", precision="float64", memory_budget=None, stats=None,
+               probabilities=None, index_only=False):
+    """
+    Fuses a stack with a pyramid of the given depth. See get_pyramid_fusion.
+
+    :param index_only: see fuse_pyramids
+    """
     kernel_size = 5
-    pyramids = laplacian_pyramid(images, depth)
-    fusion, depth = fuse_pyramids(pyramids, kernel_size)
-    return collapse(fusion), depth
+    strategy, precision, projected = choose_fusion_strategy(images.shape, depth, precision, memory_budget,
+                                                            images.dtype)
+
+    started_tracing = False
+    if stats is not None:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+
+    try:
+        if strategy == "batch":
+            pyramids = laplacian_pyramid(images, depth, backend, precision)
+            fusion, depth = fuse_pyramids(pyramids, kernel_size, precision, probabilities, index_only)
+            del pyramids
+            fused = collapse(fusion, backend)
+        else:
+            fuser = PyramidFuser(depth, kernel_size, backend, precision)
+            for i, image in enumerate(images):
+                fuser.add(image, None if probabilities is None else probabilities[i])
+            fused, depth = fuser.result(index_only)
+
+        if stats is not None:
+            stats['strategy'] = strategy
+            stats['precision'] = precision
+            stats['projected_bytes'] = projected
+            stats['peak_bytes'] = tracemalloc.get_traced_memory()[1] - traced_before
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    return fused, depth
+
+
+def _blend_weights(start, end, core_start, core_end, blend, size):
+    # Linear ramps across the seams, so that the weights of neighbouring tiles add up to one.
+    # There is no ramp on the sides that touch the image border.
+    positions = np.arange(start, end) + 0.5
+    weights = np.ones(end - start)
+    if core_start > 0:
+        weights = np.minimum(weights, np.clip((positions - core_start + blend) / (2 * blend), 0, 1))
+    if core_end < size:
+        weights = np.minimum(weights, np.clip((core_end + blend - positions) / (2 * blend), 0, 1))
+    return weights
+
+
+def _fuse_tile(task):
+    (y0, y1, x0, x1), images, depth, backend, precision, memory_budget, probabilities = task
+    stats = {}
+    fused, best_index = fuse_stack(images, depth, backend, precision, memory_budget, stats, probabilities, True)
+    return (y0, y1, x0, x1), fused, best_index, stats
+
+
+def tiled_pyramid_fusion(images, depth, tile_size, workers=None, backend="separable", precision="float64",
+                         memory_budget=None, stats=None):
+    """
+    Fuses a stack in overlapping tiles, each fused independently in a pool of worker processes
+
+    Each tile is extended by fusion_halo(depth) on every side, and fused with the same pyramid depth and the same
+    base level grey level probabilities as the whole frame. The result therefore matches the untiled fusion,
+    apart from the seams, which are blended over a band of 2 ** (depth + 1) pixels. The tiles return the index of
+    the image picked on the second level, and the depth map is made once from the assembled indices, so that it
+    matches the untiled one.
+
+    :param tile_size: size of the tile cores, rounded up to a multiple of 2 ** depth
+    :param workers: number of worker processes, defaults to the number of CPUs. With one worker the tiles are
+        fused in this process.
+    :param memory_budget: memory budget of each tile
+    """
+    count, rows, columns = images.shape[:3]
+    grid = 2 ** depth
+    tile_size = int(np.ceil(tile_size / grid)) * grid
+    halo = fusion_halo(depth)
+    blend = grid
+    probabilities = base_probabilities(images, depth, precision)
+
+    tasks = []
+    for core_y in range(0, rows, tile_size):
+        for core_x in range(0, columns, tile_size):
+            y0, y1 = max(core_y - halo, 0), min(core_y + tile_size + halo, rows)
+            x0, x1 = max(core_x - halo, 0), min(core_x + tile_size + halo, columns)
+            tasks.append(((y0, y1, x0, x1), images[:, y0:y1, x0:x1], depth, backend, precision, memory_budget,
+                          probabilities))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tasks))
+    pool = multiprocessing.Pool(processes=workers) if workers > 1 else None
+
+    fused = None
+    weights = np.zeros((rows, columns), dtype=np.float64)
+    # The indices are picked on the second level, whose pixels are scale pixels of the image apart
+    scale = 2 if depth > 1 else 1
+    best_index = np.zeros((-(-rows // scale), -(-columns // scale)), dtype=np.int64)
+    peak_bytes = 0
+    try:
+        results = map(_fuse_tile, tasks) if pool is None else pool.imap_unordered(_fuse_tile, tasks)
+        for (y0, y1, x0, x1), tile, tile_index, tile_stats in results:
+            if fused is None:
+                fused = np.zeros((rows, columns, tile.shape[2]), dtype=tile.dtype)
+            # The core of the tile is what is left once the halo has been removed from the sides inside the image
+            core_y0, core_y1 = (y0 + halo if y0 > 0 else 0), (y1 - halo if y1 < rows else rows)
+            core_x0, core_x1 = (x0 + halo if x0 > 0 else 0), (x1 - halo if x1 < columns else columns)
+            by0, by1 = max(core_y0 - blend, 0), min(core_y1 + blend, rows)
+            bx0, bx1 = max(core_x0 - blend, 0), min(core_x1 + blend, columns)
+            weight = np.outer(_blend_weights(by0, by1, core_y0, core_y1, blend, rows),
+                              _blend_weights(bx0, bx1, core_x0, core_x1, blend, columns))
+            fused[by0:by1, bx0:bx1] += weight[:, :, np.newaxis] * tile[by0 - y0:by1 - y0, bx0 - x0:bx1 - x0]
+            weights[by0:by1, bx0:bx1] += weight
+            # The tiles start on the decimation grid, so their indices line up with those of the whole frame
+            iy0, iy1 = core_y0 // scale, -(-core_y1 // scale)
+            ix0, ix1 = core_x0 // scale, -(-core_x1 // scale)
+            best_index[iy0:iy1, ix0:ix1] = tile_index[iy0 - y0 // scale:iy1 - y0 // scale,
+                                                      ix0 - x0 // scale:ix1 - x0 // scale]
+            peak_bytes = max(peak_bytes, tile_stats['peak_bytes'])
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if stats is not None:
+        stats['strategy'] = "tiled"
+        stats['tiles'] = len(tasks)
+        stats['tile_size'] = tile_size
+        stats['halo'] = halo
+        stats['peak_bytes'] = peak_bytes
+    return fused / weights[:, :, np.newaxis], depth_map(best_index, (rows, columns))
+
+
+def get_pyramid_fusion(images, min_size=32, backend="separable", precision="float64", memory_budget=None,
+                       stats=None, tile_size=None, workers=None):
+    """
+    Fuses a stack of (rows, columns, 3) images using laplacian pyramids
+
+    :param images: array of shape (images, rows, columns, 3)
+    :param min_size: approximate size of the smallest side of the top pyramid level
+    :param backend: pyramid implementation, one of PYRAMID_BACKENDS. Both give the same result.
+    :param precision: storage of the pyramid levels, one of PRECISIONS
+    :param memory_budget: bytes available to the fusion (to each tile when tiled). If the projected footprint is
+        over budget, a lower footprint strategy is used (see choose_fusion_strategy)
+    :param stats: optional dict, filled with the strategy and precision used, and the projected and peak bytes
+        allocated (measured with tracemalloc)
+    :param tile_size: if given, the stack is fused in tiles of about this size (see tiled_pyramid_fusion)
+    :param workers: number of processes fusing the tiles
+    :return: fused image, depth map
+    """
+    depth = pyramid_depth(images[0].shape, min_size)
+    if tile_size is not None:
+        return tiled_pyramid_fusion(images, depth, tile_size, workers, backend, precision, memory_budget, stats)
+    return fuse_stack(images, depth, backend, precision, memory_budget, stats)
+
+
+GRAY_CONVERSIONS = {'RGB': cv2.COLOR_RGB2GRAY, 'BGR': cv2.COLOR_BGR2GRAY}
+
+
+def focus_measure(image, kernel_size=9, channels="RGB"):
+    """
+    Local sharpness of an image: squared laplacian of the grey levels averaged over a kernel_size window (the same
+    idea as region_energy, at full resolution)
+
+    :param channels: order of the colour channels, 'RGB' (as loaded by skimage) or 'BGR' (as loaded by OpenCV and
+        given by the camera), which sets the weights of the grey levels
+    """
+    if channels not in GRAY_CONVERSIONS:
+        raise ValueError(f"Unknown channel order '{channels}', expected one of {list(GRAY_CONVERSIONS)}")
+    image = np.asarray(image, dtype=np.float32)
+    gray = cv2.cvtColor(image, GRAY_CONVERSIONS[channels]) if image.ndim == 3 else image
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F, ksize=3, borderType=cv2.BORDER_REFLECT101)
+    return cv2.boxFilter(np.square(laplacian), cv2.CV_32F, (kernel_size, kernel_size),
+                         borderType=cv2.BORDER_REFLECT101)
+
+
+def regularise_index(best_index, size=5):
+    """
+    Median filter of the index map, which removes the isolated picks in flat areas
+    """
+    if size <= 1:
+        return best_index
+    if best_index.max() < 256:
+        return cv2.medianBlur(best_index.astype(np.uint8), size).astype(best_index.dtype)
+    return ndimage.median_filter(best_index, size)
+
+
+def get_depth_map_fusion(images, z_step=1.0, kernel_size=9, smoothing=5, channels="RGB"):
+    """
+    Fuses a stack by taking each pixel from the image where it is sharpest (see focus_measure). Much faster than the
+    pyramid fusion, at the cost of harder transitions between the slices.
+
+    The images are measured one at a time, keeping only the two best measures of each pixel.
+
+    :param images: array of shape (images, rows, columns, 3)
+    :param z_step: distance between consecutive images in µm
+    :param smoothing: size of the median filter regularising the index of the sharpest image (1 to disable)
+    :param channels: order of the colour channels of the images, see focus_measure. The stackers receive RGB images.
+    :return: fused image, depth map in µm (float32), confidence in [0, 1] (float32). The confidence is 1 where only
+        one image is sharp and 0 where the two sharpest images are equally sharp (e.g. in flat areas).
+    """
+    images = np.asarray(images)
+    best = np.zeros(images.shape[1:3], dtype=np.float32)
+    second = np.zeros(images.shape[1:3], dtype=np.float32)
+    best_index = np.zeros(images.shape[1:3], dtype=np.int32)
+    for i, image in enumerate(images):
+        measure = focus_measure(image, kernel_size, channels)
+        better = measure > best
+        np.copyto(second, np.where(better, best, np.maximum(second, measure)))
+        np.copyto(best, measure, where=better)
+        best_index[better] = i
+    best_index = regularise_index(best_index, smoothing)
+    fused = np.take_along_axis(images, best_index[np.newaxis, :, :, np.newaxis], axis=0)[0]
+    depth = best_index.astype(np.float32) * np.float32(z_step)
+    confidence = np.zeros_like(best)
+    np.divide(best - second, best, out=confidence, where=best > 0)
+    return fused, depth, confidence
 
 
 def phase_correction(images):
@@ -244,58 +875,58 @@ def phase_correction(images):
            :]
 
 
-def stack_process(process_name, tasks):
-    print(f"{process_name}: stacking process starts")
-
-    while True:
-        d = tasks.get()
-        print(d)
-        if d is None:
-            print(f"{process_name}: stacking process ends")
-            break
-        else:
-            print(f"{process_name}: processing {d}")
-            fns = sorted(glob(os.path.join(d, "*.jpg")))
-            if len(fns) == 0:
-                continue
-            print(f"{process_name}: loading images {d}")
-            images = []
-            for fn in fns:
-                im = skio.imread(fn, False)
-                images.append(im)
-            images = np.asarray(images)
-            print(f"{process_name}: phase correction {d}")
-            fixed_images = phase_correction(images)
-            print(f"{process_name}: fusing {d}")
-            fused_image, depth = get_pyramid_fusion(np.asarray(fixed_images))
-            fused_image = (fused_image / fused_image.max() * 255).astype(np.uint8)
-
-            save_dir = os.path.join(d, "fused_laplacian_pyramids")
-            os.makedirs(save_dir, exist_ok=True)
-            skio.imsave(os.path.join(save_dir, os.path.basename(d) + "_image.png"), fused_image, check_contrast=False)
-            skio.imsave(os.path.join(save_dir, os.path.basename(d) + "_depth.png"), depth, check_contrast=False)
-            skio.imsave(os.path.join(save_dir, os.path.basename(d) + "_depthx10.png"), depth * 10, check_contrast=False)
-    return
-
-
-def stack(dir):
-    manager = multiprocessing.Manager()
-    tasks = manager.Queue()
-
-    num_processes = multiprocessing.cpu_count() // 2
-    pool = multiprocessing.Pool(processes=num_processes)
-    processes = []
-
-    for i in range(num_processes):
-        process_name = 'P%i' % i
-        new_process = multiprocessing.Process(target=stack_process, args=(process_name, tasks))
-        processes.append(new_process)
-        new_process.start()
-
-    dirs = sorted([d for d in glob(os.path.join(dir, "*")) if os.path.isdir(d)])
-    for d in dirs:
-        tasks.put(d)
-
-    for job in processes:
-        job.join()
-
+def to_uint8(fused):
+    return np.clip(fused, 0, 255).astype(np.uint8)
+
+
+def stack_images(images, save_path, depth_path=None, precision="float64", memory_budget=None):
+    """
+    Registers and fuses a stack, then saves the fused image (and optionally the depth map)
+
+    Used as the stacker of a StackingService.
+
+    :param depth_path: if given, the depth map is saved there, along with a x10 copy for viewing
+    :param precision: storage of the pyramid levels, see get_pyramid_fusion
+    :param memory_budget: bytes available to the fusion, see get_pyramid_fusion
+    :return: timings of each step in seconds
+    """
+    timings = {}
+    start = time.time()
+    fixed_images, shifts = registration.register(images)
+    timings['registration'] = time.time() - start
+
+    start = time.time()
+    fused_image, depth = get_pyramid_fusion(fixed_images, precision=precision, memory_budget=memory_budget)
+    timings['fusion'] = time.time() - start
+
+    start = time.time()
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    skio.imsave(str(save_path), to_uint8(fused_image), check_contrast=False)
+    if depth_path is not None:
+        root, ext = os.path.splitext(str(depth_path))
+        skio.imsave(str(depth_path), depth, check_contrast=False)
+        skio.imsave(root + "x10" + ext, depth * 10, check_contrast=False)
+    timings['save'] = time.time() - start
+    return timings
+
+
+def stack(dir, workers=None):
+    """
+    Fuses each folder of images and each stack file (see stack_file.py) in dir
+    """
+    dirs = sorted([d for d in glob(os.path.join(dir, "*")) if os.path.isdir(d) or stack_file.is_stack_file(d)])
+    with stacking_service.StackingService(stack_images, workers) as service:
+        results = []
+        for d in dirs:
+            if stack_file.is_stack_file(d):
+                save_dir = os.path.join(dir, "fused_laplacian_pyramids")
+                name = os.path.splitext(os.path.basename(d))[0]
+            else:
+                save_dir = os.path.join(d, "fused_laplacian_pyramids")
+                name = os.path.basename(d)
+            results += service.submit_folder(d,
+                                             save_path=os.path.join(save_dir, name + "_image.png"),
+                                             depth_path=os.path.join(save_dir, name + "_depth.png"))
+        results += service.close()
+    for result in results:
+        print(stacking_service.format_result(result))
@@ -0,0 +1,103 @@
+"""
+Background writing of the pictures taken while scanning
+
+The pictures are encoded and written by a few threads (OpenCV releases the GIL while encoding), so that the stage
+can move to the next slice meanwhile. The queue is bounded: write() blocks when it is full, which bounds the memory
+used if the disk can not keep up.
+"""
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+
+class ImageWriter(object):
+    """
+    :param workers: number of writing threads
+    :param max_pending: maximum number of pictures waiting to be written
+    :param quality: JPEG quality
+    """
+    def __init__(self, workers=2, max_pending=16, quality=90):
+        self.quality = quality
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name=f"ImageWriter{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def write(self, path, image):
+        """
+        Queues a BGR image to be written at path (the format is given by the extension). The image must not be
+        modified afterwards.
+        """
+        start = time.time()
+        self.queue.put((str(path), image))
+        with self.lock:
+            self.wait_time += time.time() - start
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def flush(self):
+        """
+        Waits until all the queued pictures are written
+        """
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        """
+        :return: dict of the counters: pictures written, errors, current and maximum queue depth, time spent
+            encoding and writing, and time write() spent waiting for room in the queue (in seconds)
+        """
+        with self.lock:
+            return {'written': self.written, 'errors': self.errors, 'depth': self.depth, 'max_depth': self.max_depth,
+                    'encode_time': self.encode_time, 'wait_time': self.wait_time}
+
+    def reset_stats(self):
+        with self.lock:
+            self.written = 0
+            self.errors = 0
+            self.max_depth = 0
+            self.encode_time = 0.
+            self.wait_time = 0.
+
+    def run(self):
+        parameters = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            path, image = item
+            start = time.time()
+            try:
+                # Encoded in memory rather than with imwrite, which does not handle non-ASCII paths on Windows
+                encoded, data = cv2.imencode(os.path.splitext(path)[1], image, parameters)
+                if not encoded:
+                    raise IOError("the image could not be encoded")
+                with open(path, "wb") as file:
+                    file.write(data)
+                written = 1
+            except Exception as e:
+                print(f"!!! ERROR: {path} not written ({type(e).__name__}: {e})")
+                written = 0
+            with self.lock:
+                self.encode_time += time.time() - start
+                self.written += written
+                self.errors += 1 - written
+            self.queue.task_done()
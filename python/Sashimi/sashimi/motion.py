@@ -0,0 +1,148 @@
+"""
+Model of the time taken by the moves of the stage
+
+Each axis moves with a trapezoidal speed profile given by the feed rate of the move and the acceleration of the
+axis, the moves being done one after the other, and waiting for the end of the moves (M400) costs a fixed settle
+time. The accelerations and the settle time are fitted to the durations observed between sending the moves and
+receiving the acknowledgement of the M400 that follows them, and saved in the configuration.
+"""
+import collections
+import threading
+
+import numpy as np
+from scipy import optimize
+
+AXES = "XYZ"
+
+
+def move_duration(distance, feed, acceleration):
+    """
+    Duration of a move with a trapezoidal (or triangular) speed profile
+
+    :param distance: in mm
+    :param feed: in mm/min
+    :param acceleration: in mm/s²
+    :return: duration in seconds
+    """
+    speed = feed / 60
+    if distance * acceleration > speed ** 2:
+        return distance / speed + speed / acceleration
+    return 2 * np.sqrt(distance / acceleration)
+
+
+def move_position(elapsed, distance, feed, acceleration):
+    """
+    Distance covered by a move with the speed profile of move_duration
+
+    :param elapsed: time since the start of the move in seconds
+    :param distance: length of the move in mm
+    :return: distance covered in mm
+    """
+    # The peak speed of a triangular profile is below the feed rate, which gives the same duration as move_duration
+    speed = min(feed / 60, np.sqrt(distance * acceleration))
+    if speed <= 0:
+        return distance
+    ramp = speed / acceleration
+    duration = distance / speed + ramp
+    if elapsed <= 0:
+        return 0.
+    if elapsed >= duration:
+        return distance
+    if elapsed < ramp:
+        return acceleration * elapsed ** 2 / 2
+    if elapsed > duration - ramp:
+        return distance - acceleration * (duration - elapsed) ** 2 / 2
+    return speed * (elapsed - ramp / 2)
+
+
+class MotionModel(object):
+    """
+    :param parameters: dict with the acceleration of each axis in mm/s² and the settle time in seconds, as saved in
+        the configuration (see default_parameters). It is updated in place by calibrate.
+    :param max_observations: number of latest observations used to calibrate the model
+    """
+    def __init__(self, parameters=None, max_observations=500):
+        self.parameters = parameters if parameters is not None else self.default_parameters()
+        self.observations = collections.deque(maxlen=max_observations)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def default_parameters():
+        return {'acceleration': {'X': 1000, 'Y': 1000, 'Z': 100}, 'settle_time': 0.05}
+
+    def move_duration(self, axis, distance, feed):
+        """
+        :param distance: in µm
+        :param feed: in mm/min
+        :return: duration of the move in seconds
+        """
+        if distance == 0:
+            return 0.
+        return move_duration(abs(distance) / 1000, feed, self.parameters['acceleration'][axis])
+
+    def move_position(self, axis, elapsed, distance, feed):
+        """
+        :param elapsed: time since the start of the move in seconds
+        :param distance: in µm
+        :param feed: in mm/min
+        :return: distance covered by the move in µm, with the sign of distance
+        """
+        covered = move_position(elapsed, abs(distance) / 1000, feed, self.parameters['acceleration'][axis])
+        return np.sign(distance) * 1000 * covered
+
+    def duration(self, moves):
+        """
+        :param moves: list of (axis, distance in µm, feed in mm/min) done one after the other
+        :return: time from sending the moves until the end of the following M400, in seconds
+        """
+        return self.parameters['settle_time'] + sum(self.move_duration(*move) for move in moves)
+
+    def observe(self, moves, duration):
+        """
+        :param duration: observed time from sending the moves until the end of the following M400, in seconds
+        """
+        with self.lock:
+            self.observations.append((list(moves), duration))
+
+    def error(self):
+        """
+        :return: mean absolute error of the predicted durations over the observations, in seconds
+        """
+        with self.lock:
+            observations = list(self.observations)
+        if len(observations) == 0:
+            return None
+        return float(np.mean([abs(self.duration(moves) - duration) for moves, duration in observations]))
+
+    def calibrate(self, min_observations=10):
+        """
+        Fits the accelerations of the axes that moved and the settle time to the observations, by least squares
+
+        :return: whether there were enough observations to calibrate the model
+        """
+        with self.lock:
+            observations = list(self.observations)
+        if len(observations) < min_observations:
+            return False
+        axes = [axis for axis in AXES if any(move[0] == axis and move[1] != 0
+                                              for moves, _ in observations for move in moves)]
+        acceleration = self.parameters['acceleration']
+
+        def residuals(values):
+            accelerations = dict(acceleration, **dict(zip(axes, values[:-1])))
+            predicted = []
+            for moves, _ in observations:
+                predicted.append(values[-1] + sum(move_duration(abs(distance) / 1000, feed, accelerations[axis])
+                                                  for axis, distance, feed in moves if distance != 0))
+            return np.asarray(predicted) - [duration for _, duration in observations]
+
+        start = np.log([acceleration[axis] for axis in axes])
+        # The accelerations are fitted on a log scale, within a factor of ten of their previous values: the
+        # acceleration of an axis that only makes long moves has little effect on their duration
+        fit = optimize.least_squares(lambda values: residuals(np.concatenate([np.exp(values[:-1]), values[-1:]])),
+                                     np.append(start, self.parameters['settle_time']),
+                                     bounds=(np.append(start - np.log(10), 0), np.append(start + np.log(10), np.inf)))
+        for axis, value in zip(axes, np.exp(fit.x[:-1])):
+            acceleration[axis] = round(float(value), 1)
+        self.parameters['settle_time'] = round(float(fit.x[-1]), 4)
+        return True
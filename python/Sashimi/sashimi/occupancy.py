@@ -0,0 +1,39 @@
+"""
+Empty field detection: tells whether a frame shows any particle, from a decimated copy of it
+
+The background is estimated by the median of each channel, and its spread by their median absolute deviation, so
+that the particles covering part of the field do not change them much. The pixels further than threshold spreads from
+the background in any channel are foreground, closed as in segmentation.segment, and the field is occupied if a blob
+of them is at least as large as the smallest particle.
+"""
+import cv2
+import numpy as np
+
+# Standard deviation of a normal distribution over its median absolute deviation
+MAD_SCALE = 1.4826
+
+
+def occupancy(img, threshold=4., min_area=900, scale=4):
+    """
+    :param img: frame, colour (rows, columns, channels) or grey
+    :param threshold: distance to the background above which a pixel is foreground, in standard deviations of the
+        background
+    :param min_area: area of the smallest particle, in pixels of the frame
+    :param scale: decimation of the frame
+    :return: dict telling whether the field is 'occupied', with the 'fraction' of the field in the foreground and the
+        number of 'particles'
+    """
+    small = np.asarray(img)[::scale, ::scale].astype(np.float32)
+    if small.ndim == 2:
+        small = small[..., np.newaxis]
+    pixels = small.reshape(-1, small.shape[-1])
+    background = np.median(pixels, axis=0)
+    spread = MAD_SCALE * np.median(np.abs(pixels - background), axis=0)
+    # One grey level at least, for flat backgrounds
+    distance = np.max(np.abs(small - background) / np.maximum(spread, 1), axis=-1)
+    mask = (distance > threshold).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+    # The first component is the background
+    particles = int(np.sum(stats[1:, cv2.CC_STAT_AREA] >= min_area / scale ** 2))
+    return {'occupied': particles > 0, 'fraction': float(mask.mean()), 'particles': particles}
@@ -0,0 +1,139 @@
+"""
+Order in which the stacks of the scans are taken, and estimate of the time the stage spends travelling
+
+The stacks of a scan are visited along a serpentine (boustrophedon) path, so that the stage never travels back to the
+start of a row. The scans are visited in the order, and along the direction, that shortens the travel between them
+(nearest neighbour followed by 2-opt). The stage only goes back up to the height of the scan after a stack if the next
+stack does not start at about the same height.
+
+A stop is a dict with the scan index, the offsets dx, dy of the stack from the front left corner, its position x, y,
+the height z at which the stack starts and return_z, whether to go back to the height of the scan after it.
+Distances are in µm.
+"""
+from sashimi.stage import Stage
+
+
+def serpentine(x_steps, y_steps):
+    """
+    :return: list of (xi, yi) grid indices, rows alternately walked left to right and right to left
+    """
+    path = []
+    for yi in range(y_steps):
+        columns = range(x_steps) if yi % 2 == 0 else range(x_steps - 1, -1, -1)
+        path.extend((xi, yi) for xi in columns)
+    return path
+
+
+def plan_scan(scan, index, x_step, y_step, z_of, reverse=False, z_tolerance=100):
+    """
+    :param scan: scan of the configuration, with its front left (FL) and back right (BR) corners
+    :param index: index of the scan, saved in the stops
+    :param z_of: function (scan, dx, dy) giving the height at which a stack starts
+    :param reverse: walk the path from its end
+    :param z_tolerance: the stage stays down between two stacks starting less than this apart
+    :return: list of stops
+    """
+    fl, br = scan['FL'], scan['BR']
+    x_steps = 1 + (br[0] - fl[0]) // x_step
+    y_steps = 1 + (br[1] - fl[1]) // y_step
+    path = serpentine(x_steps, y_steps)
+    if reverse:
+        path.reverse()
+    stops = []
+    for xi, yi in path:
+        dx, dy = x_step * xi, y_step * yi
+        stops.append({'scan': index, 'dx': dx, 'dy': dy, 'x': fl[0] + dx, 'y': fl[1] + dy, 'z': z_of(scan, dx, dy),
+                      'return_z': True})
+    for stop, following in zip(stops, stops[1:]):
+        stop['return_z'] = abs(following['z'] - stop['z']) > z_tolerance
+    return stops
+
+
+def move_time(distance, feed):
+    """
+    :param distance: in µm
+    :param feed: in mm/min
+    :return: duration in seconds, at constant speed
+    """
+    return abs(distance) / 1000 / (feed / 60)
+
+
+def travel_time(stops, start, z_height=None, motion=None):
+    """
+    Estimates the time spent travelling along the stops, moving the axes one after the other like Stage.goto
+
+    :param start: [x, y, z] position of the stage before the first stop
+    :param z_height: function (stop) giving the height of the scan of a stop, to which the stage goes back after
+        the stacks with return_z and before travelling. By default the stage travels at the height of the stacks.
+    :param motion: MotionModel giving the duration of the moves, by default they are done at constant speed
+    :return: duration in seconds, without taking the stacks
+    """
+    if motion is None:
+        def duration_of(axis, distance, feed):
+            return move_time(distance, feed)
+    else:
+        duration_of = motion.move_duration
+    x, y, z = start
+    duration = 0
+    for stop in stops:
+        duration += duration_of('X', stop['x'] - x, Stage.XY_FEED) + duration_of('Y', stop['y'] - y, Stage.XY_FEED)
+        duration += duration_of('Z', stop['z'] - z, Stage.Z_FEED)
+        x, y, z = stop['x'], stop['y'], stop['z']
+        if stop['return_z'] and z_height is not None:
+            duration += duration_of('Z', z_height(stop) - z, Stage.Z_FEED)
+            z = z_height(stop)
+    return duration
+
+
+def _distance(a, b):
+    return move_time(b['x'] - a['x'], Stage.XY_FEED) + move_time(b['y'] - a['y'], Stage.XY_FEED)
+
+
+def order_scans(plans, start):
+    """
+    Orders the scans to shorten the travel between them, each scan being walked forward or in reverse
+
+    :param plans: for each scan, its stops walked forward
+    :param start: [x, y, z] position of the stage before scanning
+    :return: list of (scan index in plans, reverse). The scans without stops are left at the end.
+    """
+    empty = [(index, False) for index, plan in enumerate(plans) if len(plan) == 0]
+    ends = {index: (plan[0], plan[-1]) for index, plan in enumerate(plans) if len(plan) > 0}
+    if len(ends) == 0:
+        return empty
+
+    def entry(index, reverse):
+        return ends[index][1] if reverse else ends[index][0]
+
+    def exit_(index, reverse):
+        return ends[index][0] if reverse else ends[index][1]
+
+    # Nearest neighbour, starting from the stage
+    position = {'x': start[0], 'y': start[1]}
+    remaining = set(ends)
+    order = []
+    while remaining:
+        index, reverse = min(((index, reverse) for index in sorted(remaining) for reverse in (False, True)),
+                             key=lambda option: _distance(position, entry(*option)))
+        order.append((index, reverse))
+        remaining.remove(index)
+        position = exit_(index, reverse)
+
+    def cost(order):
+        total = _distance({'x': start[0], 'y': start[1]}, entry(*order[0]))
+        for previous, following in zip(order, order[1:]):
+            total += _distance(exit_(*previous), entry(*following))
+        return total
+
+    # 2-opt: walking a run of scans backwards also walks each of them in the other direction
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(order) - 1):
+            for j in range(i + 1, len(order)):
+                flipped = [(index, not reverse) for index, reverse in order[i:j + 1][::-1]]
+                candidate = order[:i] + flipped + order[j + 1:]
+                if cost(candidate) < cost(order) - 1e-9:
+                    order = candidate
+                    improved = True
+    return order + empty
@@ -0,0 +1,137 @@
+"""
+Preview: renders the frames of the camera next to the side panel of the window
+
+Each frame is shrunk into a preallocated canvas, next to the side panel: decimated to twice the size of the preview,
+then averaged over 2 x 2 pixels with INTER_AREA, which is a few times faster than INTER_AREA over the whole frame. The
+text of the panel, and the help drawn over the frame, are only redrawn when they change, line by line for the panel,
+so that the preview leaves the CPU to the capture and the stacking. A strip below the frame and the panel holds a
+readout of the rate of the preview, of the time taken to render a frame and of the delay between the start of its
+exposure and its display.
+"""
+import time
+
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.4
+LINE_HEIGHT = 20
+BUTTON_COLOUR = (120, 255, 255)
+STATUS_COLOUR = (230, 230, 255)
+HELP_COLOUR = (0, 255, 255)
+READOUT_COLOUR = (160, 160, 160)
+# Height of the strip of the readout, below the frame and the panel
+READOUT_HEIGHT = 25
+
+
+class Preview(object):
+    """
+    :param panel_width: width of the side panel, in pixels
+    :param scale: the frames are shrunk by this factor
+    :param readout_interval: time between two updates of the readout, in seconds
+    """
+    def __init__(self, panel_width=300, scale=4, readout_interval=1.):
+        self.panel_width = panel_width
+        self.scale = scale
+        self.readout_interval = readout_interval
+        self.canvas = None
+        # Contiguous buffers the frame is decimated then shrunk into, before being copied next to the panel
+        self.decimated = None
+        self.frame = None
+        # Text drawn on each line of the panel, as (button, status), and over the frame
+        self.lines = []
+        self.help_text = None
+        self.help_layer = None
+        self.help_mask = None
+        self.readout = None
+        # Frames rendered since the readout was last updated, and the time spent rendering them
+        self.count = 0
+        self.render_time = 0.
+        self.delay = None
+        self.since = time.monotonic()
+
+    def render(self, img, channel=None, buttons=(), status=(), help_text=(), started=None):
+        """
+        :param img: BGR frame
+        :param channel: index of the channel shown in grey levels, None to show the colour frame
+        :param buttons: keys of the lines of the panel
+        :param status: text of the lines of the panel, drawn right of the keys
+        :param help_text: lines drawn over the frame
+        :param started: time (time.monotonic) at which the exposure of the frame started, for the readout
+        :return: the canvas, overwritten by the next call
+        """
+        start = time.monotonic()
+        rows, columns = max(img.shape[0] // self.scale, 1), max(img.shape[1] // self.scale, 1)
+        shape = (rows + READOUT_HEIGHT, self.panel_width + columns, 3)
+        if self.canvas is None or self.canvas.shape != shape:
+            self.canvas = np.zeros(shape, dtype=np.uint8)
+            self.decimated = np.empty((2 * rows, 2 * columns, 3), dtype=np.uint8)
+            self.frame = np.empty((rows, columns, 3), dtype=np.uint8)
+            self.lines = []
+            self.help_text = None
+            self.readout = None
+
+        if self.scale > 2:
+            img = cv2.resize(img, (2 * columns, 2 * rows), dst=self.decimated, interpolation=cv2.INTER_NEAREST)
+        cv2.resize(img, (columns, rows), dst=self.frame, interpolation=cv2.INTER_AREA)
+        if channel is not None:
+            self.frame[...] = self.frame[..., [channel]]
+        self.draw_help(help_text)
+        if self.help_mask is not None:
+            np.copyto(self.frame, self.help_layer, where=self.help_mask)
+        self.canvas[:rows, self.panel_width:] = self.frame
+        self.draw_panel(buttons, status)
+
+        now = time.monotonic()
+        self.count += 1
+        self.render_time += now - start
+        if started is not None:
+            self.delay = now - started
+        if now - self.since >= self.readout_interval:
+            self.draw_readout(f"{self.count / (now - self.since):.1f} fps, "
+                              f"render {1000 * self.render_time / self.count:.1f}ms"
+                              + ("" if self.delay is None else f", delay {1000 * self.delay:.0f}ms"))
+            self.count, self.render_time, self.since = 0, 0., now
+        return self.canvas
+
+    def draw_panel(self, buttons, status):
+        """
+        Redraws the lines of the panel that changed. The lines that would reach the readout are left out.
+        """
+        count = max(len(buttons), len(status), len(self.lines))
+        lines = [(buttons[i] if i < len(buttons) else "", status[i] if i < len(status) else "") for i in range(count)]
+        bottom = self.canvas.shape[0] - READOUT_HEIGHT
+        for i, line in enumerate(lines):
+            baseline = i * LINE_HEIGHT + 20
+            if i < len(self.lines) and self.lines[i] == line or baseline + 5 > bottom:
+                continue
+            self.clear_line(baseline)
+            cv2.putText(self.canvas, line[0], (10, baseline), FONT, FONT_SCALE, BUTTON_COLOUR, 1, cv2.LINE_AA)
+            cv2.putText(self.canvas, line[1], (50, baseline), FONT, FONT_SCALE, STATUS_COLOUR, 1, cv2.LINE_AA)
+        self.lines = lines
+
+    def draw_help(self, help_text):
+        """
+        Renders the help in a layer drawn over each frame, when it changed
+        """
+        help_text = tuple(help_text)
+        if help_text == self.help_text:
+            return
+        self.help_text = help_text
+        if len(help_text) == 0:
+            self.help_layer, self.help_mask = None, None
+            return
+        self.help_layer = np.zeros_like(self.frame)
+        for i, text in enumerate(help_text):
+            cv2.putText(self.help_layer, text, (10, i * LINE_HEIGHT + 20), FONT, FONT_SCALE, HELP_COLOUR, 1,
+                        cv2.LINE_AA)
+        self.help_mask = np.any(self.help_layer > 0, axis=-1, keepdims=True)
+
+    def draw_readout(self, text):
+        self.readout = text
+        self.canvas[-READOUT_HEIGHT:, :self.panel_width] = 0
+        cv2.putText(self.canvas, text, (10, self.canvas.shape[0] - 8), FONT, FONT_SCALE, READOUT_COLOUR, 1,
+                    cv2.LINE_AA)
+
+    def clear_line(self, baseline):
+        self.canvas[max(baseline - 15, 0):baseline + 5, :self.panel_width] = 0
@@ -0,0 +1,148 @@
+"""
+Registration of the images of a focus stack
+
+Shifts between consecutive images are estimated coarsely by phase correlation of their downsampled green channel, then
+refined to subpixel precision by matching a patch at full resolution around the coarse estimate. Each image is
+transformed only once, using real FFTs, and the shifts are returned as data so that callers can decide how (and
+whether) to apply them.
+"""
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from scipy import fft
+
+
+@lru_cache(maxsize=8)
+def hann_window(shape):
+    return cv2.createHanningWindow(shape[::-1], cv2.CV_32F)
+
+
+def _green(image):
+    green = image[..., 1] if image.ndim == 3 else image
+    return green.astype(np.float32)
+
+
+def _prepare(green, downsample):
+    if downsample > 1:
+        size = (green.shape[1] // downsample, green.shape[0] // downsample)
+        green = cv2.resize(green, size, interpolation=cv2.INTER_AREA)
+    green = green - green.mean()
+    return green * hann_window(green.shape)
+
+
+def _parabola_offset(before, value, after):
+    denominator = before - 2 * value + after
+    return 0.5 * (before - after) / denominator if denominator != 0 else 0
+
+
+def _correlation_peak(correlation):
+    # Integer peak of a circular correlation, as a signed (x, y) shift
+    rows, columns = correlation.shape
+    py, px = np.unravel_index(np.argmax(correlation), correlation.shape)
+    return np.asarray([px - columns if px > columns / 2 else px, py - rows if py > rows / 2 else py])
+
+
+def _refine(reference, green, coarse, radius, size):
+    """
+    Refines the shift of green relative to reference by matching a central patch of green in a window of
+    reference around the coarse shift, then fitting a parabola through the matching score
+    """
+    rows, columns = green.shape
+    dx, dy = int(round(coarse[0])), int(round(coarse[1]))
+    half = min(size, rows - 2 * (abs(dy) + radius), columns - 2 * (abs(dx) + radius)) // 2
+    if half < 8:
+        return np.asarray(coarse, dtype=np.float64)
+    cy, cx = rows // 2, columns // 2
+    patch = green[cy - half:cy + half, cx - half:cx + half]
+    window = reference[cy + dy - half - radius:cy + dy + half + radius, cx + dx - half - radius:cx + dx + half + radius]
+    score = cv2.matchTemplate(window, patch, cv2.TM_CCOEFF_NORMED)
+    py, px = np.unravel_index(np.argmax(score), score.shape)
+    # No subpixel offset on the border of the score, where the peak has a single neighbour
+    offset_x, offset_y = 0, 0
+    if 0 < px < score.shape[1] - 1:
+        offset_x = _parabola_offset(score[py, px - 1], score[py, px], score[py, px + 1])
+    if 0 < py < score.shape[0] - 1:
+        offset_y = _parabola_offset(score[py - 1, px], score[py, px], score[py + 1, px])
+    return np.asarray([dx - radius + px + offset_x, dy - radius + py + offset_y])
+
+
+def estimate_shifts(images, downsample=4, refine_size=256, workers=-1):
+    """
+    Estimates the shift of every image of a stack relative to the first one
+
+    :param images: sequence of (rows, columns, 3) images
+    :param downsample: the coarse shifts are estimated on the green channel reduced by this factor
+    :param refine_size: size of the full resolution patch used to refine the shifts (0 to only use the coarse shifts)
+    :param workers: number of threads used by the FFTs (-1 for all CPUs)
+    :return: (images, 2) array of (x, y) shifts in pixels. Translating image i by shifts[i] aligns it on the first.
+    """
+    shifts = np.zeros((len(images), 2), dtype=np.float64)
+    previous = None
+    previous_green = None
+    for i, image in enumerate(images):
+        green = _green(image)
+        prepared = _prepare(green, downsample)
+        spectrum = fft.rfft2(prepared, workers=workers)
+        if previous is not None:
+            cross_power = previous * np.conj(spectrum)
+            cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+            correlation = fft.irfft2(cross_power, s=prepared.shape, workers=workers)
+            shift = _correlation_peak(correlation) * downsample
+            if refine_size > 0:
+                shift = _refine(previous_green, green, shift, downsample + 1, refine_size)
+            shifts[i] = shifts[i - 1] + shift
+        previous = spectrum
+        previous_green = green
+    return shifts
+
+
+def crop_box(shape, shifts):
+    """
+    Region (y0, y1, x0, x1) of the first image that is covered by every shifted image
+    """
+    shifts = np.asarray(shifts)
+    x0 = int(np.ceil(max(shifts[:, 0].max(), 0)))
+    y0 = int(np.ceil(max(shifts[:, 1].max(), 0)))
+    x1 = shape[1] + int(np.floor(min(shifts[:, 0].min(), 0)))
+    y1 = shape[0] + int(np.floor(min(shifts[:, 1].min(), 0)))
+    return y0, y1, x0, x1
+
+
+def needs_alignment(shifts, threshold=0.5):
+    return bool(np.any(np.abs(shifts) >= threshold))
+
+
+def apply_shifts(images, shifts, threshold=0.5, subpixel=False):
+    """
+    Aligns the images on the first one and crops them to the region they all cover
+
+    :param threshold: if every shift is below this (in pixels) the images are returned untouched
+    :param subpixel: warp the images by the exact shifts. Otherwise the shifts are rounded and the images are
+        only cropped, without any interpolation.
+    :return: array of aligned images
+    """
+    images = np.asarray(images)
+    shifts = np.asarray(shifts)
+    if not needs_alignment(shifts, threshold):
+        return images
+    if not subpixel:
+        shifts = np.round(shifts)
+    y0, y1, x0, x1 = crop_box(images.shape[1:3], shifts)
+    if not subpixel:
+        aligned = [image[y0 - int(dy):y1 - int(dy), x0 - int(dx):x1 - int(dx)]
+                   for image, (dx, dy) in zip(images, shifts)]
+        return np.asarray(aligned)
+    aligned = np.zeros((images.shape[0], y1 - y0, x1 - x0) + images.shape[3:], dtype=images.dtype)
+    for i, (image, (dx, dy)) in enumerate(zip(images, shifts)):
+        M = np.asarray([[1, 0, dx - x0], [0, 1, dy - y0]], dtype=np.float32)
+        aligned[i] = cv2.warpAffine(image, M, dsize=(x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR)
+    return aligned
+
+
+def register(images, downsample=4, threshold=0.5, subpixel=False):
+    """
+    :return: aligned images, shifts
+    """
+    shifts = estimate_shifts(images, downsample)
+    return apply_shifts(images, shifts, threshold, subpixel), shifts
@@ -1,11 +1,12 @@
+import math
 import os
-import multiprocessing as mp
-import skimage.io as skio
+import time
 import numpy as np
 import datetime as dt
 from shutil import rmtree
 from pathlib import Path
-from sashimi import utils, helicon_stack
+from sashimi import utils, adaptive_range, autofocus, focus_map, focus_metrics, focus_stack, image_writer, \
+    occupancy, path_planning, stack_file, stackers, stacking_service
 
 # TODO: make an ETA function
 
@@ -18,15 +19,12 @@ def clip(n, mini=0, maxi=None):
     return n
     
     
-def measure_sharpness(img):
-    img = img[::4, ::4, ...]
-    sharpness = []
-    for i in range(3):
-        dx = np.diff(img, axis=1)[1:, :, i]  # remove the first row
-        dy = np.diff(img, axis=0)[:, 1:, i]  # remove the first column
-        dnorm = np.sqrt(dx ** 2 + dy ** 2)
-        sharpness.append(np.average(dnorm))
-    return sharpness
+def measure_sharpness(img, operator="tenengrad"):
+    """
+    :param operator: focus operator, see focus_metrics
+    :return: sharpness of the frame decimated by 4
+    """
+    return focus_metrics.sharpness(img, operator)
 
 
 def remove_folder(folder):
@@ -56,6 +54,10 @@ class Scanner(object):
 
         self.frame_duration_ms = self.controller.frame_duration_ms
         self.auto_f_stack = self.controller.auto_f_stack
+        self.stream_stack = self.controller.stream_stack
+        self.stack_files = self.controller.stack_files
+        self.stacker = self.make_stacker()
+        self.stack_workers = self.controller.stack_workers
         self.remove_raw = self.controller.remove_raw
         self.auto_quit = self.controller.auto_quit
         self.scan_dir = self.controller.save_dir
@@ -68,14 +70,27 @@ class Scanner(object):
             self.fs_exp_folders = [self.fs_folder.joinpath(f"E{exp}") for exp in self.multi_exp]
         self.X_STEP = 1700
         self.Y_STEP = 1700
+        # Fraction of a stack step moved per frame by continuous Z stacks
+        self.CONTINUOUS_Z_MARGIN = 0.8
         self.stack_count = None
         self.current_stack = 0
         self.total_stacks = 0
         self.current_pic_count = 0
         self.total_pic_count = 0
         self.is_multi_scanning = False
-        self.parallel_process = None
-        self.queue = None
+        self.stream_fusers = []
+        self.stacking_service = None
+        self.image_writer = image_writer.ImageWriter()
+        # Time spent in each phase of the scans, in seconds
+        self.phase_times = {}
+        self.autofocus_moves = 0
+        # Focus maps of the scans, by index
+        self.focus_maps = {}
+        # Slices left out by the adaptive stack range
+        self.adaptive_stats = {'stacks': 0, 'leading slices skipped': 0, 'stacks ended early': 0,
+                               'slices not taken': 0}
+        # Fields checked for particles, and the tiles found empty
+        self.empty_fields = {'checked': 0, 'empty': []}
         self.update_stack_count()
         self.update_total_pic_count()
 
@@ -84,6 +99,15 @@ class Scanner(object):
             'language': self.controller.lang,
             'layout': self.controller.layout,
             'auto_f_stack': self.auto_f_stack,
+            'stream_stack': self.stream_stack,
+            'stack_files': self.stack_files,
+            'stacker': self.stacker.name,
+            'stack_workers': self.stack_workers,
+            'triggered': self.controller.triggered,
+            'continuous_z': self.controller.continuous_z,
+            'autofocus': self.controller.autofocus,
+            'adaptive_z': self.controller.adaptive_z,
+            'empty_fields': self.controller.empty_fields,
             'remove_raw': self.remove_raw,
             'auto_quit': self.auto_quit,
             'lowest_z': self.controller.lowest_z,
@@ -93,8 +117,8 @@ class Scanner(object):
             'stack_step (µm)': self.config.stack_step
         }
         
-    def lowest_corner(self) -> int:
-        current_scan = self.selected_scan()
+    def lowest_corner(self, current_scan=None) -> int:
+        current_scan = self.selected_scan() if current_scan is None else current_scan
         fl = current_scan['FL']
         br = current_scan['BR']
         blz = current_scan['BL_Z']
@@ -106,17 +130,74 @@ class Scanner(object):
             mini = 0
         return mini
     
-    def get_corrected_z(self, dx, dy):
+    def get_corrected_z(self, dx, dy, scan=None):
+        scan = self.selected_scan() if scan is None else scan
         if self.controller.lowest_z:
             # 'Dumb-but-works' correction
-            new_z = self.lowest_corner()
+            new_z = self.lowest_corner(scan)
         else:
             # 'Smart' correction
-            dz_dx, dz_dy = self.selected_scan()['Z_corrections']
+            dz_dx, dz_dy = scan['Z_corrections']
             z_correction = int(dz_dx * dx + dz_dy * dy)
-            new_z = self.selected_scan()['FL'][2] + z_correction
+            new_z = scan['FL'][2] + z_correction
         return clip(new_z - self.config.z_margin)
         
+    def stack_range(self, dx, dy, index=None):
+        """
+        With a focus map, the stack starts below the surface by the error of the map rather than by z_margin, and
+        the slices that were only taken to cover the rest of z_margin are left out
+
+        :param index: index of the scan, the selected one by default
+        :return: height at which the stack starts, and its number of slices
+        """
+        index = self.controller.selected_scan_number - 1 if index is None else index
+        scan = self.config.scans[index]
+        surface = self.focus_maps.get(index)
+        if surface is None:
+            return self.get_corrected_z(dx, dy, scan), self.stack_count
+        margin = surface.margin(self.config.stack_step, self.config.z_margin)
+        z = surface(scan['FL'][0] + dx, scan['FL'][1] + dy)
+        skipped = (self.config.z_margin - margin) // self.config.stack_step
+        return clip(int(round(z)) - margin), max(self.stack_count - skipped, 1)
+
+    def build_focus_map(self, index):
+        """
+        Finds the height of best focus on a grid of focus_grid points over a scan, and saves its focus map with it
+        """
+        scan = self.config.scans[index]
+        fl = scan['FL']
+        samples = []
+        for x, y in focus_map.grid_points(scan, *self.config.focus_grid):
+            # Searched around the height given by the corners
+            z = self.get_corrected_z(x - fl[0], y - fl[1], scan) + self.config.z_margin
+            self.stage.goto([x, y, z])
+            self.stage.wait_until_position()
+            result = self.find_focus(z - self.config.z_margin, z + self.config.z_margin)
+            self.autofocus_moves += result['moves']
+            samples.append((x, y, result['z']))
+        surface = focus_map.FocusMap(samples, self.config.focus_map_method)
+        scan['focus_map'] = surface.to_dict()
+        error = "unknown" if surface.error is None else f"{surface.error:.1f}µm"
+        print(f"focus map of scan{index + 1}: {len(samples)} samples, error {error}")
+
+    def load_focus_maps(self):
+        # Autofocus on each tile searches around the height given by the corners, so a saved map is not used
+        self.focus_maps = {n: focus_map.FocusMap.from_dict(scan['focus_map'])
+                           for n, scan in enumerate(self.config.scans)
+                           if 'focus_map' in scan and self.controller.autofocus != 'tile'}
+        self.summary['focus maps'] = {
+            f"scan{n + 1}": {'samples': len(surface.samples), 'error (µm)': surface.error,
+                             'margin (µm)': surface.margin(self.config.stack_step, self.config.z_margin),
+                             'slices': self.stack_range(0, 0, n)[1]}
+            for n, surface in self.focus_maps.items()}
+
+    def make_stacker(self):
+        stacker_options = {'z_step': self.config.stack_step}
+        if self.controller.stacker == stackers.PyramidStacker.name:
+            stacker_options.update(precision=self.controller.fusion_precision,
+                                   memory_budget=self.controller.memory_budget)
+        return stackers.get_stacker(self.controller.stacker, **stacker_options)
+
     def update_stack_count(self):
         self.stack_count = self.config.stack_height // self.config.stack_step
 
@@ -143,6 +224,13 @@ class Scanner(object):
         self.current_pic_count = 0
         self.update_total_pic_count()
         self.summary['scan_dates'] = []
+        self.summary['stack height (µm)'] = self.config.stack_height
+        self.summary['stack_step (µm)'] = self.config.stack_step
+        self.phase_times = {}
+        self.autofocus_moves = 0
+        self.adaptive_stats = dict.fromkeys(self.adaptive_stats, 0)
+        self.empty_fields = {'checked': 0, 'empty': []}
+        self.image_writer.reset_stats()
         self.controller.selected_scan_number = 1
         self.controller.interrupt_flag = False
 
@@ -153,32 +241,67 @@ class Scanner(object):
             else:
                 self.controller.save_dir = utils.make_unique_subdir(self.controller.save_dir.parent)
         
-        if self.auto_f_stack:
+        if self.stream_stack:
+            os.makedirs(self.fs_folder, exist_ok=True)
+        elif self.auto_f_stack:
+            # With the step of this scan, which can be changed while the application runs
+            self.stacker = self.make_stacker()
+            self.stacker.check()
             os.makedirs(self.fs_folder)
-            mp.set_start_method("spawn")
-            self.queue = mp.Queue()
-            error_logs = self.controller.save_dir.joinpath('error_logs.txt')
-            if error_logs.exists():
-                os.remove(error_logs)
-            arguments = (self.queue, error_logs, self.multi_exp, self.controller.remove_raw)
-            self.parallel_process = mp.Process(target=helicon_stack.parallel_stack, args=arguments)
-            self.parallel_process.start()
-
-        for n in range(len(self.config.scans)):
-            if not self.is_multi_scanning:
-                break
-            scan_name = f"scan{n + 1}"
-            scan_dir = Path(self.controller.save_dir).joinpath(scan_name)
-            os.makedirs(scan_dir)
-            self.controller.selected_scan_number = n + 1
-            self.summary['scan_dates'].append(dt.datetime.now(tz=dt.timezone(dt.timedelta(hours=2))))
-            self.scan(scan_dir)
+            self.stacking_service = stacking_service.StackingService(self.stacker, self.stack_workers)
+        if self.controller.triggered:
+            self.camera.set_triggered(True)
+        # Free running capture is restored even if the scan fails, so that the preview keeps running
+        try:
+            if self.controller.autofocus in ('corners', 'map'):
+                start = time.time()
+                for n in range(len(self.config.scans)):
+                    if self.controller.autofocus == 'corners':
+                        self.focus_corners(n)
+                    else:
+                        self.build_focus_map(n)
+                self.add_phase_time('autofocus', start)
+                # The simulated slide is not the one under the microscope
+                if not self.controller.simulate:
+                    self.config.save()
+            self.load_focus_maps()
+
+            # The scans keep their number, but are visited in the order that shortens the travel between them
+            plans = [self.plan_scan(scan, n) for n, scan in enumerate(self.config.scans)]
+            order = path_planning.order_scans(plans, self.stage.position)
+            self.summary['scan order'] = [n + 1 for n, _ in order]
+            self.summary['planned travel (s)'] = []
+            for n, reverse in order:
+                if not self.is_multi_scanning:
+                    break
+                scan_name = f"scan{n + 1}"
+                scan_dir = Path(self.controller.save_dir).joinpath(scan_name)
+                os.makedirs(scan_dir)
+                self.controller.selected_scan_number = n + 1
+                self.summary['scan_dates'].append(dt.datetime.now(tz=dt.timezone(dt.timedelta(hours=2))))
+                self.scan(scan_dir, reverse)
+        finally:
+            if self.controller.triggered:
+                self.camera.set_triggered(False)
+        self.wait_for_stream_fusers()
+        start = time.time()
+        self.image_writer.flush()
+        self.add_phase_time('save', start)
+        self.summary['image writer'] = self.image_writer.stats()
         self.summary['scan_dates'].append(dt.datetime.now(tz=dt.timezone(dt.timedelta(hours=2))))
-        self.make_scan_summary()
         
-        if self.auto_f_stack:
-            self.queue.put('terminate')
-            self.parallel_process.join()
+        if self.stacking_service is not None:
+            start = time.time()
+            for result in self.stacking_service.close():
+                print(stacking_service.format_result(result))
+            self.stacking_service = None
+            self.add_phase_time('stacking', start)
+        self.summary['phase times (s)'] = {phase: round(duration, 2) for phase, duration in self.phase_times.items()}
+        self.summary['autofocus moves'] = self.autofocus_moves
+        self.summary['adaptive z'] = dict(self.adaptive_stats) if self.controller.adaptive_z else None
+        self.summary['empty fields'] = dict(self.empty_fields) if self.controller.empty_fields else None
+        self.calibrate_motion()
+        self.make_scan_summary()
 
         self.is_multi_scanning = False
         if self.auto_quit:
@@ -186,7 +309,32 @@ class Scanner(object):
             self.controller.interrupt_flag = True if self.controller.quit_requested else False
             self.controller.quit_requested = True
 
-    def scan(self, scan_dir):
+    def calibrate_motion(self):
+        """
+        Fits the motion model to the moves of the scans, and saves it in the configuration
+        """
+        motion = self.stage.motion
+        error = motion.error()
+        if motion.calibrate():
+            print(f"Motion model calibrated on {len(motion.observations)} moves, mean error "
+                  f"{1000 * error:.0f}ms -> {1000 * motion.error():.0f}ms: {motion.parameters}")
+            # The model of the simulated stage is not the one of the microscope
+            if not self.controller.simulate:
+                self.config.save()
+        self.summary['motion model'] = motion.parameters
+
+    def plan_scan(self, scan, index, reverse=False):
+        """
+        :return: stops of the scan along a serpentine path (see path_planning)
+        """
+        return path_planning.plan_scan(scan, index, self.X_STEP, self.Y_STEP,
+                                       lambda scan, dx, dy: self.stack_range(dx, dy, index)[0], reverse,
+                                       z_tolerance=self.config.stack_step)
+
+    def scan(self, scan_dir, reverse=False):
+        """
+        :param reverse: walk the serpentine path of the scan from its end
+        """
         selected_scan = self.controller.selected_scan()
         fl = selected_scan['FL']
         br = selected_scan['BR']
@@ -198,101 +346,477 @@ class Scanner(object):
             return
         
         os.makedirs(scan_dir, exist_ok=True)
-        
-        self.stage.goto(fl)
-        self.stage.wait_until_position(10000)
-        x_steps, y_steps = self.step_nbr_xy(selected_scan)
-        self.total_stacks = x_steps * y_steps
+
+        stops = self.plan_scan(selected_scan, self.controller.selected_scan_number - 1, reverse)
+        planned_travel = path_planning.travel_time(stops, self.stage.position, lambda stop: fl[2], self.stage.motion)
+        print(f"{len(stops)} stacks, about {planned_travel:.0f}s of travel")
+        self.summary.setdefault('planned travel (s)', []).append(round(planned_travel, 2))
+        self.stage.goto([stops[0]['x'], stops[0]['y'], fl[2]])
+        self.stage.wait_until_position()
+        self.total_stacks = len(stops)
         
         # Start scanning
         self.current_stack = 0
-        for yi in range(y_steps):
-            for xi in range(x_steps):
-                self.current_stack += 1
-
-                if self.check_for_escape():
-                    print('escaping scan()')
-                    return
-                
-                dx, dy = self.X_STEP * xi, self.Y_STEP * yi
-                du = [fl[0] + dx, fl[1] + dy, fl[2]]
-                self.stage.goto(du)
-                self.stage.wait_until_position(1000)
-                self.take_stack(dx, dy, scan_dir)
-
-    def take_stack(self, dx, dy, scan_dir):
+        stay_down = False
+        for stop in stops:
+            self.current_stack += 1
+
+            if self.check_for_escape():
+                print('escaping scan()')
+                return
+
+            start = time.time()
+            if stay_down:
+                # Straight to the start of the stack, without going back up to the height of the scan
+                self.stage.goto([stop['x'], stop['y'], stop['z']])
+            else:
+                self.stage.goto([stop['x'], stop['y'], fl[2]])
+            self.stage.wait_until_position()
+            self.add_phase_time('travel', start)
+            self.take_stack(stop['dx'], stop['dy'], scan_dir, fl[2] if stop['return_z'] else None)
+            stay_down = not stop['return_z']
+
+    def take_stack(self, dx, dy, scan_dir, z_return=None):
+        """
+        :param z_return: height to which the stage goes back after the stack, None to leave it at the top
+        """
+
         # Create directory to save stack
         xy_folder = Path(scan_dir).joinpath(f"X{self.stage.x//10:05d}_Y{self.stage.y//10:05d}")
-        os.makedirs(xy_folder, exist_ok=True)
-        if self.multi_exp:
-            for exp in self.multi_exp:
-                os.makedirs(xy_folder.joinpath(f"E{exp}"), exist_ok=True)
-        
-        z_orig = self.stage.z
-        self.stage.goto_z(self.get_corrected_z(dx, dy))
-        self.stage.wait_until_position(1000)
-        
+        # When stacking from memory, the raw pictures are only written if they are to be kept. Stack files are
+        # memory-mapped by the stackers, so the frames are not copied to shared memory as well.
+        in_memory = self.stream_stack or (self.stacking_service is not None and not self.stacker.needs_files
+                                          and not self.stack_files)
+        save_raw = not (in_memory and self.remove_raw)
+
+        z_start, count = self.stack_range(dx, dy)
+        if self.controller.autofocus == 'tile':
+            start = time.time()
+            z_start = self.focus_tile(z_start)
+            self.add_phase_time('autofocus', start)
+
         exp_values = self.multi_exp if self.multi_exp else (self.config.exposure_time,)
-        for i in range(self.stack_count):
+        checked = None
+        if self.controller.empty_fields is not None:
+            # Checked on the slice of the expected surface, where the particles are in focus
+            surface = self.surface_slice(count)
+            start = time.time()
+            self.stage.goto_z(z_start + surface * self.config.stack_step)
+            self.stage.wait_until_position()
+            self.add_phase_time('z_moves', start)
+            img = self.check_field(xy_folder, exp_values[0])
+            if img is None:
+                if z_return is not None:
+                    start = time.time()
+                    self.stage.goto_z(z_return)
+                    self.stage.wait_until_position()
+                    self.add_phase_time('z_moves', start)
+                return
+            checked = (surface, img)
+        start = time.time()
+        self.stage.goto_z(z_start)
+        self.stage.wait_until_position()
+        self.add_phase_time('z_moves', start)
+
+        if save_raw and not self.stack_files:
+            os.makedirs(xy_folder, exist_ok=True)
+            if self.multi_exp:
+                for exp in self.multi_exp:
+                    os.makedirs(xy_folder.joinpath(f"E{exp}"), exist_ok=True)
+        fusers = self.start_stream_fusers(xy_folder, exp_values) if self.stream_stack else {}
+        buffers = {}
+        files = {}
+        if self.controller.continuous_z:
+            slices = self.continuous_slices(self.stage.z, exp_values[0], count)
+        else:
+            slices = self.stepped_slices(self.stage.z, exp_values, count, checked)
+        if self.controller.adaptive_z:
+            slices = self.adaptive_slices(slices, exp_values, count)
+        stored = 0
+        for i, z, exp, img in slices:
+            self.current_pic_count += 1
+            if self.check_for_escape():
+                print('escaping take_stack()')
+                for fuser in fusers.values():
+                    fuser.cancel()
+                for buffer in buffers.values():
+                    buffer.release()
+                for file in files.values():
+                    file.close()
+                return
+            stored = max(stored, i + 1)
+            start = time.time()
+            if self.stream_stack or (save_raw and not self.stack_files):
+                # Queued for fusion or writing, while the camera keeps reusing its frame buffers
+                img = img.copy()
+            start = self.add_phase_time('capture', start)
+            self.show_image(img)
+            start = self.add_phase_time('display', start)
+            if self.stream_stack:
+                fusers[exp].add(img)
+            elif in_memory:
+                # The slices go straight into shared memory, in RGB like the saved pictures
+                if exp not in buffers:
+                    buffers[exp] = self.stacking_service.allocate((count,) + img.shape)
+                buffers[exp].array[i] = img[..., ::-1]
+            start = self.add_phase_time('stacking', start)
+            if not save_raw:
+                continue
+            if self.stack_files:
+                if exp not in files:
+                    files[exp] = stack_file.StackFile(self.stack_file_path(xy_folder, exp), count,
+                                                      img.shape, x=self.stage.x, y=self.stage.y, exposure=exp)
+                files[exp].write(i, img[..., ::-1], z=z)
+                self.add_phase_time('save', start)
+                continue
+
+            # save the picture
+            if self.multi_exp is not None:
+                save_path = xy_folder.joinpath(f"E{exp}")
+            else:
+                save_path = xy_folder
+            save_path = save_path.joinpath(f"X{self.stage.x//10:05d}_"
+                                           f"Y{self.stage.y//10:05d}_"
+                                           f"Z{int(z)//10:05d}.jpg")
+            self.image_writer.write(save_path, img)
+            self.add_phase_time('save', start)
+
+        # The stage goes back while the stack is saved and handed over for stacking
+        settling = None
+        if z_return is not None:
+            self.stage.goto_z(z_return)
+            settling = self.stage.settle()
+
+        start = time.time()
+        for file in files.values():
+            file.close()
+        self.add_phase_time('save', start)
+
+        start = time.time()
+        if self.stream_stack:
+            for fuser in fusers.values():
+                fuser.close()
+        elif in_memory:
+            for exp, buffer in buffers.items():
+                if stored < count:
+                    buffer.truncate(stored)
+                for result in self.stacking_service.submit(buffer, save_path=self.fused_path(xy_folder, exp)):
+                    print(stacking_service.format_result(result))
+        elif self.stacking_service is not None:
+            # The stacker reads the pictures from the disk
+            self.image_writer.flush()
             for exp in exp_values:
-                self.current_pic_count += 1
-                if self.check_for_escape():
-                    print('escaping take_stack()')
-                    return
-                # set exposure and take a picture
-                self.camera.set_exposure(exp)
-                img = self.wait_until_exposure(exp, 300)
-                self.show_image(img)
-                
-                # save the picture
-                if self.multi_exp is not None:
-                    save_path = xy_folder.joinpath(f"E{exp}")
+                if self.stack_files:
+                    folder = files[exp].path
+                elif self.multi_exp is not None:
+                    folder = xy_folder.joinpath(f"E{exp}")
                 else:
-                    save_path = xy_folder
-                save_path = save_path.joinpath(f"X{self.stage.x//10:05d}_"
-                                               f"Y{self.stage.y//10:05d}_"
-                                               f"Z{self.stage.z//10:05d}.jpg")
-                skio.imsave(str(save_path), img[..., ::-1], check_contrast=False, quality=90)
-            
-            self.stage.move_z(self.config.stack_step)
-            self.stage.wait_until_position(100)
-        
-        if self.auto_f_stack:
-            self.queue.put((str(xy_folder), str(self.fs_folder)))
+                    folder = xy_folder
+                finished = self.stacking_service.submit_folder(folder, save_path=self.fused_path(xy_folder, exp),
+                                                               remove_raw=self.remove_raw)
+                for result in finished:
+                    print(stacking_service.format_result(result))
+
+        start = self.add_phase_time('stacking', start)
 
         self.camera.set_exposure(exp_values[0])
-        self.stage.goto_z(z_orig)
-        self.stage.wait_until_position(50 * self.stack_count)
+        if settling is not None:
+            self.stage.wait_until_position(settling=settling)
+        self.add_phase_time('z_moves', start)
+
+    def check_field(self, xy_folder, exp):
+        """
+        Checks whether the field at the current position shows any particle (see occupancy). An empty field is
+        recorded in the summary and, with empty_fields 'single', its frame is saved next to the stacks instead of a
+        stack.
+
+        :return: copy of the frame, or None if the stack is not to be taken
+        """
+        start = time.time()
+        img = self.capture(exp)
+        result = occupancy.occupancy(img, self.config.occupancy_threshold, self.config.occupancy_min_area)
+        self.add_phase_time('occupancy', start)
+        self.empty_fields['checked'] += 1
+        if result['occupied']:
+            return img.copy()
+        self.empty_fields['empty'].append(f"{xy_folder.parent.name}/{xy_folder.name}")
+        if self.controller.empty_fields == 'single':
+            self.image_writer.write(f"{xy_folder}.jpg", img.copy())
+            self.current_pic_count += 1
+            print(f"{xy_folder.name} is empty, single frame taken")
+        else:
+            print(f"{xy_folder.name} is empty, skipped")
+        return None
+
+    def surface_slice(self, count):
+        """
+        :param count: number of slices of the stack (see stack_range)
+        :return: index of the slice at the expected surface, z_margin above the start of a full stack. The slices
+            left out below the surface by a focus map are not counted.
+        """
+        below = int(round(self.config.z_margin / self.config.stack_step)) - (self.stack_count - count)
+        return min(max(below, 0), count - 1)
+
+    def z_sweep_plan(self, z_start, exp_values, count=None):
+        """
+        Slices of a stack, in the order they are taken: one frame per exposure at each Z, bottom to top
+
+        :param count: number of slices, stack_count by default
+        :return: list of (slice index, z in µm, exposure in µs)
+        """
+        count = self.stack_count if count is None else count
+        return [(i, z_start + i * self.config.stack_step, exp) for i in range(count) for exp in exp_values]
+
+    def stepped_slices(self, z_start, exp_values, count=None, checked=None):
+        """
+        Takes the slices of a stack stopping at each Z (see z_sweep_plan). The stage already moves to the next Z
+        while the frame of a slice is being processed.
+
+        :param checked: (slice index, frame) already taken with the first exposure (see check_field), used as that
+            slice instead of taking it again
+        :return: generator of (slice index, z in µm, exposure, read-only view of the frame)
+        """
+        plan = self.z_sweep_plan(z_start, exp_values, count)
+        previous_z = z_start
+        settling = None
+        for n, (i, z, exp) in enumerate(plan):
+            if z != previous_z:
+                start = time.time()
+                if settling is None:
+                    self.stage.goto_z(z)
+                    settling = self.stage.settle()
+                self.stage.wait_until_position(settling=settling)
+                settling = None
+                self.add_phase_time('z_moves', start)
+                previous_z = z
+            if checked is not None and (i, exp) == (checked[0], exp_values[0]):
+                img = checked[1]
+            else:
+                start = time.time()
+                img = self.capture(exp)
+                self.add_phase_time('capture', start)
+            if n + 1 < len(plan) and plan[n + 1][1] != z:
+                self.stage.goto_z(plan[n + 1][1])
+                settling = self.stage.settle()
+            yield i, z, exp, img
+
+    def continuous_slices(self, z_start, exp, count=None):
+        """
+        Takes the slices of a stack while Z moves up without stopping, a little less than one stack step per frame of
+        the camera (CONTINUOUS_Z_MARGIN) so that a late frame does not skip a slice
+
+        The Z of each frame is interpolated from the time halfway through its exposure, following the speed profile of
+        the motion model of Z from the moment the move is sent. Each slice is the first frame past it; when frames
+        are dropped, the slices that were skipped get the same frame.
+
+        :return: generator of (slice index, interpolated z in µm, exposure, read-only view of the frame)
+        """
+        count = self.stack_count if count is None else count
+        step = self.config.stack_step
+        z_end = z_start + (count - 1) * step
+        start = time.time()
+        self.camera.set_exposure(exp)
+        settled_at = self.stage.settled_at
+        _, _, sequence = self.camera.wait_for_frame(
+            lambda exposure, started: int(exposure) == exp and (started is None or started >= settled_at),
+            timeout=0.3)
+        speed = step * self.camera.frame_rate() * self.CONTINUOUS_Z_MARGIN
+        feed = speed * 60 / 1000
+        self.stage.goto_z(z_end, feed=feed)
+        moved_at = time.monotonic()
+        self.add_phase_time('capture', start)
+
+        i = 0
+        while i < count:
+            start = time.time()
+            img, _, sequence = self.camera.wait_for_frame(after=sequence, timeout=1)
+            self.add_phase_time('capture', start)
+            if img is None:
+                print(f'!!! ERROR: no frame received while sweeping, {count - i} slices missing')
+                break
+            started = self.camera.frames.started(sequence)
+            middle = time.monotonic() if started is None else started + exp / 2e6
+            z = z_start + self.stage.motion.move_position('Z', middle - moved_at, z_end - z_start, feed)
+            # Within rounding, the stage reaches the last slice at the end of the move
+            last = min(math.floor((z - z_start) / step + 1e-6), count - 1)
+            if last > i:
+                print(f'{last - i} slices skipped while sweeping, taken from the next frame')
+            while i <= last:
+                yield i, z, exp, img
+                i += 1
+
+        start = time.time()
+        self.stage.wait_until_position()
+        self.add_phase_time('z_moves', start)
+
+    def adaptive_slices(self, slices, exp_values, count):
+        """
+        Leaves out the slices of a stack that show nothing in focus (see adaptive_range), following the sharpness of
+        the frames with the first exposure. The leading slices are held back until the sharpness rises, and the stack
+        ends once it has fallen back. In continuous Z, the stage still sweeps the whole stack.
+
+        :param slices: generator of the slices of the stack, see stepped_slices
+        :return: generator of the slices kept, their indices starting from 0
+        """
+        tracker = adaptive_range.AdaptiveRange(self.config.adaptive_drop, self.config.adaptive_rise)
+        pending = []
+        for i, z, exp, img in slices:
+            if i == len(tracker.values):
+                start = time.time()
+                tracker.add(measure_sharpness(img, self.config.focus_metric))
+                self.add_phase_time('capture', start)
+            if tracker.first is None:
+                pending.append((i, z, exp, img.copy()))
+                continue
+            for j, pending_z, pending_exp, pending_img in pending:
+                if j >= tracker.first:
+                    yield j - tracker.first, pending_z, pending_exp, pending_img
+            pending = []
+            yield i - tracker.first, z, exp, img
+            if tracker.stopped and exp == exp_values[-1]:
+                # The next slice is not taken
+                slices.close()
+                break
+        first = tracker.finish()
+        for j, z, exp, img in pending:
+            yield j - first, z, exp, img
+
+        self.adaptive_stats['stacks'] += 1
+        self.adaptive_stats['leading slices skipped'] += first
+        if tracker.stopped:
+            self.adaptive_stats['stacks ended early'] += 1
+            self.adaptive_stats['slices not taken'] += count - len(tracker.values)
+
+    def add_phase_time(self, phase, start):
+        """
+        Adds the time elapsed since start to the phase
+
+        :return: the current time, to start timing the next phase
+        """
+        now = time.time()
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + now - start
+        return now
         
+    def fused_path(self, xy_folder, exp):
+        if self.multi_exp is not None:
+            return self.fs_folder.joinpath(f"E{exp}", xy_folder.parent.name, xy_folder.name + self.stacker.extension)
+        return self.fs_folder.joinpath(xy_folder.parent.name, xy_folder.name + self.stacker.extension)
+
+    def stack_file_path(self, xy_folder, exp):
+        if self.multi_exp is not None:
+            return f"{xy_folder}_E{exp}{stack_file.EXTENSION}"
+        return f"{xy_folder}{stack_file.EXTENSION}"
+
+    def start_stream_fusers(self, xy_folder, exp_values):
+        # Only let the previous stack finish fusing while the stage was moving, to bound the memory used
+        self.wait_for_stream_fusers()
+        fusers = {}
+        for exp in exp_values:
+            fusers[exp] = focus_stack.StreamingFuser(self.fused_path(xy_folder, exp),
+                                                     precision=self.controller.fusion_precision)
+        self.stream_fusers = list(fusers.values())
+        return fusers
+
+    def wait_for_stream_fusers(self):
+        for fuser in self.stream_fusers:
+            try:
+                fuser.result()
+            except Exception as e:
+                print(f'!!! ERROR: fusion of {fuser.save_path} failed: {e}')
+        self.stream_fusers = []
+
+    def focus_measure(self, z):
+        """
+        :return: sharpness of the first picture taken once the stage has settled at z
+        """
+        self.stage.goto_z(z)
+        self.stage.wait_until_position()
+        img = self.capture(self.config.exposure_time)
+        self.show_image(img)
+        return measure_sharpness(img, self.config.focus_metric)
+
+    def find_focus(self, z_min, z_max, coarse_step=None, tolerance=None):
+        """
+        Finds the height of best focus at the current XY position (see autofocus.autofocus), and moves there
+
+        :param coarse_step: twice the stack step by default
+        :param tolerance: half the stack step by default
+        :return: dict of the autofocus result
+        """
+        coarse_step = 2 * self.config.stack_step if coarse_step is None else coarse_step
+        tolerance = self.config.stack_step / 2 if tolerance is None else tolerance
+        result = autofocus.autofocus(self.focus_measure, max(z_min, 0), z_max, coarse_step, tolerance)
+        print(f"best focus at Z={result['z']:.0f}µm found in {result['moves']} moves")
+        self.stage.goto_z(result['z'])
+        self.stage.wait_until_position()
+        return result
+
     def find_floor(self):
-        z_orig = self.stage.z
-        self.stage.goto_z(100)
-        self.stage.wait_until_position(500)
-        sharpness = []
-        for i in range(100):
-            img = self.camera.latest_image()
-            # self.show_image(img)
-            sh = measure_sharpness(img)
-            sharpness.append(sh)
-            print(sh)
-            self.stage.move_z(20)
-            self.stage.wait_until_position(200)
-        sharpness = np.asarray(sharpness)
-        print(np.max(sharpness, axis=0))
-        print(np.argmax(sharpness, axis=0) * 20 + 100)
-        self.stage.goto_z(z_orig)
+        """
+        Finds the height of best focus between 100 and 2100µm
+
+        :return: the height in µm, the stage is left there
+        """
+        return self.find_focus(100, 2100, coarse_step=100, tolerance=10)['z']
+
+    def focus_tile(self, z_start):
+        """
+        :param z_start: height at which the stack would start without autofocus
+        :return: height at which the stack starts, z_margin below the best focus found within z_margin of the
+            expected surface
+        """
+        z_surface = z_start + self.config.z_margin
+        result = self.find_focus(z_surface - self.config.z_margin, z_surface + self.config.z_margin)
+        self.autofocus_moves += result['moves']
+        return clip(int(round(result['z'])) - self.config.z_margin)
+
+    def focus_corners(self, index):
+        """
+        Finds the height of best focus at the corners of a scan, and updates its Z correction terms. The third
+        corner is the one at the X of BR and the Y of FL, whose height get_corrected_z takes as BL_Z.
+        """
+        scan = self.config.scans[index]
+        fl, br = scan['FL'], scan['BR']
+        heights = []
+        for x, y, z in ([fl[0], fl[1], fl[2]], [br[0], br[1], br[2]], [br[0], fl[1], scan['BL_Z']]):
+            self.stage.goto([x, y, z])
+            self.stage.wait_until_position()
+            result = self.find_focus(z - self.config.z_margin, z + self.config.z_margin)
+            self.autofocus_moves += result['moves']
+            heights.append(int(round(result['z'])))
+        fl[2], br[2] = heights[0], heights[1]
+        # Saved by multi_scan, unless simulated
+        self.config.update_z_correction_terms(index, heights[2], save=False)
     
+    def capture(self, exp):
+        """
+        Takes the picture of the current slice with the exposure exp. In triggered mode, it is the frame started by
+        the trigger, otherwise the first frame with that exposure taken once the stage settled.
+
+        :return: read-only view of the frame buffer of the camera
+        """
+        self.camera.set_exposure(exp)
+        if not self.camera.triggered:
+            return self.wait_until_exposure(exp, 300)
+        img, _, _ = self.camera.wait_for_frame(after=self.camera.trigger(), timeout=1)
+        if img is None:
+            print('triggered frame not received in 1000ms')
+            img = self.camera.latest_image(copy=False)
+        return img
+
     def wait_until_exposure(self, exp, ms):
-        img = None
-        for i in range(ms//self.frame_duration_ms):
-            img, img_exp = self.camera.latest_image(with_exposure=True)
-            if exp == img_exp:
-                
-                return img
-            else:
-                self.controller.display(img)
-                self.controller.wait(display=False)
-        print(f'desired exposure was not reached in {ms}ms')
+        """
+        Waits for the first frame taken with the exposure exp that started after the stage last settled
+
+        :return: read-only view of the frame buffer of the camera, copy it to keep it for more than a few frames
+        """
+        settled_at = self.stage.settled_at
+        img, img_exp, _ = self.camera.wait_for_frame(
+            lambda exposure, started: int(exposure) == exp and (started is None or started >= settled_at),
+            timeout=ms / 1000)
+        if img is None:
+            print(f'desired exposure was not reached in {ms}ms')
+            img = self.camera.latest_image(copy=False)
         return img
 
     def show_image(self, img):
@@ -321,13 +845,31 @@ class Scanner(object):
                 'language',
                 'layout',
                 'auto_f_stack',
+                'stream_stack',
+                'stack_files',
+                'stacker',
+                'stack_workers',
+                'triggered',
+                'continuous_z',
+                'adaptive_z',
+                'empty_fields',
+                'autofocus',
                 'remove_raw',
                 'auto_quit',
                 'lowest_z',
                 'exposure (µs)',
                 'stack height (µm)',
                 'XY_step (µm)',
-                'stack_step (µm)'
+                'stack_step (µm)',
+                'phase times (s)',
+                'autofocus moves',
+                'adaptive z',
+                'empty fields',
+                'focus maps',
+                'scan order',
+                'planned travel (s)',
+                'motion model',
+                'image writer'
             ]
             for param in param_list:
                 summary.write(f"{param} = {self.summary[param]}\n")
@@ -341,14 +883,15 @@ class Scanner(object):
                 exp_count = len(self.multi_exp)
             summary.write('Here are statistics about the scans.')
             for n in range(len(deltas)):
-                scan = self.config.scans[n]
+                number = self.summary['scan order'][n]
+                scan = self.config.scans[number - 1]
                 steps_x, steps_y = self.step_nbr_xy(scan)
                 stack_nbr = steps_x * steps_y
                 pic_nbr = stack_nbr * self.stack_count
                 total_pics += pic_nbr
                 h, m, s = s2hms(deltas[n].seconds)
                 summary.write(
-                    f"scan{n + 1} started at {dates[n]}, lasted {h}h {m}min {s}s and took :\n"
+                    f"scan{number} started at {dates[n]}, lasted {h}h {m}min {s}s and took :\n"
                     f"{stack_nbr} stacks x {exp_count} exposures x {self.stack_count} heights = {pic_nbr} pictures.\n\n"
                 )
             delta = dates[-1] - dates[0]
@@ -0,0 +1,319 @@
+"""
+Simulated stage and camera, to run the scanner without the rig (e.g. to benchmark it)
+
+The stage talks to a model of the printer firmware instead of a serial port: moves are queued and take the time
+given by their feed rate and acceleration, M400 holds the following commands until the moves are done, M118 echoes
+its text and M114 reports the position along the current move. The camera renders particles lying on a floor,
+blurred according to their distance to the focal plane (the Z of the stage), at a fixed frame rate.
+"""
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from sashimi.camera import Camera, FrameRing
+from sashimi.motion import AXES, move_duration
+from sashimi.stage import Stage
+
+MOVE_PATTERN = re.compile(r"([XYZF])\s*(-?\d+\.?\d*)")
+
+
+class SimulatedSerial(object):
+    """
+    Serial port of a Marlin-like printer. Replies only become readable once the firmware has had time to send them.
+
+    :param latency: time taken by the firmware to process a command and reply, in seconds
+    :param acceleration: acceleration of the X, Y and Z axes in mm/s²
+    :param homing_feed: feed rate of G28 in mm/min
+    """
+    def __init__(self, latency=0.002, acceleration=(1000, 1000, 100), homing_feed=3000):
+        self.latency = latency
+        self.acceleration = dict(zip(AXES, acceleration))
+        self.homing_feed = homing_feed
+        self.feed = 3000
+        self.lock = threading.Lock()
+        self.is_open = True
+        # Time at which the firmware can process the next command, and at which the planned moves are done
+        self.ready_at = time.monotonic()
+        self.moves_end = self.ready_at
+        # Planned moves of each axis as (start time, end time, start, end), positions in µm
+        self.moves = {axis: [(0., 0., 0., 0.)] for axis in AXES}
+        # Replies as (time at which they can be read, bytes)
+        self.output = []
+        self.input = b""
+        self.commands = 0
+
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        with self.lock:
+            self.input += data
+            while b"\n" in self.input:
+                line, self.input = self.input.split(b"\n", 1)
+                self._process(line.decode().strip())
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        with self.lock:
+            return sum(len(data) for available, data in self.output if available <= now)
+
+    def read(self, size=1):
+        now = time.monotonic()
+        data = b""
+        with self.lock:
+            while self.output and self.output[0][0] <= now and len(data) < size:
+                available, reply = self.output.pop(0)
+                taken = reply[:size - len(data)]
+                if len(taken) < len(reply):
+                    self.output.insert(0, (available, reply[len(taken):]))
+                data += taken
+        return data
+
+    def position(self, at=None):
+        """
+        :param at: time (time.monotonic), now by default
+        :return: [x, y, z] position of the stage in µm
+        """
+        at = time.monotonic() if at is None else at
+        with self.lock:
+            return [self._axis_position(axis, at) for axis in AXES]
+
+    def target(self):
+        """
+        :return: [x, y, z] position of the stage once the planned moves are done, in µm
+        """
+        with self.lock:
+            return [self.moves[axis][-1][3] for axis in AXES]
+
+    def _axis_position(self, axis, at):
+        position = self.moves[axis][0][2]
+        for start, end, origin, target in self.moves[axis]:
+            if at < start:
+                break
+            position = target if at >= end else origin + (target - origin) * (at - start) / (end - start)
+        return position
+
+    def _reply(self, at, text):
+        self.output.append((at, (text + "\n").encode()))
+
+    def _process(self, line):
+        self.commands += 1
+        now = max(time.monotonic(), self.ready_at) + self.latency
+        self.ready_at = now
+        code, _, arguments = line.partition(" ")
+        if code in ("G0", "G1"):
+            targets = {}
+            for axis, value in MOVE_PATTERN.findall(arguments):
+                if axis == "F":
+                    self.feed = float(value)
+                else:
+                    targets[axis] = float(value) * 1000
+            self._move(now, targets, self.feed)
+        elif code == "G28":
+            self._move(now, {axis: 0. for axis in AXES}, self.homing_feed)
+        elif code == "M400":
+            now = self.ready_at = max(now, self.moves_end)
+        elif code == "M114":
+            x, y, z = [self._axis_position(axis, now) / 1000 for axis in AXES]
+            self._reply(now, f"X:{x:.3f} Y:{y:.3f} Z:{z:.3f} E:0.00 Count X:0 Y:0 Z:0")
+        elif code == "M118":
+            self._reply(now, arguments)
+        self._reply(now, "ok")
+
+    def _move(self, now, targets, feed):
+        start = max(now, self.moves_end)
+        origins = {axis: self._axis_position(axis, start) for axis in targets}
+        distance = np.sqrt(sum((targets[axis] - origins[axis]) ** 2 for axis in targets)) / 1000
+        if distance == 0:
+            return
+        acceleration = min(self.acceleration[axis] for axis in targets)
+        end = start + move_duration(distance, feed, acceleration)
+        for axis in targets:
+            # Only the moves that are not over yet are needed
+            moves = [move for move in self.moves[axis] if move[1] >= now]
+            self.moves[axis] = (moves or self.moves[axis][-1:]) + [(start, end, origins[axis], targets[axis])]
+        self.moves_end = end
+
+
+class SimulatedStage(Stage):
+    """
+    :param serial_options: passed to SimulatedSerial
+    """
+    def __init__(self, controller, port=None, motion=None, **serial_options):
+        super(SimulatedStage, self).__init__(controller, port, motion)
+        self.serial_options = serial_options
+
+    def start(self):
+        self.serial = SimulatedSerial(**self.serial_options)
+        self.start_driver()
+
+
+class SyntheticScene(object):
+    """
+    Textured particles lying on a floor, seen with a shallow depth of field. The particles change with the XY
+    position of the stage.
+
+    :param shape: (rows, columns) of the images
+    :param floor_z: height of the floor in µm
+    :param relief: the tops of the particles are up to this height above the floor, in µm
+    :param depth_of_field: distance to the focal plane (µm) over which the blur increases by one level
+    :param levels: number of blur levels
+    :param particles: number of particles in the field of view
+    :param empty: fraction of the fields of view without any particle
+    :param reference_exposure: exposure (µs) at which the images are rendered unchanged
+    """
+    def __init__(self, shape=(912, 1368), floor_z=2000, relief=400, depth_of_field=40, levels=8, particles=40, empty=0.,
+                 reference_exposure=2000, seed=0):
+        self.shape = tuple(shape)
+        self.floor_z = floor_z
+        self.relief = relief
+        self.depth_of_field = depth_of_field
+        self.levels = levels
+        self.particles = particles
+        self.empty = empty
+        self.reference_exposure = reference_exposure
+        self.seed = seed
+        self.key = None
+        self.heights = None
+        self.ladder = None
+
+    def _generate(self, key):
+        rng = np.random.default_rng([self.seed, key[0] & 0xFFFFFFFF, key[1] & 0xFFFFFFFF])
+        rows, columns = self.shape
+        # Low contrast floor with a fine grain
+        coarse = rng.uniform(90, 130, size=(rows // 32 + 1, columns // 32 + 1, 3)).astype(np.float32)
+        image = cv2.resize(coarse, (columns, rows), interpolation=cv2.INTER_CUBIC)
+        image += 6 * rng.standard_normal(size=image.shape, dtype=np.float32)
+        heights = np.full(self.shape, self.floor_z, dtype=np.float32)
+        particles = 0 if rng.random() < self.empty else self.particles
+        for _ in range(particles):
+            cx, cy = int(rng.integers(columns)), int(rng.integers(rows))
+            axes = (int(rng.integers(10, max(11, rows // 8))), int(rng.integers(10, max(11, rows // 8))))
+            angle = float(rng.uniform(0, 180))
+            color = rng.uniform(30, 230, size=3).astype(np.float32)
+            height = self.floor_z + rng.uniform(0.2, 1) * self.relief
+            # Only the box around the particle is drawn
+            radius = max(axes)
+            y0, y1 = max(cy - radius, 0), min(cy + radius + 1, rows)
+            x0, x1 = max(cx - radius, 0), min(cx + radius + 1, columns)
+            mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.ellipse(mask, (cx - x0, cy - y0), axes, angle, 0, 360, 1, -1)
+            inside = mask.astype(bool)
+            texture = 0.6 + 0.8 * rng.random(size=(int(inside.sum()), 3), dtype=np.float32)
+            image[y0:y1, x0:x1][inside] = color * texture
+            heights[y0:y1, x0:x1][inside] = height
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        # Each level is blurred from the previous one, with the sigma that adds up to the level
+        self.ladder = np.empty((self.levels,) + image.shape, dtype=np.uint8)
+        self.ladder[0] = image
+        for level in range(1, self.levels):
+            self.ladder[level] = cv2.GaussianBlur(self.ladder[level - 1], (0, 0), np.sqrt(2 * level - 1))
+        self.heights = heights
+        self.key = key
+
+    def render(self, x, y, z, exposure):
+        """
+        :return: BGR image seen with the stage at (x, y, z) µm
+        """
+        key = (int(round(x / 100)), int(round(y / 100)))
+        if key != self.key:
+            self._generate(key)
+        level = np.minimum(np.abs(z - self.heights) / self.depth_of_field, self.levels - 1).astype(np.intp)
+        image = np.take_along_axis(self.ladder, level[np.newaxis, :, :, np.newaxis], axis=0)[0]
+        return cv2.convertScaleAbs(image, alpha=exposure / self.reference_exposure)
+
+
+class SimulatedCaptureThread(threading.Thread):
+    """
+    Grabs frames like CaptureThread: a frame takes the longest of the frame period and the exposure, and carries the
+    exposure that was set when it started (as the exposure time chunk does). Free running, the frames follow each
+    other; triggered, each trigger starts exactly one frame.
+    """
+    def __init__(self, camera, controller):
+        super(SimulatedCaptureThread, self).__init__(daemon=True)
+        self.camera = camera
+        self.controller = controller
+        self.frames = camera.frames
+        self.count = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        frame_start = time.monotonic()
+        last = None
+        image = None
+        while not self.stopped.is_set() and not self.controller.quit_requested:
+            if self.camera.triggered:
+                if not self.camera.triggers.acquire(timeout=0.05):
+                    continue
+                frame_start = time.monotonic()
+            exposure = self.camera.exposure
+            period = max(1 / self.camera.fps, exposure / 1e6)
+            # The frame sees the stage where it is halfway through the exposure. The particles are those at the end
+            # of the move, so that they are generated while the stage travels.
+            serial = self.controller.stage.serial
+            z = serial.position(frame_start + exposure / 2e6)[2]
+            x, y = serial.target()[:2]
+            if (x, y, z, exposure) != last:
+                image = self.camera.scene.render(x, y, z, exposure)
+                last = (x, y, z, exposure)
+            delay = frame_start + period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.frames.store(image, exposure, frame_start)
+            self.count += 1
+            frame_start = max(frame_start + period, time.monotonic())
+
+
+class SimulatedCamera(Camera):
+    """
+    :param scene: SyntheticScene rendered by the camera
+    :param fps: maximum frame rate
+    """
+    def __init__(self, controller, scene=None, fps=20):
+        self.image = None
+        self.camera = None
+        self.controller = controller
+        self.capture_thread = None
+        self.frames = FrameRing()
+        self.triggered = False
+        self.triggers = threading.Semaphore(0)
+        self.scene = scene if scene is not None else SyntheticScene()
+        self.fps = fps
+        self.exposure = self.scene.reference_exposure
+        self.gain = 0
+
+    def start(self):
+        self.capture_thread = SimulatedCaptureThread(self, self.controller)
+        self.capture_thread.start()
+
+    def stop(self):
+        self.capture_thread.stopped.set()
+        self.capture_thread.join()
+
+    def set_triggered(self, triggered):
+        self.triggered = triggered
+
+    def trigger(self, timeout_ms=1000):
+        sequence = self.frames.sequence
+        self.triggers.release()
+        return sequence
+
+    def frame_rate(self):
+        return min(self.fps, 1e6 / self.exposure)
+
+    def set_exposure(self, value):
+        self.exposure = value
+
+    def set_gain(self, value):
+        self.gain = value
@@ -0,0 +1,70 @@
+"""
+Stacks saved in a single file
+
+The frames of a stack are saved uncompressed, one after the other, in a .npy file, so that the stackers can memory-map
+it instead of listing and decoding one jpg per slice. The attributes of the stack and of each frame (Z, exposure,
+time) are saved in a JSON file with the same name.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+EXTENSION = ".npy"
+
+
+def metadata_path(path):
+    return os.path.splitext(str(path))[0] + ".json"
+
+
+def is_stack_file(path):
+    return str(path).endswith(EXTENSION) and os.path.isfile(path)
+
+
+class StackFile(object):
+    """
+    Stack file being written, one frame at a time
+
+    :param count: number of frames
+    :param frame_shape: shape of each frame, e.g. (rows, columns, 3)
+    :param attributes: saved in the metadata of the stack
+    """
+    def __init__(self, path, count, frame_shape, dtype=np.uint8, **attributes):
+        self.path = str(path)
+        self.frames = np.lib.format.open_memmap(self.path, mode="w+", dtype=dtype,
+                                                shape=(count,) + tuple(frame_shape))
+        self.metadata = {'count': 0, 'frames': [], **attributes}
+
+    def write(self, index, frame, **attributes):
+        """
+        :param attributes: saved in the metadata of the frame, e.g. z=..., exposure=...
+        """
+        self.frames[index] = frame
+        self.metadata['frames'].append({'index': index, 'time': time.time(), **attributes})
+        self.metadata['count'] = max(self.metadata['count'], index + 1)
+
+    def close(self):
+        """
+        Flushes the frames and saves the metadata. Frames that were not written are left out when reading the file.
+        """
+        self.frames.flush()
+        self.frames = None
+        with open(metadata_path(self.path), "w") as file:
+            json.dump(self.metadata, file, indent=4)
+
+
+def read_stack(path, mmap=True):
+    """
+    :param mmap: memory-map the frames (read only) rather than loading them
+    :return: array of the frames written, metadata dict
+    """
+    with open(metadata_path(path), "r") as file:
+        metadata = json.load(file)
+    frames = np.load(str(path), mmap_mode="r" if mmap else None)
+    return frames[:metadata['count']], metadata
+
+
+def remove_stack(path):
+    os.remove(path)
+    os.remove(metadata_path(path))
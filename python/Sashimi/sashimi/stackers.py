@@ -0,0 +1,178 @@
+"""
+Stackers used to fuse the stacks while scanning
+
+A stacker is called as stacker(images, save_path) on a stack held in memory, or through stack_folder(folder,
+save_path) on a folder of jpg images or a stack file. It writes a single fused image at save_path, whose extension
+is given by the stacker. Stackers are run in the workers of a StackingService, so they must be picklable.
+"""
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import skimage.io as skio
+
+from sashimi import focus_stack, registration, stack_file
+from sashimi.helicon_stack import get_helicon_focus
+from sashimi.stacking_service import load_stack
+
+
+class Stacker(object):
+    """
+    :param z_step: distance between the images of a stack in µm, used by the stackers that output a depth map
+    """
+    name = None
+    # Extension of the fused images, which are written directly in that format
+    extension = ".png"
+    # Whether the stacker reads the images from files rather than from memory
+    needs_files = False
+
+    def __init__(self, z_step=1.0):
+        self.z_step = z_step
+
+    def __call__(self, images, save_path):
+        return self.stack(images, save_path)
+
+    def check(self):
+        """
+        Raises an error if the stacker can not run on this computer
+        """
+        pass
+
+    def stack(self, images, save_path):
+        """
+        :param images: array of shape (images, rows, columns, 3), in RGB
+        :return: optional dict of timings in seconds
+        """
+        raise NotImplementedError
+
+    def stack_folder(self, folder, save_path, remove_raw=False):
+        """
+        :param remove_raw: remove the folder once it is stacked
+        """
+        images = load_stack(folder)
+        if len(images) == 0:
+            raise ValueError(f"No images found in {folder}")
+        timings = self.stack(images, save_path)
+        # A memory-mapped stack file can only be removed once it is closed
+        images = None
+        if remove_raw:
+            remove_raw_stack(folder)
+        return timings
+
+
+class PyramidStacker(Stacker):
+    """
+    Registration followed by laplacian pyramid fusion (see focus_stack.stack_images)
+
+    :param precision: storage of the pyramid levels, one of focus_stack.PRECISIONS
+    :param memory_budget: bytes available to the fusion of a stack, see focus_stack.get_pyramid_fusion
+    """
+    name = "pyramid"
+
+    def __init__(self, z_step=1.0, precision="float64", memory_budget=None):
+        super(PyramidStacker, self).__init__(z_step)
+        if precision not in focus_stack.PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {focus_stack.PRECISIONS}")
+        self.precision = precision
+        self.memory_budget = memory_budget
+
+    def stack(self, images, save_path):
+        return focus_stack.stack_images(images, save_path, precision=self.precision,
+                                        memory_budget=self.memory_budget)
+
+
+class DepthMapStacker(Stacker):
+    """
+    Registration followed by the depth map fusion (see focus_stack.get_depth_map_fusion). The depth map (in µm) and
+    the confidence are saved next to the fused image, as float32 tiff files ending in _depth and _confidence.
+    """
+    name = "depthmap"
+
+    def stack(self, images, save_path):
+        timings = {}
+        start = time.time()
+        fixed_images, shifts = registration.register(images)
+        timings['registration'] = time.time() - start
+
+        start = time.time()
+        fused, depth, confidence = focus_stack.get_depth_map_fusion(fixed_images, self.z_step)
+        timings['fusion'] = time.time() - start
+
+        start = time.time()
+        os.makedirs(os.path.dirname(str(save_path)), exist_ok=True)
+        root = os.path.splitext(str(save_path))[0]
+        skio.imsave(str(save_path), np.asarray(fused, dtype=np.uint8), check_contrast=False)
+        skio.imsave(root + "_depth.tif", depth, check_contrast=False)
+        skio.imsave(root + "_confidence.tif", confidence, check_contrast=False)
+        timings['save'] = time.time() - start
+        return timings
+
+
+class HeliconStacker(Stacker):
+    """
+    Helicon Focus command line (Windows only). The fused image is saved to a tiff file, then converted to png.
+    """
+    name = "helicon"
+    needs_files = True
+
+    def check(self):
+        get_helicon_focus()
+
+    def stack(self, images, save_path):
+        with tempfile.TemporaryDirectory() as folder:
+            for i, image in enumerate(images):
+                skio.imsave(os.path.join(folder, f"Z{i:05d}.jpg"), image, check_contrast=False, quality=90)
+            return self.stack_folder(folder, save_path)
+
+    def stack_folder(self, folder, save_path, remove_raw=False):
+        if stack_file.is_stack_file(folder):
+            # Helicon Focus only reads image files
+            return super(HeliconStacker, self).stack_folder(folder, save_path, remove_raw)
+        os.makedirs(os.path.dirname(str(save_path)), exist_ok=True)
+        timings = {}
+        start = time.time()
+        tiff_path = os.path.splitext(str(save_path))[0] + ".tiff"
+        command = [get_helicon_focus(), "-silent", f"{folder}", "-mp:0", "-rp:4", f"-save:{tiff_path}"]
+        subprocess.run(command, check=True)
+        timings['fusion'] = time.time() - start
+
+        start = time.time()
+        skio.imsave(str(save_path), skio.imread(tiff_path), check_contrast=False)
+        os.remove(tiff_path)
+        timings['save'] = time.time() - start
+        if remove_raw:
+            remove_raw_stack(folder)
+        return timings
+
+
+def remove_raw_stack(folder):
+    """
+    Removes a stack file or a folder of images, and the XY folder holding it once its last exposure folder is removed
+    """
+    if stack_file.is_stack_file(folder):
+        stack_file.remove_stack(folder)
+        return
+    folder = os.path.normpath(str(folder))
+    shutil.rmtree(folder)
+    if re.fullmatch(r"E[\d.]+", os.path.basename(folder)):
+        try:
+            # Only removes the XY folder once it is empty
+            os.rmdir(os.path.dirname(folder))
+        except OSError:
+            pass
+
+
+STACKERS = {stacker.name: stacker for stacker in (PyramidStacker, DepthMapStacker, HeliconStacker)}
+
+
+def get_stacker(name, **options):
+    """
+    :param options: passed to the stacker, e.g. z_step
+    """
+    if name not in STACKERS:
+        raise ValueError(f"Unknown stacker '{name}', expected one of {list(STACKERS)}")
+    return STACKERS[name](**options)
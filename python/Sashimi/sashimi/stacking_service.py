@@ -0,0 +1,269 @@
+"""
+Pool of stacking processes fed through shared memory
+
+The pool has a fixed number of workers that live as long as the service. Stacks captured in memory are written
+into shared memory blocks (see StackingService.allocate) which the workers map directly, so the frames are
+neither pickled nor re-decoded. Stacks already saved on disk can also be submitted by folder (or stack file, see
+stack_file.py).
+
+Each task returns a result dict to the parent with the worker name, the keyword arguments it was submitted with,
+the timings of each step (in seconds) and the error message if the stacker failed. Each task is handed to the
+worker with the fewest tasks through its own queue, so that if a worker dies (e.g. killed when out of memory), the
+tasks it was given fail with an error instead of being waited for.
+"""
+import os
+import time
+import queue
+import multiprocessing as mp
+from glob import glob
+from multiprocessing import shared_memory
+
+import numpy as np
+import skimage.io as skio
+
+from sashimi import stack_file
+
+# Time between two checks that the workers are still alive while waiting for a result, in seconds
+POLL_INTERVAL = 1.
+
+
+def load_stack(folder):
+    """
+    :param folder: folder of jpg images, or stack file (which is memory-mapped)
+    """
+    if stack_file.is_stack_file(folder):
+        return stack_file.read_stack(folder)[0]
+    fns = sorted(glob(os.path.join(folder, "*.jpg")))
+    return np.asarray([skio.imread(fn) for fn in fns])
+
+
+class SharedStack(object):
+    """
+    Stack of frames held in a shared memory block
+    """
+    def __init__(self, shape, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def truncate(self, count):
+        """
+        Only the first count frames are stacked, e.g. when the stack ended early
+        """
+        self.shape = (count,) + self.shape[1:]
+        self.array = self.array[:count]
+
+    def release(self):
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def stacking_worker(name, stacker, tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        start = time.time()
+        result = {'id': task['id'], 'worker': name, 'kwargs': task['kwargs'], 'error': None,
+                  'timings': {'queued': start - task['submitted']}}
+        shm = None
+        images = None
+        try:
+            if task['folder'] is not None and hasattr(stacker, 'stack_folder'):
+                # The stacker reads the folder itself
+                timings = stacker.stack_folder(task['folder'], **task['kwargs'])
+            else:
+                if task['folder'] is not None:
+                    images = load_stack(task['folder'])
+                    if len(images) == 0:
+                        raise ValueError(f"No images found in {task['folder']}")
+                else:
+                    shm = shared_memory.SharedMemory(name=task['shm'])
+                    images = np.ndarray(task['shape'], dtype=task['dtype'], buffer=shm.buf)
+                result['timings']['load'] = time.time() - start
+                timings = stacker(images, **task['kwargs'])
+            if timings is not None:
+                result['timings'].update(timings)
+        except Exception as e:
+            result['error'] = f"{type(e).__name__}: {e}"
+        finally:
+            images = None
+            if shm is not None:
+                shm.close()
+        result['timings']['total'] = time.time() - start
+        results.put(result)
+
+
+class StackingService(object):
+    """
+    :param stacker: module level function (or picklable object, see stackers.py) called in the workers as
+        stacker(images, **kwargs). It may return a dict of timings, which is added to the task result. Folders are
+        passed to stacker.stack_folder(folder, **kwargs) instead when the stacker has that method.
+    :param workers: number of worker processes, defaults to half the number of CPUs
+    :param max_pending: maximum number of tasks in flight. submit() blocks until a task finishes beyond that,
+        which bounds the shared memory used. Defaults to twice the number of workers.
+    """
+    def __init__(self, stacker, workers=None, max_pending=None):
+        if workers is None:
+            workers = max(mp.cpu_count() // 2, 1)
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else 2 * workers
+        # Spawned rather than forked, as the parent runs the capture thread and the GUI
+        context = mp.get_context("spawn")
+        self.finished = context.Queue()
+        # Task and shared stack of each task in flight, by id
+        self.pending = {}
+        self.next_id = 0
+        self.processes = []
+        # Task queue of each worker, the workers still alive and the ids of the tasks handed to each of them
+        self.tasks = []
+        self.alive = {}
+        self.assigned = {}
+        for i in range(workers):
+            self.tasks.append(context.Queue())
+            process = context.Process(target=stacking_worker, args=(f"P{i}", stacker, self.tasks[i], self.finished),
+                                      daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.alive[i] = process
+            self.assigned[i] = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def allocate(self, shape, dtype=np.uint8):
+        """
+        Shared stack that can be filled in place (e.g. one slice at a time during capture) and then submitted
+        """
+        return SharedStack(shape, dtype)
+
+    def submit(self, frames, **kwargs):
+        """
+        Queues a stack of frames. Arrays are copied into shared memory, SharedStacks are handed over as they are
+        and released once stacked.
+
+        :return: list of the results that finished meanwhile
+        """
+        shared = frames if isinstance(frames, SharedStack) else None
+        try:
+            if shared is None:
+                frames = np.asarray(frames)
+                shared = SharedStack(frames.shape, frames.dtype)
+                shared.array[:] = frames
+            task = self._task(kwargs)
+            task.update(shm=shared.name, shape=shared.shape, dtype=shared.dtype.str)
+            return self._put(task, shared)
+        except BaseException:
+            # Released here unless it was handed over to the workers
+            if shared is not None and all(pending is not shared for _, pending in self.pending.values()):
+                shared.release()
+            raise
+
+    def submit_folder(self, folder, **kwargs):
+        """
+        Queues a folder of jpg images or a stack file, which is loaded by the worker
+        """
+        task = self._task(kwargs)
+        task['folder'] = str(folder)
+        return self._put(task, None)
+
+    def results(self, block=False):
+        """
+        :param block: wait for at least one task to finish if any are pending
+        :return: list of the result dicts of the tasks that have finished
+        """
+        finished = []
+        while self.pending:
+            wait = block and not finished
+            try:
+                result = self.finished.get(block=wait, timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not wait:
+                    break
+                finished.extend(self._check_workers())
+                continue
+            # Unless the task already failed as its worker died
+            if result['id'] in self.pending:
+                finished.append(self._finish(result))
+        return finished
+
+    def close(self):
+        """
+        Waits for all the tasks to finish and stops the workers
+
+        :return: list of the results not collected yet
+        """
+        finished = []
+        while self.pending:
+            finished.extend(self.results(block=True))
+        for i in self.alive:
+            self.tasks[i].put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        return finished
+
+    def _check_workers(self):
+        """
+        Fails the tasks handed to each worker that died
+
+        :return: list of the result dicts of the failed tasks
+        """
+        failed = []
+        for i, process in list(self.alive.items()):
+            if process.is_alive():
+                continue
+            del self.alive[i]
+            print(f"!!! ERROR: stacking worker P{i} died with exit code {process.exitcode}")
+            for task_id in sorted(self.assigned.pop(i)):
+                failed.append(self._fail(task_id, f"P{i}", f"worker died with exit code {process.exitcode}"))
+        return failed
+
+    def _fail(self, task_id, worker, error):
+        task = self.pending[task_id][0]
+        return self._finish({'id': task_id, 'worker': worker, 'kwargs': task['kwargs'], 'error': error,
+                             'timings': {'total': time.time() - task['submitted']}})
+
+    def _finish(self, result):
+        for ids in self.assigned.values():
+            ids.discard(result['id'])
+        _, shared = self.pending.pop(result['id'])
+        if shared is not None:
+            shared.release()
+        return result
+
+    def _task(self, kwargs):
+        task = {'id': self.next_id, 'submitted': time.time(), 'kwargs': kwargs, 'folder': None}
+        self.next_id += 1
+        return task
+
+    def _put(self, task, shared):
+        finished = []
+        while len(self.pending) >= self.max_pending:
+            finished.extend(self.results(block=True))
+        self.pending[task['id']] = (task, shared)
+        if not self.alive:
+            finished.append(self._fail(task['id'], None, "no stacking worker left"))
+            return finished
+        i = min(self.alive, key=lambda j: len(self.assigned[j]))
+        self.assigned[i].add(task['id'])
+        self.tasks[i].put(task)
+        finished.extend(self.results())
+        return finished
+
+
+def format_result(result):
+    timings = ", ".join(f"{step} {duration:.2f}s" for step, duration in result['timings'].items())
+    if result['error'] is not None:
+        return f"{result['worker']}: task {result['id']} failed ({result['error']}) after {timings}"
+    return f"{result['worker']}: task {result['id']} done in {timings}"
@@ -1,10 +1,112 @@
+import collections
+import threading
+import time
+from concurrent import futures
+
 import cv2
 import serial
-import time
+
+from sashimi.motion import MotionModel
+
+
+class SerialDriver(threading.Thread):
+    """
+    I/O thread of the stage: sends the queued commands and reads the replies of the firmware
+
+    A few commands are kept ahead in the firmware (its planner queues the moves), the next one being sent when the
+    'ok' of an earlier one is received. Each command gets a future, resolved with the lines received before its 'ok'
+    (e.g. the position given by M114) once it is acknowledged. The replies are read in bulk, as soon as they arrive.
+
+    :param keep_ahead: number of commands sent but not acknowledged yet, at most the size of the command buffer of
+        the firmware (BUFSIZE, 4 in Marlin)
+    :param poll_interval: time between two checks of the serial port, in seconds
+    """
+    def __init__(self, serial_port, keep_ahead=4, poll_interval=0.002):
+        super(SerialDriver, self).__init__(daemon=True)
+        self.serial = serial_port
+        self.keep_ahead = keep_ahead
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        # Commands to send, and commands sent waiting for their ok, with their future
+        self.queued = collections.deque()
+        self.sent = collections.deque()
+        # Lines received before the ok of the oldest command sent
+        self.replies = []
+        # Latest lines that were not replies to a command (e.g. the messages of the firmware when it starts)
+        self.messages = collections.deque(maxlen=100)
+        self.buffer = b""
+        self.stopped = False
+
+    def send(self, command):
+        """
+        :return: future resolved with the list of lines received before the ok of the command
+        """
+        future = futures.Future()
+        with self.condition:
+            self.queued.append((command, future))
+            self.condition.notify()
+        return future
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.join()
+        for _, future in list(self.sent) + list(self.queued):
+            future.cancel()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                commands = []
+                while self.queued and len(self.sent) < self.keep_ahead:
+                    command, future = self.queued.popleft()
+                    self.sent.append((command, future))
+                    commands.append(command)
+            if commands:
+                self.serial.write("".join(command + "\n" for command in commands).encode())
+            waiting = self.serial.in_waiting
+            if waiting > 0:
+                self.received(self.serial.read(waiting))
+            elif not commands:
+                with self.condition:
+                    if not self.stopped and not (self.queued and len(self.sent) < self.keep_ahead):
+                        self.condition.wait(self.poll_interval)
+
+    def received(self, data):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            line = line.decode(errors="replace").strip()
+            if not line:
+                continue
+            with self.condition:
+                if line.startswith("ok") and self.sent:
+                    _, future = self.sent.popleft()
+                    replies, self.replies = self.replies, []
+                    self.condition.notify()
+                elif self.sent:
+                    self.replies.append(line)
+                    continue
+                else:
+                    self.messages.append(line)
+                    continue
+            future.set_result(replies)
 
 
 class Stage(object):
-    def __init__(self, controller, port):
+    """
+    :param motion: parameters of the MotionModel predicting the duration of the moves, from the configuration
+    """
+    # Feed rates of the moves in mm/min
+    XY_FEED = 3000
+    Z_FEED = 100
+    # Time allowed on top of twice the predicted duration of the moves before waiting for them fails, in seconds
+    WAIT_MARGIN = 0.5
+
+    def __init__(self, controller, port, motion=None):
         self.controller = controller
         self.port = port
         self.serial: serial.Serial = None
@@ -22,14 +124,28 @@ class Stage(object):
         self.y_limits = (0, 200000)
         self.z_limits = (0, 20000)
 
-        self.buffer = []
+        self.driver: SerialDriver = None
+        # Time (time.monotonic) at which the last wait_until_position saw the moves finish
+        self.settled_at = 0
+        self.motion = MotionModel(motion)
+        # Moves sent since the last settle, as (axis, distance, feed), and time at which the first one was sent
+        self.moves = []
+        self.moves_sent_at = None
+        # Time at which the moves waited for by the last settle should be finished
+        self.expected_at = 0
 
     def start(self):
         self.serial = serial.Serial(self.port, 115200)
         if not self.serial.isOpen():
             self.serial.open()
+        self.start_driver()
+
+    def start_driver(self):
+        self.driver = SerialDriver(self.serial)
+        self.driver.start()
 
     def stop(self):
+        self.driver.stop()
         self.serial.close()
 
     @property
@@ -45,7 +161,8 @@ class Stage(object):
         self.move_y(offset[1])
         self.goto_z(offset[2] + 1000)
         self.goto_z(offset[2])
-        self.wait_until_position(20000)
+        # The duration of the homing is unknown
+        self.wait_until_position(20000, self.settle(observe=False))
 
     def move_x(self, distance_um):
         self.goto_x(self.x + distance_um)
@@ -54,45 +171,54 @@ class Stage(object):
         self.goto_y(self.y + distance_um)
 
     def move_z(self, distance_um):
-        sleep_time = abs(distance_um) / 1000
-        self.goto_z(self.z + distance_um)
-        time.sleep(sleep_time)
+        return self.goto_z(self.z + distance_um)
 
     def goto_x(self, position):
+        previous = self.x
         self.x = position
         if self.x < self.x_limits[0]:
             self.x = self.x_limits[0]
         if self.x > self.x_limits[1]:
             self.x = self.x_limits[1]
-        self.send_command(f"G0 X {self.x / 1000:3f} F3000")
+        self.add_move('X', self.x - previous, self.XY_FEED)
+        return self.send_command(f"G0 X {self.x / 1000:3f} F{self.XY_FEED}")
 
     def goto_y(self, position):
+        previous = self.y
         self.y = position
         if self.y < self.y_limits[0]:
             self.y = self.y_limits[0]
         if self.y > self.y_limits[1]:
             self.y = self.y_limits[1]
-        self.send_command(f"G0 Y {self.y / 1000:3f} F3000")
+        self.add_move('Y', self.y - previous, self.XY_FEED)
+        return self.send_command(f"G0 Y {self.y / 1000:3f} F{self.XY_FEED}")
 
-    def goto_z(self, position):
+    def goto_z(self, position, feed=None):
+        """
+        :param feed: speed of the move in mm/min, Z_FEED by default
+        :return: future of the command, resolved once the move is planned (see settle to wait for the end of the move)
+        """
+        feed = self.Z_FEED if feed is None else feed
+        previous = self.z
         self.z = position
         if self.z < self.z_limits[0]:
             self.z = self.z_limits[0]
         if self.z > self.z_limits[1]:
             self.z = self.z_limits[1]
-        self.send_command(f"G0 Z {self.z / 1000:3f} F100")
+        self.add_move('Z', self.z - previous, feed)
+        return self.send_command(f"G0 Z {self.z / 1000:3f} F{feed:g}")
 
     def goto(self, position):
         self.goto_x(position[0])
         self.goto_y(position[1])
-        self.goto_z(position[2])
+        return self.goto_z(position[2])
 
     def poll(self):
-        dummy = self.read()
-        self.send_command("M114 R")
-        self.controller.wait(100)
-        responses = self.read()
-        for response in responses:
+        reply = self.send_command("M114 R")
+        if not self.wait_for(reply, 1000):
+            print("!!! ERROR: the position was not reported")
+            return
+        for response in reply.result():
             if response.startswith("X:"):
                 parts = response.split(' ')
                 sub_parts = parts[0].split(':')
@@ -102,33 +228,72 @@ class Stage(object):
                 sub_parts = parts[2].split(':')
                 self.reported_z = int(float(sub_parts[1]) * 1000)
 
-    def wait_until_position(self, ms):
-        # tells the printer to finish it's planned movements before executing any other g-code
-        self.send_command('M400')
-        self.send_command("M118 Ready")
-        for i in range(ms//self.controller.frame_duration_ms):
-            self.controller.wait()
-            messages = self.read()
-            for message in messages:
-                if message.startswith('Ready'):
-                    return
-        
-        print(f"!!! ERROR: position not attained after {ms}ms ")
+    def add_move(self, axis, distance, feed):
+        if distance == 0:
+            return
+        if self.moves_sent_at is None:
+            self.moves_sent_at = time.monotonic()
+        self.moves.append((axis, distance, feed))
+
+    def settle(self, observe=True):
+        """
+        :param observe: record the time the moves took, to calibrate the motion model
+        :return: future resolved once the planned moves are finished, without waiting for it
+        """
+        moves, sent_at = self.moves, self.moves_sent_at
+        self.moves, self.moves_sent_at = [], None
+        # The printer finishes its planned movements before executing any other g-code, and acknowledges M400 then
+        settling = self.send_command('M400')
+        sent_at = time.monotonic() if sent_at is None else sent_at
+        self.expected_at = sent_at + self.motion.duration(moves)
+
+        def settled(future):
+            if observe and not future.cancelled():
+                self.motion.observe(moves, time.monotonic() - sent_at)
+
+        settling.add_done_callback(settled)
+        return settling
+
+    def wait_until_position(self, ms=None, settling=None):
+        """
+        Waits until the planned moves are finished
+
+        :param ms: time after which the wait fails, by default twice the duration predicted by the motion model plus
+            WAIT_MARGIN
+        :param settling: future returned by settle when it was already called, to wait for it
+        :return: whether the moves finished in time
+        """
+        settling = self.settle() if settling is None else settling
+        if ms is None:
+            ms = int(1000 * (2 * max(self.expected_at - time.monotonic(), 0) + self.WAIT_MARGIN))
+        if not self.wait_for(settling, ms):
+            print(f"!!! ERROR: position not attained after {ms}ms ")
+            return False
+        self.settled_at = time.monotonic()
+        return True
+
+    def wait_for(self, future, ms):
+        """
+        Waits for the future of a command, keeping the window responsive if it takes more than a frame
+
+        :return: whether the command was acknowledged within ms
+        """
+        deadline = time.monotonic() + ms / 1000
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                future.result(max(min(remaining, self.controller.frame_duration_ms / 1000), 0))
+                return True
+            except futures.TimeoutError:
+                if remaining <= 0:
+                    return False
+            if not self.controller.headless:
+                self.controller.wait()
 
     def send_command(self, command):
-        self.serial.write((command + "\n").encode())
-        # print((command + "\n").encode())
-
-    def read(self):
-        lines = []
-        while self.serial.in_waiting > 0:
-            for b in self.serial.read():
-                if b != ord('\n') and b != ord('\r'):
-                    self.buffer.append(chr(b))
-                else:
-                    line = ''.join(self.buffer)
-                    print(line)
-                    lines.append(line)
-                    self.buffer = []
-        # print(lines)
-        return lines
+        """
+        Queues a command, without waiting for it to be sent
+
+        :return: future resolved with the lines replied by the firmware once it acknowledges the command
+        """
+        return self.driver.send(command)
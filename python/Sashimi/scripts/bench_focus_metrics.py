@@ -0,0 +1,47 @@
+"""
+Times the focus operators of focus_metrics on a frame of the simulated camera, against the per-channel gradient the
+scanner used before
+"""
+import argparse
+import time
+
+import numpy as np
+
+from sashimi import focus_metrics, simulation
+
+
+def per_channel_gradient(img):
+    img = img[::4, ::4, ...].astype(np.float32)
+    sharpness = []
+    for i in range(3):
+        dx = np.diff(img, axis=1)[1:, :, i]
+        dy = np.diff(img, axis=0)[:, 1:, i]
+        sharpness.append(np.average(np.sqrt(dx ** 2 + dy ** 2)))
+    return float(np.mean(sharpness))
+
+
+def timed(function, *args, repeats=20, **kwargs):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1824)
+    parser.add_argument("--columns", type=int, default=2736)
+    parser.add_argument("--step", type=int, default=4, help="decimation of the frame")
+    args = parser.parse_args()
+
+    img = simulation.SyntheticScene(shape=(args.rows, args.columns)).render(0, 0, 2000, 2000)
+    print(f"frame of {args.rows}x{args.columns}, decimated by {args.step}")
+    duration = timed(per_channel_gradient, img)
+    print(f"{'per channel gradient, by 4':<26} {1000 * duration:7.2f}ms {1 / duration:8.0f} frames/s")
+    duration = timed(focus_metrics.grey_view, img, args.step)
+    print(f"{'grey_view':<26} {1000 * duration:7.2f}ms {1 / duration:8.0f} frames/s")
+    for operator in focus_metrics.OPERATORS:
+        duration = timed(focus_metrics.sharpness, img, operator, args.step)
+        print(f"{operator:<26} {1000 * duration:7.2f}ms {1 / duration:8.0f} frames/s")
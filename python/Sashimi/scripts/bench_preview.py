@@ -0,0 +1,51 @@
+"""
+Times the rendering of a preview frame by preview.Preview, against decimating, padding and drawing the whole side
+panel on every frame as the window did before
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from sashimi import simulation
+from sashimi.preview import Preview
+
+
+def redraw_everything(img, buttons, status):
+    im = img[::4, ::4, :].astype(np.uint8)
+    im = np.pad(im, [[0, 0], [300, 0], [0, 0]])
+    for i, t in enumerate(status):
+        cv2.putText(im, t, (50, i * 20 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (230, 230, 255), 1, cv2.LINE_AA)
+    for i, t in enumerate(buttons):
+        cv2.putText(im, t, (10, i * 20 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (120, 255, 255), 1, cv2.LINE_AA)
+    return im
+
+
+def timed(function, *args, repeats=50, **kwargs):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(*args, **kwargs)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1824)
+    parser.add_argument("--columns", type=int, default=2736)
+    args = parser.parse_args()
+
+    img = simulation.SyntheticScene(shape=(args.rows, args.columns)).render(0, 0, 2000, 2000)
+    buttons = [f"{i}" for i in range(25)]
+    status = [f"STATUS LINE {i}: [10000, 50000, 2000]" for i in range(25)]
+    print(f"frame of {args.rows}x{args.columns}, 25 lines of panel")
+    duration = timed(redraw_everything, img, buttons, status)
+    print(f"{'redrawn every frame':<26} {1000 * duration:7.2f}ms")
+    preview = Preview()
+    duration = timed(preview.render, img, None, buttons, status)
+    print(f"{'preview, same panel':<26} {1000 * duration:7.2f}ms")
+    moving = [status[:1] + [f"[X, Y, Z]: {[i, 50000, 2000]}"] + status[2:] for i in range(50)]
+    start = time.perf_counter()
+    for lines in moving:
+        preview.render(img, None, buttons, lines)
+    print(f"{'preview, one line changed':<26} {1000 * (time.perf_counter() - start) / len(moving):7.2f}ms")
@@ -0,0 +1,55 @@
+"""
+Compares the registration module with focus_stack.phase_correction on a synthetic stack with known shifts
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from sashimi import focus_stack, registration
+
+
+def synthetic_stack(count, rows, columns, seed=0):
+    rng = np.random.default_rng(seed)
+    base = cv2.GaussianBlur(rng.integers(0, 256, size=(rows, columns, 3)).astype(np.uint8), (0, 0), 2)
+    shifts = np.cumsum(rng.uniform(-3, 3, size=(count, 2)), axis=0)
+    shifts -= shifts[0]
+    images = []
+    for dx, dy in shifts:
+        M = np.float32([[1, 0, -dx], [0, 1, -dy]])
+        images.append(cv2.warpAffine(base, M, (columns, rows), borderMode=cv2.BORDER_REFLECT))
+    return np.asarray(images), shifts
+
+
+def timed(function, *args, repeats=3, **kwargs):
+    best = np.inf
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=1824)
+    parser.add_argument("--columns", type=int, default=2736)
+    args = parser.parse_args()
+
+    images, true_shifts = synthetic_stack(args.count, args.rows, args.columns)
+    print(f"{args.count} images of {args.rows}x{args.columns}")
+
+    _, duration = timed(focus_stack.phase_correction, images)
+    print(f"phase_correction:              {duration:.3f}s")
+
+    shifts, duration = timed(registration.estimate_shifts, images)
+    error = np.abs(shifts - true_shifts).max()
+    print(f"registration.estimate_shifts:  {duration:.3f}s (max error {error:.2f}px)")
+
+    _, duration = timed(registration.apply_shifts, images, shifts)
+    print(f"registration.apply_shifts:     {duration:.3f}s (integer)")
+    _, duration = timed(registration.apply_shifts, images, shifts, subpixel=True)
+    print(f"registration.apply_shifts:     {duration:.3f}s (subpixel)")
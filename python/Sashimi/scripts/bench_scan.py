@@ -0,0 +1,86 @@
+"""
+Runs a scan with the simulated camera and stage, and reports the throughput and the time spent in each phase
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from sashimi import focus_stack, simulation, stackers
+from sashimi.controller import Controller
+
+
+def run(args, save_dir):
+    controller = Controller(save_dir, None, auto_f_stack=not args.skip_fs, stream_stack=args.stream_fs,
+                            stack_files=args.stack_files, stacker=args.stacker, stack_workers=args.workers,
+                            fusion_precision=args.precision,
+                            memory_budget=None if args.memory is None else args.memory * 1e9,
+                            remove_raw=args.remove_raw, triggered=args.triggered, continuous_z=args.continuous_z,
+                            autofocus=args.autofocus, adaptive_z=args.adaptive_z,
+                            empty_fields=args.empty_fields, simulate=True, headless=True)
+    # The configuration is only changed in memory, the saved one is left untouched
+    config = controller.config
+    scanner = controller.scanner
+    config.stack_height = args.height
+    config.stack_step = args.step
+    fl = [10000, 50000, 2000]
+    br = [fl[0] + scanner.X_STEP * (args.columns - 1) + 1, fl[1] + scanner.Y_STEP * (args.rows - 1) + 1, 2000]
+    config.scans = [{'FL': fl, 'BR': br, 'BL_Z': 2000, 'Z_corrections': [0, 0]}]
+    scanner.update_stack_count()
+    controller.camera.scene = simulation.SyntheticScene(shape=(args.image_rows, args.image_columns), empty=args.empty)
+    controller.camera.fps = args.fps
+
+    controller.stage.start()
+    controller.camera.start()
+    controller.camera.set_exposure(config.exposure_time)
+    start = time.time()
+    scanner.multi_scan()
+    duration = time.time() - start
+    controller.camera.stop()
+    controller.stage.stop()
+    return scanner, duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2, help="stacks along Y")
+    parser.add_argument("--columns", type=int, default=2, help="stacks along X")
+    parser.add_argument("--height", type=int, default=600, help="stack height in µm")
+    parser.add_argument("--step", type=int, default=60, help="stack step in µm")
+    parser.add_argument("--image-rows", type=int, default=912)
+    parser.add_argument("--image-columns", type=int, default=1368)
+    parser.add_argument("--fps", type=float, default=20)
+    parser.add_argument("--stacker", choices=list(stackers.STACKERS), default="pyramid")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--precision", choices=list(focus_stack.PRECISIONS), default="float64")
+    parser.add_argument("--memory", type=float, default=None, help="memory available to the fusion of a stack in GB")
+    parser.add_argument("--skip-fs", action="store_true")
+    parser.add_argument("--stream-fs", action="store_true")
+    parser.add_argument("--remove-raw", action="store_true")
+    parser.add_argument("--stack-files", action="store_true")
+    parser.add_argument("--triggered", action="store_true", help="one software triggered frame per slice")
+    parser.add_argument("--continuous-z", action="store_true", help="Z moves without stopping through each stack")
+    parser.add_argument("--autofocus", choices=["tile", "corners", "map"], default=None)
+    parser.add_argument("--adaptive-z", action="store_true", help="leaves out the slices showing nothing in focus")
+    parser.add_argument("--empty-fields", choices=["skip", "single"], default=None)
+    parser.add_argument("--empty", type=float, default=0., help="fraction of the fields of view without particles")
+    parser.add_argument("--verbose", action="store_true", help="shows the output of the scanner")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.devnull, "w") as devnull:
+            with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull):
+                scanner, duration = run(args, Path(folder).joinpath("scan"))
+
+    frames = scanner.current_pic_count
+    stacks = args.rows * args.columns
+    print(f"{stacks} stacks of {scanner.stack_count} images of {args.image_rows}x{args.image_columns} "
+          f"in {duration:.1f}s")
+    print(f"{frames / duration:.2f} frames/s, {stacks * 3600 / duration:.0f} stacks/hour")
+    stats = scanner.image_writer.stats()
+    print(f"{stats['written']} pictures written in {stats['encode_time']:.2f}s (maximum queue depth "
+          f"{stats['max_depth']}, {stats['wait_time']:.2f}s waiting for the queue)")
+    for phase, phase_duration in sorted(scanner.phase_times.items(), key=lambda item: -item[1]):
+        print(f"{phase:<10} {phase_duration:7.2f}s {100 * phase_duration / duration:5.1f}%")
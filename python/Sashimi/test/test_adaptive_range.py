@@ -0,0 +1,48 @@
+import pytest
+
+from sashimi import adaptive_range, simulation
+from sashimi.scanner import measure_sharpness
+
+
+def run(values, **kwargs):
+    tracker = adaptive_range.AdaptiveRange(**kwargs)
+    for value in values:
+        tracker.add(value)
+        if tracker.stopped:
+            break
+    return tracker.finish(), len(tracker.values), tracker.stopped
+
+
+def test_leading_empty_slices_are_skipped_and_the_stack_ends_after_the_peak():
+    values = [7, 7.1, 7, 7.2, 9, 14, 17, 16, 12, 9, 7.5, 7, 7, 7]
+    first, taken, stopped = run(values)
+    # The slice before the rise is kept
+    assert first == 3
+    assert stopped and taken == 10
+
+
+def test_a_stack_starting_in_focus_keeps_its_first_slices():
+    first, taken, stopped = run([17, 15, 12, 9, 4, 3, 3])
+    assert first == 0
+    assert stopped and taken == 5
+
+
+def test_an_empty_field_is_kept_whole():
+    assert run([7, 7.1, 6.9, 7, 7.2, 7]) == (0, 6, False)
+
+
+def test_invalid_parameters():
+    with pytest.raises(ValueError):
+        adaptive_range.AdaptiveRange(drop=1)
+    with pytest.raises(ValueError):
+        adaptive_range.AdaptiveRange(rise=0.9)
+
+
+def test_on_the_simulated_scene():
+    scene = simulation.SyntheticScene(shape=(120, 160), floor_z=2000, relief=400, particles=10)
+    heights = list(range(1500, 3100, 60))
+    first, taken, stopped = run([measure_sharpness(scene.render(0, 0, z, 2000)) for z in heights])
+    assert stopped
+    # The slices kept cover the floor and the particles
+    assert 1500 < heights[first] < 2000
+    assert 2400 <= heights[taken - 1] < 3000
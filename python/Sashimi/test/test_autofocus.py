@@ -0,0 +1,30 @@
+import numpy as np
+
+from sashimi import autofocus, simulation
+from sashimi.scanner import measure_sharpness
+
+
+def test_autofocus_finds_the_peak_in_a_few_moves():
+    heights = []
+
+    def measure(z):
+        heights.append(z)
+        return np.exp(-((z - 1234) / 150) ** 2)
+
+    result = autofocus.autofocus(measure, 100, 2100, coarse_step=100, tolerance=10)
+    assert abs(result['z'] - 1234) < 5
+    # The coarse pass stopped well before the top of the range
+    assert max(heights) < 1700
+    assert result['moves'] == len(heights) == len(set(heights)) < 25
+
+
+def test_parabola_vertex():
+    assert autofocus.parabola_vertex((0, 1, 2), (0, 1, 0)) == 1
+    assert autofocus.parabola_vertex((0, 1, 2), (1, 0, 1)) is None
+
+
+def test_autofocus_on_the_simulated_scene():
+    scene = simulation.SyntheticScene(shape=(120, 160), floor_z=1500, relief=0, particles=5)
+    result = autofocus.autofocus(lambda z: measure_sharpness(scene.render(0, 0, z, 2000)),
+                                 1000, 2000, coarse_step=120, tolerance=30)
+    assert abs(result['z'] - 1500) <= scene.depth_of_field
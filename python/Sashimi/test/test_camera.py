@@ -0,0 +1,61 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from sashimi.camera import FrameRing
+
+
+def test_frame_ring_hands_out_views():
+    ring = FrameRing(slots=3)
+    assert ring.latest() == (None, None, -1)
+    images = np.arange(5 * 4 * 6 * 3, dtype=np.uint8).reshape((5, 4, 6, 3))
+    ring.store(images[0], 1000, rotate=True)
+    frame, exposure, sequence = ring.latest()
+    np.testing.assert_array_equal(frame, images[0][::-1, ::-1])
+    assert exposure == 1000 and sequence == 0
+    assert np.shares_memory(frame, ring.frames)
+    with pytest.raises(ValueError):
+        frame[0, 0, 0] = 0
+    for image in images[1:3]:
+        ring.store(image, 2000)
+    assert ring.is_current(0)
+    ring.store(images[3], 2000)
+    # The first slot was written again
+    assert not ring.is_current(0)
+    frame, exposure, sequence = ring.latest()
+    np.testing.assert_array_equal(frame, images[3])
+    assert sequence == 3 and ring.is_current(3)
+
+
+def test_frame_ring_waits_for_matching_frame():
+    ring = FrameRing(slots=4)
+    image = np.zeros((4, 6, 3), dtype=np.uint8)
+
+    def capture():
+        for i, exposure in enumerate((1000, 1000, 2000, 2000)):
+            time.sleep(0.01)
+            ring.store(image + i, exposure, started=float(i))
+
+    thread = threading.Thread(target=capture)
+    thread.start()
+    frame, exposure, sequence = ring.wait_for(lambda exposure, started: exposure == 2000 and started >= 3,
+                                              timeout=5)
+    thread.join()
+    assert exposure == 2000 and sequence == 3
+    assert frame[0, 0, 0] == 3
+    # Frames already published are checked before waiting
+    assert ring.wait_for(lambda exposure, started: exposure == 1000, after=0, timeout=0)[2] == 1
+    assert ring.wait_for(after=3, timeout=0.01) == (None, None, -1)
+
+
+def test_frame_ring_start_times():
+    ring = FrameRing(slots=2)
+    image = np.zeros((4, 6, 3), dtype=np.uint8)
+    for started in (1., 2., 3.):
+        ring.store(image, 1000, started)
+    assert ring.started(2) == 3. and ring.started(1) == 2.
+    # Overwritten
+    assert ring.started(0) is None
+    assert ring.started(-1) is None
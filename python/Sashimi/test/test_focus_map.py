@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from sashimi import focus_map
+
+
+def plane(x, y):
+    return 1000 + 0.01 * x - 0.02 * y
+
+
+def samples_of(surface, columns=3, rows=3):
+    scan = {'FL': [1000, 2000, 0], 'BR': [21000, 12000, 0]}
+    return [(x, y, surface(x, y)) for x, y in focus_map.grid_points(scan, columns, rows)]
+
+
+def test_grid_points_are_in_serpentine_order():
+    scan = {'FL': [0, 0, 0], 'BR': [200, 100, 0]}
+    assert focus_map.grid_points(scan, 3, 2) == [(0, 0), (100, 0), (200, 0), (200, 100), (100, 100), (0, 100)]
+
+
+@pytest.mark.parametrize("method", focus_map.METHODS)
+def test_a_plane_is_mapped_exactly(method):
+    surface = focus_map.FocusMap(samples_of(plane), method)
+    assert surface(5000, 7000) == pytest.approx(plane(5000, 7000))
+    x, y = np.array([1000, 21000]), np.array([2000, 12000])
+    assert surface(x, y) == pytest.approx(plane(x, y))
+    assert surface.error == pytest.approx(0, abs=1e-6)
+    assert surface.margin(20, 500) == 20
+
+
+def test_the_margin_follows_the_error():
+    surface = focus_map.FocusMap(samples_of(lambda x, y: plane(x, y) + 50 * np.sin(x / 3000)), "thin_plate")
+    assert surface.error > 1
+    assert surface.margin(20, 500) == min(max(int(np.ceil(3 * surface.error)), 20), 500)
+    assert surface.margin(20, 30) <= 30
+
+
+def test_round_trip_and_invalid_maps():
+    surface = focus_map.FocusMap(samples_of(plane), "bilinear")
+    copy = focus_map.FocusMap.from_dict(surface.to_dict())
+    assert copy(3000, 4000) == pytest.approx(surface(3000, 4000), abs=0.1)
+    with pytest.raises(ValueError):
+        focus_map.FocusMap(samples_of(plane)[:-1], "bilinear")
+    with pytest.raises(ValueError):
+        focus_map.FocusMap(samples_of(plane), "cubic")
@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+import pytest
+
+from sashimi import focus_metrics, simulation
+
+
+@pytest.mark.parametrize("operator", focus_metrics.OPERATORS)
+def test_the_sharpness_peaks_at_the_focus(operator):
+    scene = simulation.SyntheticScene(shape=(240, 320), floor_z=2000, relief=0, particles=10)
+    heights = [1700, 1850, 2000, 2150, 2300]
+    values = [focus_metrics.sharpness(scene.render(0, 0, z, 2000), operator) for z in heights]
+    assert np.argmax(values) == 2
+    assert values[0] < values[1] < values[2] > values[3] > values[4]
+
+
+@pytest.mark.parametrize("operator", focus_metrics.OPERATORS)
+def test_differences_do_not_wrap_around(operator):
+    ramp = np.tile(np.arange(0, 256, 8, dtype=np.uint8), (32, 1))
+    assert focus_metrics.sharpness(ramp, operator, step=1) == pytest.approx(
+        focus_metrics.sharpness(ramp[:, ::-1], operator, step=1), rel=1e-5)
+
+
+def test_grey_view_of_a_region():
+    img = np.zeros((100, 120, 3), dtype=np.uint8)
+    img[20:60, 40:100] = (30, 60, 90)
+    grey = focus_metrics.grey_view(img, step=2, roi=(40, 20, 60, 40))
+    assert grey.dtype == np.float32 and grey.shape == (20, 30)
+    assert np.all(grey == 60)
+
+
+def test_the_normalised_gradient_does_not_change_with_the_exposure():
+    scene = simulation.SyntheticScene(shape=(240, 320))
+    img = scene.render(0, 0, 2000, 2000)
+    darker = cv2.convertScaleAbs(img, alpha=0.5)
+    assert focus_metrics.sharpness(darker, "gradient") == pytest.approx(focus_metrics.sharpness(img, "gradient"),
+                                                                        rel=0.05)
+    with pytest.raises(ValueError):
+        focus_metrics.sharpness(img, "sobel")
@@ -0,0 +1,231 @@
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+
+from sashimi import focus_stack as fs
+
+# The windowed statistics are computed from sliding sums rather than per window,
+# so they only agree with the per-pixel reference to within float64 rounding
+TOLERANCE = 1e-6
+
+
+def _reference_entropy(image, kernel_size):
+    probabilities = fs.get_probabilities(image)
+    pad_amount = int((kernel_size - 1) / 2)
+    padded_image = cv2.copyMakeBorder(image, pad_amount, pad_amount, pad_amount, pad_amount, cv2.BORDER_REFLECT101)
+    entropies = np.zeros(image.shape[:2], dtype=np.float64)
+    offset = np.arange(-pad_amount, pad_amount + 1)
+    for row in range(entropies.shape[0]):
+        for column in range(entropies.shape[1]):
+            levels = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset].flatten()
+            entropies[row, column] = -1. * (levels * np.log(probabilities[levels])).sum()
+    return entropies
+
+
+def _reference_deviation(image, kernel_size):
+    pad_amount = int((kernel_size - 1) / 2)
+    padded_image = cv2.copyMakeBorder(image, pad_amount, pad_amount, pad_amount, pad_amount, cv2.BORDER_REFLECT101)
+    deviations = np.zeros(image.shape[:2], dtype=np.float64)
+    offset = np.arange(-pad_amount, pad_amount + 1)
+    for row in range(deviations.shape[0]):
+        for column in range(deviations.shape[1]):
+            area = padded_image[row + pad_amount + offset[:, np.newaxis], column + pad_amount + offset]
+            deviations[row, column] = np.square(area - np.average(area)).sum() / area.size
+    return deviations
+
+
+def _synthetic_stack(count=4, shape=(37, 29), seed=0):
+    rng = np.random.default_rng(seed)
+    images = rng.integers(0, 256, size=(count, *shape, 3)).astype(np.float64)
+    for i in range(count):
+        images[i] = cv2.GaussianBlur(images[i], (0, 0), 0.5 + i)
+    return images
+
+
+def test_entropy_matches_reference():
+    for kernel_size in (3, 5, 7):
+        for image in _synthetic_stack():
+            gray = cv2.cvtColor(image.astype(np.float32), cv2.COLOR_BGR2GRAY).astype(np.uint8)
+            expected = _reference_entropy(gray, kernel_size)
+            np.testing.assert_allclose(fs.entropy(gray, kernel_size), expected, rtol=TOLERANCE, atol=TOLERANCE)
+
+
+def test_deviation_matches_reference():
+    for kernel_size in (3, 5, 7):
+        for image in _synthetic_stack():
+            gray = cv2.cvtColor(image.astype(np.float32), cv2.COLOR_BGR2GRAY).astype(np.uint8)
+            expected = _reference_deviation(gray, kernel_size)
+            np.testing.assert_allclose(fs.deviation(gray, kernel_size), expected, rtol=TOLERANCE, atol=TOLERANCE)
+
+
+def test_fused_base_matches_reference():
+    images = _synthetic_stack()
+    entropies = []
+    deviations = []
+    for image in images:
+        gray = cv2.cvtColor(image.astype(np.float32), cv2.COLOR_BGR2GRAY).astype(np.uint8)
+        entropies.append(_reference_entropy(gray, 5))
+        deviations.append(_reference_deviation(gray, 5))
+    best_e = np.argmax(entropies, axis=0)
+    best_d = np.argmax(deviations, axis=0)
+    expected = np.zeros(images.shape[1:], dtype=np.float64)
+    for layer in range(images.shape[0]):
+        expected += np.where(best_e[:, :, np.newaxis] == layer, images[layer], 0)
+        expected += np.where(best_d[:, :, np.newaxis] == layer, images[layer], 0)
+    expected = expected / 2
+    np.testing.assert_allclose(fs.get_fused_base(images, 5), expected)
+
+
+def test_separable_pyramid_matches_convolve():
+    # Odd sizes exercise the cropping after expansion
+    images = _synthetic_stack(count=3, shape=(67, 45))
+    reference = fs.laplacian_pyramid(images, 3, backend="convolve")
+    separable = fs.laplacian_pyramid(images, 3, backend="separable")
+    assert len(reference) == len(separable)
+    for expected, level in zip(reference, separable):
+        np.testing.assert_allclose(level, expected, atol=1e-9)
+    np.testing.assert_allclose(fs.collapse([level[0] for level in separable], backend="separable"),
+                               fs.collapse([level[0] for level in reference], backend="convolve"), atol=1e-9)
+
+
+def test_pyramid_fusion_backends_agree():
+    images = _synthetic_stack(count=3, shape=(160, 136))
+    expected, expected_depth = fs.get_pyramid_fusion(images, backend="convolve")
+    fused, depth = fs.get_pyramid_fusion(images, backend="separable")
+    np.testing.assert_allclose(fused, expected, atol=1e-6)
+    np.testing.assert_array_equal(depth, expected_depth)
+
+
+def test_sequential_fusion_matches_batch():
+    images = _synthetic_stack(count=4, shape=(160, 136))
+    for precision in fs.PRECISIONS:
+        depth = 2
+        pyramids = fs.laplacian_pyramid(images, depth, "separable", precision)
+        fusion, expected_depth = fs.fuse_pyramids(pyramids, 5, precision)
+        expected = fs.collapse(fusion, "separable")
+        fuser = fs.PyramidFuser(depth, precision=precision)
+        for image in images:
+            fuser.add(image)
+        fused, depth_map = fuser.result()
+        np.testing.assert_allclose(fused, expected, atol=1e-4)
+        np.testing.assert_array_equal(depth_map, expected_depth)
+
+
+def test_reduced_precision_close_to_float64():
+    images = _synthetic_stack(count=3, shape=(160, 136))
+    expected, _ = fs.get_pyramid_fusion(images)
+    fused, _ = fs.get_pyramid_fusion(images, precision="float32")
+    assert fused.dtype == np.float32
+    np.testing.assert_allclose(fused, expected, atol=1e-2)
+    fused, _ = fs.get_pyramid_fusion(images, precision="uint16")
+    # Each level is quantised to 1/128 of a grey level
+    assert np.abs(fused - expected).mean() < 0.1
+
+
+def test_uint16_precision_needs_8_bit_images():
+    images = (_synthetic_stack(count=3, shape=(160, 136)) * 256).astype(np.uint16)
+    with pytest.raises(ValueError):
+        fs.get_pyramid_fusion(images, precision="uint16")
+    # Over budget, 16 bit images are fused in float32 rather than in uint16
+    strategy, precision, _ = fs.choose_fusion_strategy(images.shape, 2, memory_budget=1, dtype=images.dtype)
+    assert precision == "float32"
+
+
+def test_stats_stop_tracing_on_error():
+    images = (_synthetic_stack(count=3, shape=(160, 136)) * 256).astype(np.uint16)
+    with pytest.raises(ValueError):
+        fs.get_pyramid_fusion(images, precision="uint16", stats={})
+    assert not tracemalloc.is_tracing()
+
+
+def test_memory_budget_switches_strategy():
+    images = _synthetic_stack(count=6, shape=(160, 136))
+    batch_bytes = fs.estimate_fusion_bytes(images.shape, 2, "float64", "batch")
+    sequential_bytes = fs.estimate_fusion_bytes(images.shape, 2, "float64", "sequential")
+    assert sequential_bytes < batch_bytes
+    stats = {}
+    fused, _ = fs.get_pyramid_fusion(images, memory_budget=sequential_bytes, stats=stats)
+    assert stats['strategy'] == "sequential"
+    assert stats['precision'] == "float64"
+    assert stats['peak_bytes'] > 0
+    expected, _ = fs.get_pyramid_fusion(images)
+    np.testing.assert_allclose(fused, expected, atol=1e-9)
+
+
+def test_tiled_fusion_matches_untiled():
+    images = _synthetic_stack(count=3, shape=(300, 260))
+    expected, expected_depth = fs.get_pyramid_fusion(images)
+    stats = {}
+    fused, depth_map = fs.get_pyramid_fusion(images, tile_size=64, workers=1, stats=stats)
+    assert stats['tiles'] > 1
+    np.testing.assert_array_equal(depth_map, expected_depth)
+    np.testing.assert_allclose(fused, expected, atol=1e-6)
+
+
+def test_streaming_fuser_matches_batch(tmp_path):
+    images = _synthetic_stack(count=4, shape=(160, 136))
+    expected, expected_depth = fs.get_pyramid_fusion(images)
+    save_path = tmp_path.joinpath("scan1", "X00000_Y00000.png")
+    fuser = fs.StreamingFuser(save_path, max_pending=1)
+    for image in images:
+        fuser.add(image)
+    fuser.close()
+    fused, depth_map = fuser.result()
+    np.testing.assert_allclose(fused, expected, atol=1e-9)
+    np.testing.assert_array_equal(depth_map, expected_depth)
+    assert save_path.exists()
+
+
+def test_depth_map_fusion_picks_sharpest():
+    rng = np.random.default_rng(0)
+    sharp = rng.integers(0, 256, size=(64, 80, 3)).astype(np.uint8)
+    blurred = cv2.GaussianBlur(sharp, (0, 0), 3)
+    # The left half is in focus in the second image, the right half in the third
+    images = np.asarray([blurred, blurred.copy(), blurred.copy()])
+    images[1, :, :40] = sharp[:, :40]
+    images[2, :, 40:] = sharp[:, 40:]
+    fused, depth, confidence = fs.get_depth_map_fusion(images, z_step=20)
+    assert depth.dtype == np.float32
+    # Away from the seam, where the windows see both halves
+    assert np.all(depth[:, :30] == 20)
+    assert np.all(depth[:, 50:] == 40)
+    np.testing.assert_array_equal(fused[:, :30], sharp[:, :30])
+    np.testing.assert_array_equal(fused[:, 50:], sharp[:, 50:])
+    assert 0 <= confidence.min() and confidence.max() <= 1
+    assert confidence[:, 50:].mean() > 0.5
+
+
+def test_focus_measure_channel_order():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(32, 40, 3)).astype(np.uint8)
+    np.testing.assert_allclose(fs.focus_measure(image[..., ::-1], channels="BGR"), fs.focus_measure(image),
+                               rtol=1e-5)
+    assert not np.allclose(fs.focus_measure(image[..., ::-1]), fs.focus_measure(image))
+    with pytest.raises(ValueError, match="channel order"):
+        fs.focus_measure(image, channels="GBR")
+
+
+def test_streaming_fuser_error(tmp_path):
+    # 16 bit slices can not be fused in uint16, which fails on the first slice
+    images = (_synthetic_stack(count=6, shape=(160, 136)) * 256).astype(np.uint16)
+    save_path = tmp_path.joinpath("scan1", "X00000_Y00000.png")
+    fuser = fs.StreamingFuser(save_path, precision="uint16", max_pending=1)
+    # The slices after the error are still taken, so adding them does not block
+    for image in images:
+        fuser.add(image)
+    fuser.close()
+    with pytest.raises(ValueError):
+        fuser.result()
+    assert not save_path.exists()
+
+
+def test_images_too_small_for_a_pyramid_level():
+    images = _synthetic_stack(count=3, shape=(16, 16))
+    with pytest.raises(ValueError, match="min_size"):
+        fs.get_pyramid_fusion(images)
+    with pytest.raises(ValueError):
+        fs.PyramidFuser(0)
+    fused, depth_map = fs.get_pyramid_fusion(images, min_size=4)
+    assert fused.shape == images.shape[1:] and depth_map.shape == images.shape[1:3]
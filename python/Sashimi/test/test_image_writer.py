@@ -0,0 +1,23 @@
+import cv2
+import numpy as np
+
+from sashimi import image_writer
+
+
+def test_writer_flushes_all_images(tmp_path):
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(10, 32, 48, 3)).astype(np.uint8)
+    writer = image_writer.ImageWriter(workers=2, max_pending=2)
+    for i, image in enumerate(images):
+        writer.write(tmp_path.joinpath(f"{i}.png"), image)
+    writer.write(tmp_path.joinpath("10.jpg"), images[0])
+    writer.flush()
+    stats = writer.stats()
+    assert stats['written'] == 11 and stats['errors'] == 0 and stats['depth'] == 0
+    assert 1 <= stats['max_depth'] <= 2
+    for i, image in enumerate(images):
+        np.testing.assert_array_equal(cv2.imread(str(tmp_path.joinpath(f"{i}.png"))), image)
+    assert cv2.imread(str(tmp_path.joinpath("10.jpg"))).shape == images[0].shape
+    writer.write(tmp_path.joinpath("missing", "0.jpg"), images[0])
+    writer.close()
+    assert writer.stats()['errors'] == 1
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from sashimi import motion
+
+
+def test_calibrate_recovers_the_accelerations():
+    rng = np.random.default_rng(0)
+    truth = motion.MotionModel({'acceleration': {'X': 800, 'Y': 1000, 'Z': 50}, 'settle_time': 0.02})
+    model = motion.MotionModel()
+    assert not model.calibrate()
+    for _ in range(40):
+        moves = [('X', rng.uniform(100, 5000), 3000), ('Z', rng.uniform(10, 300), 100)]
+        model.observe(moves, truth.duration(moves) + rng.normal(0, 0.001))
+    error = model.error()
+    assert model.calibrate()
+    assert model.error() < error
+    assert abs(model.parameters['acceleration']['X'] - 800) < 80
+    assert abs(model.parameters['acceleration']['Z'] - 50) < 10
+    # Y did not move
+    assert model.parameters['acceleration']['Y'] == 1000
+    assert abs(model.parameters['settle_time'] - 0.02) < 0.005
+
+
+def test_calibrate_settle_time_only():
+    model = motion.MotionModel({'acceleration': {'X': 1000, 'Y': 1000, 'Z': 100}, 'settle_time': 0})
+    for _ in range(10):
+        model.observe([], 0.01)
+    assert model.calibrate()
+    assert abs(model.parameters['settle_time'] - 0.01) < 1e-4
+
+
+def test_move_position_follows_the_speed_profile():
+    for distance in (0.01, 5):
+        duration = motion.move_duration(distance, 600, 100)
+        times = np.linspace(-0.1, duration + 0.1, 200)
+        positions = np.asarray([motion.move_position(t, distance, 600, 100) for t in times])
+        assert positions[0] == 0 and positions[-1] == distance
+        assert np.all(np.diff(positions) >= 0)
+        assert motion.move_position(duration / 2, distance, 600, 100) == pytest.approx(distance / 2)
+    model = motion.MotionModel()
+    assert model.move_position('Z', 100, -300, 100) == -300
@@ -0,0 +1,22 @@
+import numpy as np
+
+from sashimi import occupancy, simulation
+
+
+def test_particles_are_found_on_the_simulated_scene():
+    for z in (1800, 2000):
+        occupied = simulation.SyntheticScene(shape=(240, 320), particles=10)
+        empty = simulation.SyntheticScene(shape=(240, 320), particles=0)
+        result = occupancy.occupancy(occupied.render(0, 0, z, 2000), min_area=100)
+        assert result['occupied'] and result['particles'] > 0 and result['fraction'] > 0
+        assert not occupancy.occupancy(empty.render(0, 0, z, 2000), min_area=100)['occupied']
+
+
+def test_small_blobs_and_flat_fields_are_empty():
+    img = np.full((200, 200), 120, dtype=np.uint8)
+    assert occupancy.occupancy(img) == {'occupied': False, 'fraction': 0., 'particles': 0}
+    img[50:54, 50:54] = 20
+    assert not occupancy.occupancy(img, min_area=400)['occupied']
+    img[100:140, 100:140] = 20
+    result = occupancy.occupancy(img, min_area=400)
+    assert result['occupied'] and result['particles'] == 1
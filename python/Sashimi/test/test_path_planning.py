@@ -0,0 +1,47 @@
+from sashimi import path_planning
+
+
+def _scan(x, y, columns, rows, step=100):
+    return {'FL': [x, y, 1000], 'BR': [x + (columns - 1) * step, y + (rows - 1) * step, 1000]}
+
+
+def _flat(scan, dx, dy):
+    return scan['FL'][2]
+
+
+def test_serpentine():
+    assert path_planning.serpentine(3, 2) == [(0, 0), (1, 0), (2, 0), (2, 1), (1, 1), (0, 1)]
+
+
+def test_plan_scan_stays_down_between_close_stacks():
+    scan = _scan(0, 0, 3, 2)
+    stops = path_planning.plan_scan(scan, 0, 100, 100, lambda scan, dx, dy: 1000 + dx, z_tolerance=150)
+    assert [(stop['x'], stop['y']) for stop in stops] == [(0, 0), (100, 0), (200, 0), (200, 100), (100, 100), (0, 100)]
+    assert [stop['return_z'] for stop in stops] == [False, False, False, False, False, True]
+    stops = path_planning.plan_scan(scan, 0, 100, 100, lambda scan, dx, dy: 1000 + dx, z_tolerance=50)
+    assert [stop['return_z'] for stop in stops] == [True, True, False, True, True, True]
+    reverse = path_planning.plan_scan(scan, 0, 100, 100, _flat, reverse=True)
+    assert (reverse[0]['x'], reverse[0]['y']) == (0, 100)
+
+
+def test_serpentine_travels_less_than_raster():
+    scan = _scan(0, 0, 10, 10, step=1700)
+    stops = path_planning.plan_scan(scan, 0, 1700, 1700, _flat)
+    raster = sorted(stops, key=lambda stop: (stop['y'], stop['x']))
+    assert path_planning.travel_time(stops, [0, 0, 1000]) < path_planning.travel_time(raster, [0, 0, 1000])
+    # Going back up to the height of the scan takes longer
+    lower = [dict(stop, z=500) for stop in stops]
+    assert path_planning.travel_time(lower, [0, 0, 1000], lambda stop: 1000) > \
+        path_planning.travel_time(lower, [0, 0, 1000])
+
+
+def test_order_scans():
+    scans = [_scan(20000, 0, 3, 3), _scan(0, 0, 3, 3), _scan(10000, 0, 3, 3), {'FL': [0, 0, 0], 'BR': [-1, -1, 0]}]
+    plans = [path_planning.plan_scan(scan, n, 100, 100, _flat) for n, scan in enumerate(scans)]
+    order = path_planning.order_scans(plans, [0, 0, 0])
+    assert [index for index, _ in order] == [1, 2, 0, 3]
+    # The scans with an odd number of rows end on the right, so they are all walked forward
+    assert [reverse for _, reverse in order[:3]] == [False, False, False]
+    order = path_planning.order_scans(plans, [30000, 300, 0])
+    assert [index for index, _ in order] == [0, 2, 1, 3]
+    assert order[0][1]
@@ -0,0 +1,53 @@
+import numpy as np
+
+from sashimi import simulation
+from sashimi.preview import READOUT_HEIGHT, Preview
+
+
+def frame():
+    return simulation.SyntheticScene(shape=(240, 320)).render(0, 0, 2000, 2000)
+
+
+def test_the_canvas_is_reused_and_the_frame_shrunk_next_to_the_panel():
+    preview = Preview(panel_width=100, scale=4)
+    canvas = preview.render(frame(), buttons=["a"], status=["STATUS"])
+    assert canvas.shape == (60 + READOUT_HEIGHT, 180, 3)
+    assert np.any(canvas[:, :100]) and np.any(canvas[:, 100:])
+    assert preview.render(frame(), buttons=["a"], status=["STATUS"]) is canvas
+
+
+def test_only_the_lines_that_changed_are_redrawn():
+    preview = Preview(panel_width=100, scale=4)
+    panel = preview.render(frame(), buttons=["a", "b"], status=["ONE", "TWO"])[:, :100].copy()
+    # A mark the next render would erase if it redrew the first line
+    preview.canvas[10, 95] = 255
+    panel_after = preview.render(frame(), buttons=["a", "b"], status=["ONE", "THREE"])[:, :100]
+    assert panel_after[10, 95, 0] == 255
+    assert np.array_equal(panel_after[:25, :90], panel[:25, :90])
+    assert not np.array_equal(panel_after[25:45], panel[25:45])
+
+
+def test_a_channel_in_grey_levels_and_the_help_over_the_frame():
+    preview = Preview(panel_width=100, scale=4)
+    canvas = preview.render(frame(), channel=2)
+    assert np.all(canvas[..., 0] == canvas[..., 2]) and np.all(canvas[..., 1] == canvas[..., 2])
+    plain = canvas[:, 100:].copy()
+    canvas = preview.render(frame(), channel=2, help_text=["?: show help"])
+    assert not np.array_equal(canvas[:, 100:], plain)
+    assert np.array_equal(preview.render(frame(), channel=2)[:, 100:], plain)
+
+
+def test_readout():
+    preview = Preview(panel_width=200, scale=4, readout_interval=0)
+    preview.render(frame(), started=0)
+    assert "fps" in preview.readout and "delay" in preview.readout
+
+
+def test_the_readout_leaves_the_panel_untouched():
+    preview = Preview(panel_width=200, scale=4, readout_interval=0)
+    buttons, status = ["a", "b", "c"], ["ONE", "TWO", "THREE"]
+    panel = preview.render(frame(), buttons=buttons, status=status)[:60, :200].copy()
+    assert np.any(panel[40:60])
+    canvas = preview.render(frame(), buttons=buttons, status=status)
+    assert np.array_equal(canvas[:60, :200], panel)
+    assert np.any(canvas[60:, :200])
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+
+from sashimi import registration
+
+
+def _shifted_stack(shifts, shape=(300, 360), seed=1):
+    rng = np.random.default_rng(seed)
+    base = cv2.GaussianBlur(rng.integers(0, 256, size=(*shape, 3)).astype(np.uint8), (0, 0), 2)
+    images = []
+    for dx, dy in shifts:
+        M = np.float32([[1, 0, -dx], [0, 1, -dy]])
+        images.append(cv2.warpAffine(base, M, shape[::-1], borderMode=cv2.BORDER_REFLECT))
+    return np.asarray(images)
+
+
+def test_estimate_shifts_subpixel():
+    shifts = [(0, 0), (3, -2), (7.5, -4.25), (10, 1), (-6, 5)]
+    estimated = registration.estimate_shifts(_shifted_stack(shifts))
+    np.testing.assert_allclose(estimated, shifts, atol=0.15)
+
+
+def test_apply_shifts_aligns_and_crops():
+    shifts = [(0, 0), (3, -2), (10, 1), (-6, 5)]
+    images = _shifted_stack(shifts)
+    aligned, estimated = registration.register(images)
+    y0, y1, x0, x1 = registration.crop_box(images.shape[1:3], np.round(estimated))
+    assert aligned.shape == (4, y1 - y0, x1 - x0, 3)
+    for image in aligned[1:]:
+        assert np.abs(image.astype(np.float64) - aligned[0]).mean() < 1
+
+
+def test_small_shifts_are_skipped():
+    images = _shifted_stack([(0, 0), (0.2, -0.1), (0.1, 0.3)])
+    aligned, shifts = registration.register(images)
+    assert not registration.needs_alignment(shifts)
+    assert aligned is images
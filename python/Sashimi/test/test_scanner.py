@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+import skimage.io as skio
+
+from sashimi import simulation
+from sashimi.controller import Controller
+
+
+def _scan(save_dir, columns=2, rows=1, shape=(120, 160), height=400, step=100, empty=0., **options):
+    """
+    Simulated multi-scan of a grid of columns x rows stacks, with the configuration changed in memory only
+    """
+    controller = Controller(save_dir, None, simulate=True, headless=True, stack_workers=1, **options)
+    config = controller.config
+    scanner = controller.scanner
+    config.stack_height = height
+    config.stack_step = step
+    fl = [10000, 50000, 2000]
+    br = [fl[0] + scanner.X_STEP * (columns - 1) + 1, fl[1] + scanner.Y_STEP * (rows - 1) + 1, 2000]
+    config.scans = [{'FL': fl, 'BR': br, 'BL_Z': 2000, 'Z_corrections': [0, 0]}]
+    # The particles of the small scene are a few hundred pixels large
+    config.occupancy_min_area = 100
+    scanner.update_stack_count()
+    controller.camera.scene = simulation.SyntheticScene(shape=shape, empty=empty)
+    controller.camera.fps = 50
+    controller.stage.start()
+    controller.camera.start()
+    try:
+        controller.camera.set_exposure(config.exposure_time)
+        scanner.multi_scan()
+    finally:
+        controller.camera.stop()
+        controller.stage.stop()
+    return controller
+
+
+def test_depth_map_follows_the_step_of_the_scan(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    # The step is changed after the scanner was made, as with the keys of the controller
+    controller = _scan(tmp_path.joinpath("scan"), columns=1, stacker="depthmap", step=100)
+    assert controller.scanner.stacker.z_step == 100
+    depths = list(tmp_path.joinpath("scan", "f_stacks").rglob("*_depth.tif"))
+    assert len(depths) == 1
+    depth = skio.imread(depths[0])
+    assert depth.max() > 0
+    assert set(np.unique(depth)) <= {0, 100, 200, 300, 400}
+
+
+def test_fields_with_particles_are_not_empty(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    # The particles lie on the floor and above, z_margin over the bottom of the stacks where they are out of focus
+    controller = _scan(tmp_path.joinpath("scan"), empty_fields='skip')
+    assert controller.scanner.summary['empty fields'] == {'checked': 2, 'empty': []}
+    assert len(list(tmp_path.joinpath("scan", "f_stacks", "scan1").glob("*.png"))) == 2
+    # The frame of the check is one of the slices
+    for folder in tmp_path.joinpath("scan", "scan1").iterdir():
+        assert len(list(folder.glob("*.jpg"))) == controller.scanner.stack_count
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {'remove_raw': True},
+    {'triggered': True},
+    {'continuous_z': True},
+    {'stream_stack': True, 'remove_raw': True},
+    {'stack_files': True},
+    {'stack_files': True, 'remove_raw': True},
+    {'adaptive_z': True},
+    {'autofocus': 'tile'},
+    {'autofocus': 'corners'},
+    # A bilinear focus map needs a grid of 2 x 2 samples, so the scan must span two rows
+    {'autofocus': 'map', 'rows': 2},
+    {'empty_fields': 'skip'},
+    {'empty_fields': 'single', 'remove_raw': True},
+], ids=lambda options: "-".join(f"{key}={value}" for key, value in options.items()) or "default")
+def test_multi_scan(tmp_path, monkeypatch, options):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    save_dir = tmp_path.joinpath("scan")
+    controller = _scan(save_dir, **options)
+    fields = {path.stem for path in save_dir.joinpath("f_stacks", "scan1").glob("*.png")}
+    assert len(fields) == 2 * options.get('rows', 1)
+    raw = list(save_dir.joinpath("scan1").iterdir())
+    if options.get('remove_raw'):
+        assert raw == []
+    elif options.get('stack_files'):
+        assert {path.stem for path in raw} == fields
+    else:
+        assert sorted(path.name for path in raw) == sorted(fields)
+        assert all(len(list(path.glob("*.jpg"))) > 0 for path in raw)
+    summary = controller.scanner.summary
+    assert {'scan_dates', 'phase times (s)', 'autofocus moves', 'adaptive z', 'empty fields', 'image writer',
+            'stack_step (µm)'} <= set(summary)
+    assert len(summary['scan_dates']) == 2
+    assert save_dir.joinpath("summary.txt").exists()
+    if options.get('autofocus'):
+        assert summary['autofocus moves'] > 0
+    if options.get('adaptive_z'):
+        assert summary['adaptive z']['stacks'] == 2
+    if options.get('empty_fields'):
+        assert summary['empty fields'] == {'checked': 2, 'empty': []}
+    # Free running capture is restored for the preview
+    assert not controller.camera.triggered
+
+
+def test_multi_scan_of_empty_fields(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    save_dir = tmp_path.joinpath("scan")
+    controller = _scan(save_dir, empty=1., empty_fields='single', triggered=True)
+    assert list(save_dir.joinpath("f_stacks", "scan1").glob("*.png")) == []
+    assert sorted(path.name for path in save_dir.joinpath("scan1").iterdir()) == ["X01000_Y05000.jpg",
+                                                                                   "X01170_Y05000.jpg"]
+    assert len(controller.scanner.summary['empty fields']['empty']) == 2
+    assert not controller.camera.triggered
@@ -0,0 +1,59 @@
+import time
+
+import cv2
+import numpy as np
+
+from sashimi import simulation
+
+
+def _read_lines(serial):
+    return serial.read(serial.in_waiting).decode().split()
+
+
+def test_serial_waits_for_moves():
+    serial = simulation.SimulatedSerial(latency=0)
+    serial.write(b"G0 X 1.000000 F3000\nM400\nM118 Ready\n")
+    duration = simulation.move_duration(1, 3000, 1000)
+    assert "Ready" not in _read_lines(serial)
+    time.sleep(duration + 0.01)
+    assert "Ready" in _read_lines(serial)
+    assert serial.position() == [1000, 0, 0]
+    serial.write(b"M114 R\n")
+    assert _read_lines(serial)[0] == "X:1.000"
+
+
+def test_scene_is_sharp_in_focus():
+    scene = simulation.SyntheticScene(shape=(120, 160), floor_z=1000, relief=0, particles=5)
+    sharpness = [cv2.Laplacian(cv2.cvtColor(scene.render(0, 0, z, 2000), cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
+                 for z in (800, 900, 1000, 1100)]
+    assert np.argmax(sharpness) == 2
+    dark = scene.render(0, 0, 1000, 1000)
+    assert dark.mean() < scene.render(0, 0, 1000, 2000).mean()
+
+
+def test_tiny_scene():
+    scene = simulation.SyntheticScene(shape=(24, 32), particles=5)
+    assert scene.render(0, 0, 1000, 2000).shape == (24, 32, 3)
+
+
+def test_triggered_camera_takes_one_frame_per_trigger():
+    class Controller(object):
+        quit_requested = False
+
+    controller = Controller()
+    controller.stage = simulation.SimulatedStage(controller)
+    controller.stage.start()
+    camera = simulation.SimulatedCamera(controller, simulation.SyntheticScene(shape=(120, 160), particles=2), fps=50)
+    camera.set_triggered(True)
+    camera.start()
+    try:
+        sequences = []
+        for _ in range(3):
+            image, _, _ = camera.wait_for_frame(after=camera.trigger(), timeout=1)
+            assert image is not None
+            sequences.append(camera.frames.sequence)
+        time.sleep(0.1)
+        assert sequences == [0, 1, 2]
+        assert camera.frames.sequence == 2
+    finally:
+        camera.stop()
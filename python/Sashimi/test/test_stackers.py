@@ -0,0 +1,87 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+import skimage.io as skio
+
+from sashimi import stack_file, stackers, stacking_service
+
+
+def _stack(seed, count=3, shape=(160, 136)):
+    # Differently blurred copies of one image, so that the registration leaves them untouched
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, size=(*shape, 3)).astype(np.uint8)
+    return np.asarray([cv2.GaussianBlur(image, (0, 0), 0.5 + i) for i in range(count)])
+
+
+def test_get_stacker():
+    assert isinstance(stackers.get_stacker("pyramid"), stackers.PyramidStacker)
+    with pytest.raises(ValueError):
+        stackers.get_stacker("unknown")
+    stacker = stackers.get_stacker("pyramid", precision="uint16", memory_budget=1e9)
+    assert (stacker.precision, stacker.memory_budget) == ("uint16", 1e9)
+    with pytest.raises(ValueError):
+        stackers.get_stacker("pyramid", precision="float16")
+
+
+def test_pyramid_stacker_in_service(tmp_path):
+    folder = tmp_path.joinpath("scan1", "X00000_Y00000")
+    os.makedirs(folder)
+    images = _stack(0)
+    for i, image in enumerate(images):
+        skio.imsave(folder.joinpath(f"X00000_Y00000_Z{i:05d}.jpg"), image, check_contrast=False)
+    stacker = stackers.get_stacker("pyramid")
+    memory_path = tmp_path.joinpath("f_stacks", "memory" + stacker.extension)
+    folder_path = tmp_path.joinpath("f_stacks", "folder" + stacker.extension)
+    with stacking_service.StackingService(stacker, workers=1) as service:
+        service.submit(images, save_path=memory_path)
+        service.submit_folder(folder, save_path=folder_path, remove_raw=True)
+        results = service.close()
+    assert [result['error'] for result in results] == [None, None]
+    assert skio.imread(memory_path).shape == images.shape[1:]
+    assert folder_path.exists()
+    assert not folder.exists()
+
+
+def test_depth_map_stacker(tmp_path):
+    images = _stack(0)
+    stacker = stackers.get_stacker("depthmap", z_step=20)
+    save_path = tmp_path.joinpath("scan1", "X00000_Y00000.png")
+    timings = stacker(images, save_path)
+    assert {'registration', 'fusion', 'save'} <= set(timings)
+    assert skio.imread(save_path).shape == images.shape[1:]
+    depth = skio.imread(tmp_path.joinpath("scan1", "X00000_Y00000_depth.tif"))
+    assert depth.dtype == np.float32
+    # The least blurred image is the first one
+    assert np.median(depth) == 0
+    assert tmp_path.joinpath("scan1", "X00000_Y00000_confidence.tif").exists()
+
+
+def test_stacker_maps_stack_file(tmp_path):
+    images = _stack(0)
+    path = tmp_path.joinpath("X00000_Y00000.npy")
+    file = stack_file.StackFile(path, len(images) + 1, images.shape[1:], exposure=2000)
+    for i, image in enumerate(images):
+        file.write(i, image, z=100 * i)
+    file.close()
+    frames, metadata = stack_file.read_stack(path)
+    assert isinstance(frames, np.memmap)
+    np.testing.assert_array_equal(frames, images)
+    assert metadata['exposure'] == 2000 and [frame['z'] for frame in metadata['frames']] == [0, 100, 200]
+    stacker = stackers.get_stacker("pyramid")
+    save_path = tmp_path.joinpath("f_stacks", "X00000_Y00000.png")
+    stacker.stack_folder(str(path), save_path, remove_raw=True)
+    assert save_path.exists()
+    assert not path.exists() and not os.path.exists(stack_file.metadata_path(path))
+
+
+def test_remove_raw_exposure_folders(tmp_path):
+    xy_folder = tmp_path.joinpath("scan1", "X00000_Y00000")
+    for exp in (1000, 2000):
+        os.makedirs(xy_folder.joinpath(f"E{exp}"))
+    stackers.remove_raw_stack(xy_folder.joinpath("E1000"))
+    assert xy_folder.exists()
+    stackers.remove_raw_stack(xy_folder.joinpath("E2000"))
+    assert not xy_folder.exists()
+    assert tmp_path.joinpath("scan1").exists()
@@ -0,0 +1,109 @@
+import os
+import time
+
+import numpy as np
+import skimage.io as skio
+
+from sashimi import focus_stack, stacking_service
+
+
+def _mean_stacker(images, save_path):
+    skio.imsave(save_path, images.mean(axis=0).astype(np.uint8), check_contrast=False)
+    return {'mean': 0.0}
+
+
+def _stack(seed, count=3, shape=(64, 80)):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(count, *shape, 3)).astype(np.uint8)
+
+
+def test_service_stacks_shared_frames(tmp_path):
+    stacks = [_stack(seed) for seed in range(3)]
+    with stacking_service.StackingService(_mean_stacker, workers=2, max_pending=2) as service:
+        results = []
+        for i, images in enumerate(stacks):
+            if i == 0:
+                # Filled in place, as during capture
+                shared = service.allocate(images.shape)
+                shared.array[:] = images
+                results += service.submit(shared, save_path=str(tmp_path.joinpath(f"{i}.png")))
+            else:
+                results += service.submit(images, save_path=str(tmp_path.joinpath(f"{i}.png")))
+        results += service.close()
+    assert sorted(result['id'] for result in results) == [0, 1, 2]
+    for result in results:
+        assert result['error'] is None
+        assert {'queued', 'load', 'mean', 'total'} <= set(result['timings'])
+    for i, images in enumerate(stacks):
+        np.testing.assert_array_equal(skio.imread(tmp_path.joinpath(f"{i}.png")),
+                                      images.mean(axis=0).astype(np.uint8))
+
+
+def test_service_reports_errors(tmp_path):
+    with stacking_service.StackingService(_mean_stacker, workers=1) as service:
+        service.submit_folder(tmp_path, save_path=str(tmp_path.joinpath("empty.png")))
+        results = service.close()
+    assert len(results) == 1
+    assert results[0]['error'] is not None
+
+
+def test_stack_directory(tmp_path):
+    folder = tmp_path.joinpath("X00000_Y00000")
+    os.makedirs(folder)
+    for i, image in enumerate(_stack(0, shape=(160, 136))):
+        skio.imsave(folder.joinpath(f"X00000_Y00000_Z{i:05d}.jpg"), image, check_contrast=False)
+    focus_stack.stack(tmp_path, workers=1)
+    save_dir = folder.joinpath("fused_laplacian_pyramids")
+    assert save_dir.joinpath("X00000_Y00000_image.png").exists()
+    assert save_dir.joinpath("X00000_Y00000_depth.png").exists()
+
+
+def _dying_stacker(images, save_path):
+    # As if killed when out of memory
+    if save_path.endswith("dies.png"):
+        os._exit(1)
+    return _mean_stacker(images, save_path)
+
+
+def test_service_survives_dead_workers(tmp_path):
+    with stacking_service.StackingService(_dying_stacker, workers=2) as service:
+        results = service.submit(_stack(0), save_path=str(tmp_path.joinpath("dies.png")))
+        results += service.submit(_stack(1), save_path=str(tmp_path.joinpath("done.png")))
+        results += service.close()
+    errors = {result['kwargs']['save_path']: result['error'] for result in results}
+    assert errors[str(tmp_path.joinpath("done.png"))] is None
+    assert "died" in errors[str(tmp_path.joinpath("dies.png"))]
+    assert service.pending == {}
+
+
+def test_service_fails_tasks_without_workers(tmp_path):
+    with stacking_service.StackingService(_dying_stacker, workers=1) as service:
+        results = service.submit(_stack(0), save_path=str(tmp_path.joinpath("dies.png")))
+        results += service.submit(_stack(1), save_path=str(tmp_path.joinpath("left.png")))
+        results += service.close()
+    assert len(results) == 2
+    assert all(result['error'] is not None for result in results)
+    assert service.pending == {}
+
+
+def _slow_stacker(images, save_path):
+    open(save_path + ".started", "w").close()
+    if save_path.endswith("killed.png"):
+        time.sleep(60)
+    return _mean_stacker(images, save_path)
+
+
+def test_service_fails_tasks_of_killed_workers(tmp_path):
+    killed = str(tmp_path.joinpath("killed.png"))
+    with stacking_service.StackingService(_slow_stacker, workers=2) as service:
+        results = service.submit(_stack(0), save_path=killed)
+        results += service.submit(_stack(1), save_path=str(tmp_path.joinpath("done.png")))
+        # Killed once it has taken its task off the queue
+        while not os.path.exists(killed + ".started"):
+            time.sleep(0.05)
+        service.processes[0].kill()
+        results += service.close()
+    errors = {result['kwargs']['save_path']: result['error'] for result in results}
+    assert "died" in errors[killed]
+    assert errors[str(tmp_path.joinpath("done.png"))] is None
+    assert service.pending == {}
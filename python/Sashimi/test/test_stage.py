@@ -0,0 +1,40 @@
+import time
+
+from sashimi import simulation
+from sashimi.stage import SerialDriver
+
+
+def test_driver_matches_replies_to_commands():
+    serial = simulation.SimulatedSerial(latency=0.001)
+    driver = SerialDriver(serial, keep_ahead=2)
+    driver.start()
+    try:
+        move = driver.send("G0 Z 0.100000 F100")
+        settled = driver.send("M400")
+        echo = driver.send("M118 Ready")
+        position = driver.send("M114 R")
+        assert move.result(1) == []
+        assert not settled.done()
+        # Only two commands are kept ahead in the firmware: M114 waits for the ok of M400
+        time.sleep(0.01)
+        assert serial.commands == 3
+        start = time.monotonic()
+        settled.result(1)
+        assert time.monotonic() - start > 0.02
+        assert serial.position()[2] == 100
+        assert echo.result(1) == ["Ready"]
+        assert position.result(1)[0].startswith("X:0.000 Y:0.000 Z:0.100")
+    finally:
+        driver.stop()
+
+
+def test_driver_keeps_unsolicited_messages():
+    serial = simulation.SimulatedSerial(latency=0)
+    serial.output.append((0, b"start\necho: Marlin\n"))
+    driver = SerialDriver(serial)
+    driver.start()
+    try:
+        driver.send("M114 R").result(1)
+        assert list(driver.messages) == ["start", "echo: Marlin"]
+    finally:
+        driver.stop()